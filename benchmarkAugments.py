@@ -0,0 +1,42 @@
+#######################################################################################
+# cpu cost of every augment code on the kornia, torchvision and fused backends, see src/AugmentBenchmark.py
+#
+#   python benchmarkAugments.py --augments Af Pe Ji Er --cutn 32 64 128 --json augments.json
+#######################################################################################
+
+import argparse
+
+from src import AugmentBenchmark
+
+
+def PrintProgress(done:int, total:int, result:dict):
+    status = result['error'] if result['error'] else f"{result['cutsPerSec']:.1f} cuts/sec"
+    print(f"[{done}/{total}] {result['augment']} {result['backend']} cutn {result['cutn']} res {result['resolution']} {result['dtype']}: {status}", flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark augment backends on the cpu')
+    parser.add_argument("--augments", nargs='+', type=str, default=AugmentBenchmark.AUGMENT_CODES, choices=AugmentBenchmark.AUGMENT_CODES, help="augment codes to test")
+    parser.add_argument("--backends", nargs='+', type=str, default=AugmentBenchmark.BACKENDS, choices=AugmentBenchmark.BACKENDS, help="augment backends to test")
+    parser.add_argument("--cutn", nargs='+', type=int, default=[32, 64, 128], help="batch sizes to test")
+    parser.add_argument("--resolutions", nargs='+', type=int, default=[224, 336], help="cutout resolutions to test")
+    parser.add_argument("--dtypes", nargs='+', type=str, default=['float32', 'bfloat16'], choices=list(AugmentBenchmark.DTYPES.keys()), help="dtypes to test")
+    parser.add_argument("--repeats", type=int, default=10, help="timed runs per case")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed runs per case")
+    parser.add_argument("--threads", type=int, default=0, help="torch cpu threads ( 0 = torch default )")
+    parser.add_argument("--no_isolate", action='store_true', help="run every case in this process, faster but peak memory is cumulative")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this json file")
+    parser.add_argument("--verbose", action='store_true', help="print tracebacks for failing cases")
+    args = parser.parse_args()
+
+    cases = AugmentBenchmark.BuildCases(args.augments, args.backends, args.cutn, args.resolutions, args.dtypes,
+                                        args.repeats, args.warmup, args.threads, args.verbose)
+
+    results = AugmentBenchmark.RunBenchmark(cases, not args.no_isolate, PrintProgress)
+
+    print("")
+    print(AugmentBenchmark.FormatTable(results))
+
+    if args.json:
+        AugmentBenchmark.WriteJson(results, args.json)
+        print("\nwrote " + args.json)
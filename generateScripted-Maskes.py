@@ -43,6 +43,8 @@ spatialPrompts.append_to_prompts = ''
 #spatialPrompts.prompt_key_image = './examples/4-square-mask.png'
 spatialPrompts.prompt_key_image = './examples/4-square-mask-circle.png'
 spatialPrompts.dilate_masks = 25
+# only encode the cutouts that overlap each prompts mask, instead of all of them for any prompt that overlaps somewhere
+#spatialPrompts.pair_filter = True
 
 # make a generation job, with a few tweaked settings, in order to build a mp4:
 #   1000 iterations
@@ -63,12 +65,11 @@ genJob.AddGenerationCommandFireOnce(cut, 0)
 
 modList = HallucinatorHelpers.CreateGenerationCommandListForMaskablePrompts(genJob, spatialPrompts)
 
-# copy prompts and masks to cpu to stroe for later, we are going to move prompts from mask to mask
-maskList = []
+# store prompts for later, we are going to move prompts from mask to mask.
+# the masks live in the hallucinators mask store once added, later commands just take another handle to them
 promptList = []
 
 for mod in modList:   
-    maskList.append(mod.sourceMaskTensor.detach().clone().cpu())    
     promptList.append(mod.prompt)
     genJob.AddGenerationCommandFireOnce(mod, 0)
 
@@ -78,7 +79,7 @@ genJob.AddGenerationCommandFireOnce(rmMod, 200)
 #lets re-arrange them, change prompts between mods and what not
 i = 1
 for idx, mod in enumerate(modList):       
-    modcp = GenerationCommands.AddTextPromptWithMask(genJob, promptList[i], maskTensor=maskList[idx].detach().clone(), dilateMaskAmount=mod.dilateMaskAmount, blindfold=mod.blindfold)
+    modcp = GenerationCommands.AddTextPromptWithMask(genJob, promptList[i], maskHandle=mod.maskHandle, blindfold=mod.blindfold)
     genJob.AddGenerationCommandFireOnce(modcp, 200)
     i += 1
     i = i % len( promptList )
@@ -89,7 +90,7 @@ genJob.AddGenerationCommandFireOnce(rmMod, 400)
 #lets re-arrange them, change prompts between mods and what not
 i = 2
 for idx, mod in enumerate(modList):       
-    modcp = GenerationCommands.AddTextPromptWithMask(genJob, promptList[i], maskTensor=maskList[idx].detach().clone(), dilateMaskAmount=mod.dilateMaskAmount, blindfold=mod.blindfold)
+    modcp = GenerationCommands.AddTextPromptWithMask(genJob, promptList[i], maskHandle=mod.maskHandle, blindfold=mod.blindfold)
     genJob.AddGenerationCommandFireOnce(modcp, 400)
     i += 1
     i = i % len( promptList )  
@@ -101,7 +102,7 @@ genJob.AddGenerationCommandFireOnce(rmMod, 600)
 #lets re-arrange them, change prompts between mods and what not
 i = 3
 for idx, mod in enumerate(modList):       
-    modcp = GenerationCommands.AddTextPromptWithMask(genJob, promptList[i], maskTensor=maskList[idx].detach().clone(), dilateMaskAmount=mod.dilateMaskAmount, blindfold=mod.blindfold)
+    modcp = GenerationCommands.AddTextPromptWithMask(genJob, promptList[i], maskHandle=mod.maskHandle, blindfold=mod.blindfold)
     genJob.AddGenerationCommandFireOnce(modcp, 600)
     i += 1
     i = i % len( promptList )
@@ -113,7 +114,7 @@ genJob.AddGenerationCommandFireOnce(rmMod, 800)
 #lets re-arrange them, change prompts between mods and what not
 i = 4
 for idx, mod in enumerate(modList):       
-    modcp = GenerationCommands.AddTextPromptWithMask(genJob, promptList[i], maskTensor=maskList[idx].detach().clone(), dilateMaskAmount=mod.dilateMaskAmount, blindfold=mod.blindfold)
+    modcp = GenerationCommands.AddTextPromptWithMask(genJob, promptList[i], maskHandle=mod.maskHandle, blindfold=mod.blindfold)
     genJob.AddGenerationCommandFireOnce(modcp, 800)
     i += 1
     i = i % len( promptList )
@@ -0,0 +1,34 @@
+#######################################################################################
+# runs a local generation server, so the models get loaded once and stay warm between requests
+# model / device options come from the command line like generate.py, jobs are posted as json:
+#
+#   curl -X POST http://127.0.0.1:8765/jobs -d '{"prompts": "a waffle", "max_iterations": 100}'
+#   curl http://127.0.0.1:8765/jobs/<id>
+#   curl http://127.0.0.1:8765/jobs/<id>/result -o result.png
+#   curl -X POST http://127.0.0.1:8765/jobs/<id>/cancel
+#######################################################################################
+
+import sys
+import gc
+
+from src import CmdLineArgs
+CmdLineArgs.init()
+
+from src import HallucinatorHelpers
+from src import HallucinatorServer
+
+from PIL import ImageFile
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+
+# create the hallucinator class from commandline args, this is the only time the models get loaded
+hallucinatorInst = HallucinatorHelpers.CreateHallucinatorFromArgParse( CmdLineArgs.args )
+
+server = HallucinatorServer.HallucinatorServer( hallucinatorInst, CmdLineArgs.args )
+
+# flush, clean, go
+sys.stdout.flush()
+gc.collect()
+
+server.Start()
+server.ServeForever()
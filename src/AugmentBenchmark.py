@@ -0,0 +1,164 @@
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from typing import List
+
+import numpy as np
+import torch
+
+from src import FusedAugments
+from src import MakeCutouts
+
+
+####################################################
+# times every augment code from MakeCutouts.setupAugmentList on each backend, on the cpu
+#
+# every case ( augment, backend, cutn, resolution, dtype ) runs in its own fresh process by default,
+# so the peak memory numbers are for that case alone and one case blowing up doesnt take the rest with it.
+# results are a list of dicts, see RunCase, which can be printed as a table or written out as json
+####################################################
+
+AUGMENT_CODES = ['Ji', 'Sh', 'Gn', 'Pe', 'Ro', 'Af', 'Et', 'Ts', 'Cr', 'Er', 'Re']
+BACKENDS = ['kornia', 'torchvision', 'fused']
+DTYPES = { 'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16 }
+
+
+def BuildAugment(code:str, backend:str, cutSize:int) -> torch.nn.Module:
+    if backend == 'fused':
+        if code not in FusedAugments.FUSED_AUGMENT_NAMES:
+            raise ValueError("not supported by the fused backend")
+        return FusedAugments.FusedAugments([code])
+
+    # setupAugmentList is chatty, keep the table readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        augs = MakeCutouts.setupAugmentList([[code]], cutSize, cutSize, backend == 'kornia')
+
+    if len(augs) == 0:
+        raise ValueError("not available in the " + backend + " backend")
+    return augs
+
+
+# current resident memory of this process in MB, None where we cant tell
+def GetRssMB() -> float:
+    try:
+        with open('/proc/self/statm', 'rt') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# peak resident memory of this process in MB, None where we cant tell ( windows has no resource module )
+def GetPeakRssMB() -> float:
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports KB, mac reports bytes
+    if os.uname().sysname == 'Darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def RunCase(case:dict) -> dict:
+    result = dict(case)
+    result['error'] = None
+
+    try:
+        torch.manual_seed(0)
+        if case.get('threads'):
+            torch.set_num_threads(case['threads'])
+
+        aug = BuildAugment(case['augment'], case['backend'], case['resolution'])
+        batch = torch.rand((case['cutn'], 3, case['resolution'], case['resolution'])).to(DTYPES[case['dtype']])
+
+        result['rssBeforeMB'] = GetRssMB()
+
+        with torch.no_grad():
+            for _ in range(case['warmup']):
+                aug(batch)
+
+            latencies = []
+            for _ in range(case['repeats']):
+                start = time.perf_counter()
+                aug(batch)
+                latencies.append(time.perf_counter() - start)
+
+        latencies = np.array(latencies) * 1000
+        result['meanMs'] = float(latencies.mean())
+        result['p50Ms'] = float(np.percentile(latencies, 50))
+        result['p90Ms'] = float(np.percentile(latencies, 90))
+        result['p99Ms'] = float(np.percentile(latencies, 99))
+        result['cutsPerSec'] = case['cutn'] / (result['meanMs'] / 1000)
+    except Exception as e:
+        result['error'] = type(e).__name__ + ": " + str(e).splitlines()[0] if str(e) else type(e).__name__
+        if case.get('verbose'):
+            traceback.print_exc()
+
+    result['peakRssMB'] = GetPeakRssMB()
+    if result.get('rssBeforeMB') is not None and result['peakRssMB'] is not None:
+        result['peakRssDeltaMB'] = result['peakRssMB'] - result['rssBeforeMB']
+
+    return result
+
+
+def BuildCases(augments:List[str], backends:List[str], cutns:List[int], resolutions:List[int], dtypes:List[str],
+               repeats:int = 10, warmup:int = 2, threads:int = 0, verbose:bool = False) -> List[dict]:
+    cases = []
+    for augment in augments:
+        for backend in backends:
+            for cutn in cutns:
+                for resolution in resolutions:
+                    for dtype in dtypes:
+                        cases.append({ 'augment': augment, 'backend': backend, 'cutn': cutn, 'resolution': resolution, 'dtype': dtype,
+                                       'repeats': repeats, 'warmup': warmup, 'threads': threads, 'verbose': verbose })
+    return cases
+
+
+def RunBenchmark(cases:List[dict], isolate:bool = True, progressFunc = None) -> List[dict]:
+    results = []
+
+    if not isolate:
+        for case in cases:
+            results.append(RunCase(case))
+            if progressFunc is not None:
+                progressFunc(len(results), len(cases), results[-1])
+        return results
+
+    # a new process per case, so ru_maxrss is that case's peak
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        for result in pool.imap(RunCase, cases):
+            results.append(result)
+            if progressFunc is not None:
+                progressFunc(len(results), len(cases), result)
+
+    return results
+
+
+def FormatNumber(val, fmt:str = '.1f') -> str:
+    return '-' if val is None else format(val, fmt)
+
+
+def FormatTable(results:List[dict]) -> str:
+    header = ['augment', 'backend', 'cutn', 'res', 'dtype', 'cuts/sec', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'peak MB', 'delta MB', 'error']
+    rows = [header]
+
+    for result in results:
+        rows.append([ result['augment'], result['backend'], str(result['cutn']), str(result['resolution']), result['dtype'],
+                      FormatNumber(result.get('cutsPerSec')), FormatNumber(result.get('meanMs'), '.2f'), FormatNumber(result.get('p50Ms'), '.2f'),
+                      FormatNumber(result.get('p90Ms'), '.2f'), FormatNumber(result.get('p99Ms'), '.2f'),
+                      FormatNumber(result.get('peakRssMB'), '.0f'), FormatNumber(result.get('peakRssDeltaMB'), '.0f'), result['error'] or '' ])
+
+    widths = [ max(len(row[col]) for row in rows) for col in range(len(header)) ]
+    return '\n'.join( '  '.join(row[col].ljust(widths[col]) for col in range(len(header))).rstrip() for row in rows )
+
+
+def WriteJson(results:List[dict], path:str):
+    with open(path, 'wt') as f:
+        json.dump({ 'torch': torch.__version__, 'threads': torch.get_num_threads(), 'results': results }, f, indent=2)
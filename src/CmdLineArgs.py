@@ -8,10 +8,8 @@ import sys
 # this is used globally until i clean this all up
 args:argparse.Namespace = None
 
-def init():
-    global args
-
-
+# builds the parser with every option, also used by the server to turn job specs into args
+def build_parser() -> argparse.ArgumentParser:
     # Check for GPU and reduce the default image size if low VRAM
     default_image_size = 512  # >8GB VRAM
     if not torch.cuda.is_available():
@@ -41,6 +39,7 @@ def init():
     vq_parser.add_argument("-opt",  "--optimizer", type=str, help="Optimizer", choices=['Adam','AdamW','Adagrad','Adamax','DiffGrad','AdamP','RMSprop','MADGRAD'], default='Adam', dest='optimizer')    
     vq_parser.add_argument("-cpe",  "--change_prompt_every", type=int, help="Prompt change frequency", default=0, dest='prompt_frequency')    
     vq_parser.add_argument("-aug",  "--augments", nargs='+', action='append', type=str, choices=['None','Ji','Sh','Gn','Pe','Ro','Af','Et','Ts','Cr','Er','Re'], help="Enabled augments (latest vut method only)", default=[], dest='augments')
+    vq_parser.add_argument("--fused_augments", action='store_true', help="Run Af, Pe, Ro, Ji, Er as one warp and one colour pass instead of one kornia op each", dest='fused_augments')
     vq_parser.add_argument("-cd",   "--cuda_device", type=str, help="Cuda device to use", default="cuda:0", dest='cuda_device')
 
 
@@ -52,6 +51,27 @@ def init():
     vq_parser.add_argument("-cutp", "--cut_power", type=float, help="Cut power", default=1., dest='cut_pow')
 
     vq_parser.add_argument("-cutsize",    "--cut_size", nargs=2, type=int, help="Cut size (width height) (clip controlled)", default=[0,0], dest='cut_size')
+    vq_parser.add_argument("--cut_size_buckets", type=int, help="Snap random cut sizes to this many sizes so resampling cut methods can batch them ( 0 = off )", default=0, dest='cut_size_buckets')
+
+    # caps memory used by the nearest codebook search, which is tokens x codebook size. 0 does the whole image at once
+    vq_parser.add_argument("--vq_memory_budget", type=int, help="Max MB used at once by the vqgan nearest code search ( 0 = unbounded, the approximate search then uses 256 )", default=0, dest='vq_memory_budget')
+
+    # approximate nearest codebook search, trades a little fidelity for speed on big codebooks / high res images
+    vq_parser.add_argument("--vq_approx_lists", type=int, help="Clusters in the approximate codebook search index ( 0 = exact search )", default=0, dest='vq_approx_lists')
+    vq_parser.add_argument("--vq_approx_probes", type=int, help="Clusters searched per token by the approximate codebook search, higher = better recall, slower", default=8, dest='vq_approx_probes')
+
+    # clip text embedding cache, in memory and optionally on disk so repeated prompts skip clip
+    vq_parser.add_argument("--text_cache_mb", type=int, help="Size of the in memory clip text embedding cache in MB", default=64, dest='text_cache_mb')
+    vq_parser.add_argument("--text_cache_dir", type=str, help="Directory for the on disk clip text embedding cache ( default: disabled )", default=None, dest='text_cache_dir')
+    vq_parser.add_argument("--text_disk_cache_mb", type=int, help="Max size of the on disk clip text embedding cache in MB", default=512, dest='text_disk_cache_mb')
+    vq_parser.add_argument("--image_cache_mb", type=int, help="Size of the in memory cache of decoded image prompts in MB", default=256, dest='image_cache_mb')
+
+    # progress images get written on background threads so png encoding doesnt stall training
+    vq_parser.add_argument("--save_workers", type=int, help="Threads writing output images in the background ( 0 = save inline )", default=2, dest='save_workers')
+    vq_parser.add_argument("--save_queue", type=int, help="Images queued per writer thread before training waits for the writer", default=8, dest='save_queue')
+    vq_parser.add_argument("--metrics_flush_freq", type=int, help="Steps between reading losses back from the gpu, for save_best and the lr scheduler", default=10, dest='metrics_flush_freq')
+    vq_parser.add_argument("--clip_encode_budget", type=int, help="Max MB a clip image encode should use, bigger cutout batches are encoded in micro batches ( 0 = unbounded )", default=0, dest='clip_encode_budget')
+    vq_parser.add_argument("--cutout_chunk_size", type=int, help="Backpropagate this many cutouts through clip at a time, trades an extra clip forward for memory ( 0 = all at once )", default=0, dest='cutout_chunk_size')
 
     # manage output files and other logged data 
     vq_parser.add_argument("--output_dir", type=str, help="Output filename", default="./output/", dest='output_dir')
@@ -87,6 +107,19 @@ def init():
     vq_parser.add_argument('--load_json', help='Load settings from file in json format. Command line options override values in file.')
     vq_parser.add_argument('--convert_to_json_cmd', action='store_true', help='only load/save back to json for use as a cmd')
 
+    # server mode, see generateServer.py
+    vq_parser.add_argument("--server_host", type=str, help="Address the generation server listens on", default="127.0.0.1", dest='server_host')
+    vq_parser.add_argument("--server_port", type=int, help="Port the generation server listens on", default=8765, dest='server_port')
+    vq_parser.add_argument("--server_quantum", type=int, help="Iterations a server job runs before the next job gets a turn", default=10, dest='server_quantum')
+    vq_parser.add_argument("--server_job_history", type=int, help="Finished, failed or cancelled jobs the server and its scheduler keep the status of, older ones are forgotten ( 0 = keep all )", default=100, dest='server_job_history')
+
+    return vq_parser
+
+
+def init():
+    global args
+
+    vq_parser = build_parser()
 
     # Execute the parse_args() method
     args = vq_parser.parse_args()
@@ -148,10 +181,13 @@ def init():
 
 
 
-    #######
-    # handle some default args and other runtime decided stuff
-    #######
+    apply_runtime_defaults(args)
+
 
+#######
+# handle some default args and other runtime decided stuff
+#######
+def apply_runtime_defaults(args:argparse.Namespace):
     print("Args: " + str(args) )    
 
     if not args.prompts and not args.image_prompts:
@@ -0,0 +1,147 @@
+import math
+from typing import List
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+
+####################################################
+# approximate nearest code search over a vqgan codebook
+#
+# IVF style index: the codebook is split into clusters with kmeans when the model is loaded, and
+# each token only searches the codes in the few clusters ( probes ) whose centroids are closest to it.
+# more probes = better recall but slower, numProbes == numLists is the same as the exact search
+#
+# the lists are padded to one width, so a search is a gather of every tokens probed lists and one batched matmul,
+# with no host syncs. tokens are searched in chunks to keep the gathered lists in budget
+####################################################
+
+# used when no vq memory budget is set, the gathered lists are tokens x probes x listWidth x e_dim
+DEFAULT_SEARCH_BUDGET_MB = 256
+
+
+class IVFCodebookIndex:
+    def __init__(self, codebook:torch.Tensor, numLists:int = 0, numProbes:int = 8, kmeansIterations:int = 20, seed:int = 0, searchBudgetMB:int = 0):
+        self.codebook = codebook.detach()
+        self.codebookNormsSq = self.codebook.pow(2).sum(dim=1)
+        self.numCodes = self.codebook.shape[0]
+
+        # sqrt(n_e) clusters is the usual starting point for IVF
+        if numLists <= 0:
+            numLists = int(math.sqrt(self.numCodes))
+        self.numLists = max(1, min(numLists, self.numCodes))
+        self.numProbes = max(1, min(numProbes, self.numLists))
+        self.searchBudgetMB = searchBudgetMB if searchBudgetMB > 0 else DEFAULT_SEARCH_BUDGET_MB
+
+        self.centroids: torch.Tensor = None
+        self.centroidNormsSq: torch.Tensor = None
+        self.listCodes: torch.Tensor = None # numLists x listWidth, codebook indices in each list. padded with code 0
+        self.listNormsSq: torch.Tensor = None # numLists x listWidth, squared norms of those codes. padding is inf so it never wins
+
+        self.Build(kmeansIterations, seed)
+
+
+    @torch.no_grad()
+    def Build(self, kmeansIterations:int, seed:int):
+        gen = torch.Generator().manual_seed(seed)
+        initIdx = torch.randperm(self.numCodes, generator=gen)[:self.numLists].to(self.codebook.device)
+        centroids = self.codebook[initIdx].clone()
+
+        for _ in range(kmeansIterations):
+            assignments = self.NearestCentroids(self.codebook, centroids, 1).squeeze(1)
+
+            counts = torch.bincount(assignments, minlength=self.numLists).to(centroids.dtype)
+            sums = torch.zeros_like(centroids).index_add_(0, assignments, self.codebook)
+
+            # empty clusters just keep their old centroid
+            centroids = torch.where(counts[:, None] > 0, sums / counts.clamp(min=1)[:, None], centroids)
+
+        assignments = self.NearestCentroids(self.codebook, centroids, 1).squeeze(1)
+        counts = torch.bincount(assignments, minlength=self.numLists)
+
+        # every list gets padded to the widest one, but kmeans lists can be very uneven ( unused codes tend to pile up
+        # in one cluster ). lists wider than twice the average are split along their widest dimension.
+        # kmeans can also leave clusters empty ( and duplicate codebook rows give duplicate centroids that never win ),
+        # those are dropped so a probe always lands on a list with codes in it
+        maxWidth = 2 * math.ceil(self.numCodes / self.numLists)
+        lists: List[torch.Tensor] = []
+        for codes in assignments.argsort().split(counts.tolist()):
+            if codes.shape[0] > maxWidth:
+                members = self.codebook[codes]
+                codes = codes[members[:, members.var(dim=0).argmax()].argsort()]
+            lists.extend(piece for piece in codes.split(maxWidth) if piece.shape[0] > 0)
+
+        self.numLists = len(lists)
+        self.numProbes = min(self.numProbes, self.numLists)
+
+        self.centroids = torch.stack([ self.codebook[codes].mean(dim=0) for codes in lists ])
+        self.centroidNormsSq = self.centroids.pow(2).sum(dim=1)
+
+        self.listCodes = pad_sequence(lists, batch_first=True, padding_value=0)
+        self.listNormsSq = pad_sequence([ self.codebookNormsSq[codes] for codes in lists ], batch_first=True, padding_value=math.inf)
+
+
+    def NearestCentroids(self, x:torch.Tensor, centroids:torch.Tensor, k:int) -> torch.Tensor:
+        d = x.pow(2).sum(dim=-1, keepdim=True) + centroids.pow(2).sum(dim=1) - 2 * x @ centroids.T
+        return d.topk(k, dim=-1, largest=False).indices
+
+
+    # x is tokens x e_dim, returns the (approximate) closest codebook index for each token
+    @torch.no_grad()
+    def Search(self, x:torch.Tensor) -> torch.Tensor:
+        x = x.to(self.codebook.dtype)
+        indices = []
+        for xChunk in x.split(self.GetSearchChunkSize()):
+            indices.append(self.SearchChunk(xChunk))
+        return torch.cat(indices)
+
+    # tokens whose gathered lists fit in the search budget
+    def GetSearchChunkSize(self) -> int:
+        bytesPerToken = self.numProbes * self.listCodes.shape[1] * (self.codebook.shape[1] + 1) * self.codebook.element_size()
+        return max(1, (self.searchBudgetMB * 1024 * 1024) // bytesPerToken)
+
+    def SearchChunk(self, x:torch.Tensor) -> torch.Tensor:
+        probes = self.NearestCentroids(x, self.centroids, self.numProbes) # tokens x probes
+
+        # every code in every probed list, flattened over (probe, slot) per token
+        codes = self.listCodes[probes].flatten(1) # tokens x probes*listWidth
+        normsSq = self.listNormsSq[probes].flatten(1)
+
+        # the tokens own squared norm is the same for all its candidates, so it doesnt change the argmin
+        d = normsSq - 2 * torch.bmm(self.codebook[codes], x.unsqueeze(2)).squeeze(2)
+        return codes.gather(1, d.argmin(dim=-1, keepdim=True)).squeeze(1)
+
+
+    # chunkSize tokens at a time, so the tokens x n_e distance matrix stays inside the vq memory budget. 0 is all at once
+    @torch.no_grad()
+    def ExactSearch(self, x:torch.Tensor, chunkSize:int = 0) -> torch.Tensor:
+        x = x.to(self.codebook.dtype)
+        if chunkSize <= 0:
+            chunkSize = x.shape[0]
+
+        indices = []
+        for xChunk in x.split(chunkSize):
+            d = xChunk.pow(2).sum(dim=-1, keepdim=True) + self.codebookNormsSq - 2 * xChunk @ self.codebook.T
+            indices.append(d.argmin(-1))
+            del d
+        return torch.cat(indices)
+
+
+    # fraction of tokens where the approximate search finds the same code as the exact search.
+    # measured on at most maxTokens randomly picked tokens, its a progress readout, not worth a full exact search
+    @torch.no_grad()
+    def MeasureRecall(self, x:torch.Tensor, chunkSize:int = 0, maxTokens:int = 4096) -> float:
+        x = x.reshape(-1, self.codebook.shape[1])
+        if maxTokens > 0 and x.shape[0] > maxTokens:
+            x = x[torch.randperm(x.shape[0], device=x.device)[:maxTokens]]
+        return (self.Search(x) == self.ExactSearch(x, chunkSize)).float().mean().item()
+
+
+    # recall on fake latents made by jittering random codebook entries, used to report recall at build time
+    @torch.no_grad()
+    def MeasureRecallOnCodebook(self, numSamples:int = 4096, noiseScale:float = 0.5, seed:int = 0, chunkSize:int = 0) -> float:
+        gen = torch.Generator().manual_seed(seed)
+        idx = torch.randint(self.numCodes, [numSamples], generator=gen).to(self.codebook.device)
+        noise = torch.randn([numSamples, self.codebook.shape[1]], generator=gen).to(self.codebook.device, self.codebook.dtype)
+        samples = self.codebook[idx] + noise * self.codebook.std(dim=0) * noiseScale
+        return self.MeasureRecall(samples, chunkSize, 0)
@@ -0,0 +1,37 @@
+import torch
+
+
+####################################################
+# statistics about a loaded vqgan codebook that every job needs
+# computed once when the model is loaded, and shared by all jobs using that Hallucinator instance.
+# the tensors live on the vqgan device and are shared, treat them as read only
+####################################################
+
+class VQGANCodebookStats:
+    def __init__(self, vqganModel, gumbelEnabled:bool):
+        with torch.no_grad():
+            # Gumbel or not?
+            if gumbelEnabled:
+                codebook = vqganModel.quantize.embed.weight
+                self.e_dim:int = 256
+                self.n_toks:int = vqganModel.quantize.n_embed
+            else:
+                codebook = vqganModel.quantize.embedding.weight
+                self.e_dim:int = vqganModel.quantize.e_dim
+                self.n_toks:int = vqganModel.quantize.n_e
+
+            self.codebook: torch.Tensor = codebook.detach() # n_toks x e_dim
+            self.codebookNormsSq: torch.Tensor = self.codebook.pow(2).sum(dim=1)
+
+            # per channel bounds of the codebook, the latent image gets clamped to these every step
+            self.z_min: torch.Tensor = self.codebook.min(dim=0).values[None, :, None, None]
+            self.z_max: torch.Tensor = self.codebook.max(dim=0).values[None, :, None, None]
+
+        # how many pixels each latent token covers, along each axis
+        self.numResolutions:int = vqganModel.decoder.num_resolutions
+        self.vqganNumResolutionsF:int = 2**(self.numResolutions - 1)
+
+
+    def GetTokenGrid(self, imageSizeX:int, imageSizeY:int):
+        toksX, toksY = imageSizeX // self.vqganNumResolutionsF, imageSizeY // self.vqganNumResolutionsF
+        return toksX, toksY
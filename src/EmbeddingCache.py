@@ -0,0 +1,226 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, List
+
+import torch
+from torchvision.transforms import functional as TF
+from PIL import Image
+
+from src import ImageUtils
+
+
+####################################################
+# caches for clip embeddings, so the same prompt text / image doesnt get loaded and run
+# through clip every time its added ( story mode, scripted prompt changes, repeat users )
+####################################################
+
+
+def tensor_size_bytes(tensor:torch.Tensor) -> int:
+    return tensor.numel() * tensor.element_size()
+
+
+# in memory LRU cache of tensors, evicts least recently used entries once over maxBytes
+class LRUTensorCache:
+    def __init__(self, maxBytes:int):
+        self.maxBytes = maxBytes
+        self.currentBytes = 0
+        self.entries: OrderedDict = OrderedDict()
+
+    def Get(self, key) -> torch.Tensor:
+        tensor = self.entries.get(key)
+        if tensor is not None:
+            self.entries.move_to_end(key)
+        return tensor
+
+    def Put(self, key, tensor:torch.Tensor):
+        if key in self.entries:
+            self.currentBytes -= tensor_size_bytes(self.entries.pop(key))
+
+        size = tensor_size_bytes(tensor)
+        if size > self.maxBytes:
+            return
+
+        self.entries[key] = tensor
+        self.currentBytes += size
+
+        while self.currentBytes > self.maxBytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.currentBytes -= tensor_size_bytes(evicted)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+
+# two tier cache of clip text embeddings, keyed by clip model name and the exact prompt text.
+# tier 1 is an in memory LRU, tier 2 is a directory of .pt files, evicted oldest first once over its size limit
+class TextEmbeddingCache:
+    def __init__(self, clipModelName:str, maxMemoryBytes:int = 64 * 1024 * 1024, cacheDir:str = None, maxDiskBytes:int = 512 * 1024 * 1024):
+        self.clipModelName = clipModelName
+        self.memoryCache = LRUTensorCache(maxMemoryBytes)
+
+        self.cacheDir = cacheDir
+        self.maxDiskBytes = maxDiskBytes
+        if self.cacheDir:
+            os.makedirs(self.cacheDir, exist_ok=True)
+
+        self.memoryHits = 0
+        self.diskHits = 0
+        self.misses = 0
+
+
+    def GetKey(self, text:str) -> str:
+        return hashlib.sha256((self.clipModelName + '\n' + text).encode('utf-8')).hexdigest()
+
+
+    def GetDiskPath(self, key:str) -> str:
+        return os.path.join(self.cacheDir, key + '.pt')
+
+
+    # returns the cached embedding on device, or None
+    def Get(self, text:str, device) -> torch.Tensor:
+        key = self.GetKey(text)
+
+        embed = self.memoryCache.Get(key)
+        if embed is not None:
+            self.memoryHits += 1
+            return embed.to(device)
+
+        if self.cacheDir:
+            path = self.GetDiskPath(key)
+            if os.path.exists(path):
+                try:
+                    embed = torch.load(path, map_location=device)
+                except Exception as e:
+                    print("text embedding cache: failed to load " + path + ", " + str(e))
+                    embed = None
+
+                if embed is not None:
+                    os.utime(path) # mark as recently used for disk eviction
+                    self.diskHits += 1
+                    self.memoryCache.Put(key, embed)
+                    return embed
+
+        self.misses += 1
+        return None
+
+
+    def Put(self, text:str, embed:torch.Tensor):
+        key = self.GetKey(text)
+        embed = embed.detach()
+        self.memoryCache.Put(key, embed)
+
+        if self.cacheDir:
+            torch.save(embed.cpu(), self.GetDiskPath(key))
+            self.EvictDisk()
+
+
+    def GetOrCompute(self, text:str, device, computeFunc:Callable[[], torch.Tensor]) -> torch.Tensor:
+        embed = self.Get(text, device)
+        if embed is None:
+            embed = computeFunc().detach()
+            self.Put(text, embed)
+        return embed
+
+
+    # deletes the least recently used files until the cache dir is under its size limit
+    def EvictDisk(self):
+        files = []
+        totalBytes = 0
+        for entry in os.scandir(self.cacheDir):
+            if entry.is_file() and entry.name.endswith('.pt'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                totalBytes += stat.st_size
+
+        if totalBytes <= self.maxDiskBytes:
+            return
+
+        files.sort()
+        for _, size, path in files:
+            if totalBytes <= self.maxDiskBytes:
+                break
+            try:
+                os.remove(path)
+                totalBytes -= size
+            except OSError:
+                pass
+
+
+    def GetStats(self) -> dict:
+        return { 'memoryHits': self.memoryHits, 'diskHits': self.diskHits, 'misses': self.misses,
+                 'memoryEntries': len(self.memoryCache), 'memoryBytes': self.memoryCache.currentBytes }
+
+
+
+# cache for image prompts, keyed by a hash of the image file contents so renamed / re-uploaded copies still hit.
+#   - decoded + resized image tensors, keyed by content hash and size
+#   - clip embeddings of the cutouts of those images, keyed by clip model, content hash, size and every cut method + augment setting
+# images get loaded from worker threads, so everything here is behind a lock
+class ImagePromptCache:
+    def __init__(self, clipModelName:str, maxImageBytes:int = 256 * 1024 * 1024, maxEmbedBytes:int = 16 * 1024 * 1024):
+        self.clipModelName = clipModelName
+        self.imageCache = LRUTensorCache(maxImageBytes)
+        self.embedCache = LRUTensorCache(maxEmbedBytes)
+        self.lock = threading.Lock()
+
+        self.imageHits = 0
+        self.imageMisses = 0
+        self.embedHits = 0
+        self.embedMisses = 0
+
+
+    # reads and resizes an image prompt, returns (content hash, 3 x h x w cpu tensor)
+    def LoadImage(self, path:str, sizeXY:List[int]):
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        contentHash = hashlib.sha256(data).hexdigest()
+        key = (contentHash, tuple(sizeXY))
+
+        with self.lock:
+            tensor = self.imageCache.Get(key)
+            if tensor is not None:
+                self.imageHits += 1
+                return contentHash, tensor
+            self.imageMisses += 1
+
+        pil_image = Image.open(io.BytesIO(data)).convert('RGB')
+        pil_image = ImageUtils.resize_image(pil_image, sizeXY)
+        tensor = TF.to_tensor(pil_image)
+
+        with self.lock:
+            self.imageCache.Put(key, tensor)
+
+        return contentHash, tensor
+
+
+    def GetEmbedKey(self, contentHash:str, sizeXY:List[int], cutMethodKey:str):
+        return (self.clipModelName, contentHash, tuple(sizeXY), cutMethodKey)
+
+
+    def GetOrComputeEmbed(self, contentHash:str, sizeXY:List[int], cutMethodKey:str, device, computeFunc:Callable[[], torch.Tensor]) -> torch.Tensor:
+        key = self.GetEmbedKey(contentHash, sizeXY, cutMethodKey)
+
+        with self.lock:
+            embed = self.embedCache.Get(key)
+            if embed is not None:
+                self.embedHits += 1
+                return embed.to(device)
+            self.embedMisses += 1
+
+        embed = computeFunc().detach()
+
+        with self.lock:
+            self.embedCache.Put(key, embed)
+
+        return embed
+
+
+    def GetStats(self) -> dict:
+        with self.lock:
+            return { 'imageHits': self.imageHits, 'imageMisses': self.imageMisses, 'embedHits': self.embedHits, 'embedMisses': self.embedMisses,
+                     'imageBytes': self.imageCache.currentBytes, 'embedBytes': self.embedCache.currentBytes }
@@ -0,0 +1,252 @@
+import math
+from typing import List
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+
+####################################################
+# augments done in as few passes over the cutouts as possible
+#
+# the kornia stack resamples the whole batch once per geometric augment, and colour jitter is a few passes of its own.
+# here every geometric augment ( Af, Pe, Ro ) is a per cut 3x3 matrix, they get multiplied together and the batch
+# is resampled once with grid_sample. colour jitter is a per cut 3x3 colour matrix + offset, and erasing is a mask
+# multiply, both done after the warp.
+#
+# same names, parameter ranges and probabilities as the kornia augments in MakeCutouts.setupAugmentList, but its not
+# a drop in match for them, the outputs are close but not the same distribution. differences:
+#   - the geometric augments are applied in list order, then colour jitter, then erasing, whatever order the list has
+#   - colour jitter always applies brightness, contrast, saturation, hue in that order, and clamps once at the end.
+#     kornia shuffles the order per call and clamps after each step
+#   - saturation blends towards the rec.601 luma grey instead of scaling the hsv saturation channel. same at 1, and
+#     close for small changes, but strongly coloured pixels move differently than with kornia
+#   - hue is a rotation of the yiq chroma plane instead of a shift of the hsv hue channel. the rotation changes
+#     perceived brightness a little and can push colours out of [0, 1] before the final clamp, the hsv shift does neither
+#   - so the hue and saturation ranges are the same numbers as kornia's, but dont give exactly the same amount of change
+####################################################
+
+# augment codes this handles, everything else still has to go through kornia / torchvision
+FUSED_AUGMENT_NAMES = ['Af', 'Pe', 'Ro', 'Ji', 'Er']
+FUSED_GEOMETRIC_NAMES = ['Af', 'Pe', 'Ro']
+
+# rgb to yiq, hue is a rotation of the iq plane
+RGB_TO_YIQ = [[0.299, 0.587, 0.114], [0.596, -0.274, -0.322], [0.211, -0.523, 0.312]]
+LUMA_WEIGHTS = [0.299, 0.587, 0.114]
+
+
+# solves for the N x 3 x 3 homographies taking the 4 src points to the 4 dst points ( N x 4 x 2 each )
+def homography_from_points(src:torch.Tensor, dst:torch.Tensor) -> torch.Tensor:
+    x, y = src[..., 0], src[..., 1]
+    u, v = dst[..., 0], dst[..., 1]
+    zeros = torch.zeros_like(x)
+    ones = torch.ones_like(x)
+
+    rowsU = torch.stack([x, y, ones, zeros, zeros, zeros, -x * u, -y * u], dim=-1)
+    rowsV = torch.stack([zeros, zeros, zeros, x, y, ones, -x * v, -y * v], dim=-1)
+    system = torch.cat([rowsU, rowsV], dim=1)
+    target = torch.cat([u, v], dim=1)
+
+    h = torch.linalg.solve(system, target)
+    return torch.cat([h, ones[:, :1]], dim=1).view(-1, 3, 3)
+
+
+def translation_matrices(tx:torch.Tensor, ty:torch.Tensor) -> torch.Tensor:
+    mat = torch.eye(3, device=tx.device, dtype=tx.dtype).repeat(tx.shape[0], 1, 1)
+    mat[:, 0, 2] = tx
+    mat[:, 1, 2] = ty
+    return mat
+
+
+def rotation_matrices(angle:torch.Tensor) -> torch.Tensor:
+    mat = torch.eye(3, device=angle.device, dtype=angle.dtype).repeat(angle.shape[0], 1, 1)
+    cos = torch.cos(angle)
+    sin = torch.sin(angle)
+    mat[:, 0, 0] = cos
+    mat[:, 0, 1] = -sin
+    mat[:, 1, 0] = sin
+    mat[:, 1, 1] = cos
+    return mat
+
+
+
+class FusedAugments(nn.Module):
+    def __init__(self, augmentNames:List[str]):
+        super().__init__()
+        self.augmentNames = [ name for name in augmentNames if name in FUSED_AUGMENT_NAMES ]
+
+        # same settings as the kornia versions in setupAugmentList
+        self.affine_p = 0.7
+        self.affine_degrees = 15.
+        self.affine_translate = 0.1
+        self.affine_shear = 5.
+
+        self.perspective_p = 0.7
+        self.perspective_distortion = 0.7
+
+        self.rotation_p = 0.7
+        self.rotation_degrees = 15.
+
+        self.jitter_p = 0.7
+        self.jitter_brightness = 0.1
+        self.jitter_contrast = 0.1
+        self.jitter_saturation = 0.1
+        self.jitter_hue = 0.1
+
+        self.erase_p = 0.7
+        self.erase_scale = (.1, .4)
+        self.erase_ratio = (.3, 1/.3)
+
+
+    def extra_repr(self) -> str:
+        return 'augments=' + str(self.augmentNames)
+
+
+    # picks the sampled matrix for cuts the augment applies to, identity for the rest
+    def ApplyWithProbability(self, mats:torch.Tensor, p:float) -> torch.Tensor:
+        applied = torch.rand(mats.shape[0], device=mats.device) < p
+        eye = torch.eye(mats.shape[-1], device=mats.device, dtype=mats.dtype)
+        return torch.where(applied[:, None, None], mats, eye)
+
+
+    def Uniform(self, n:int, low:float, high:float, device) -> torch.Tensor:
+        return torch.empty(n, device=device).uniform_(low, high)
+
+
+    ######
+    # geometric augments, all are N x 3 x 3 matrices in pixel coords, taking input pixels to output pixels
+    ######
+    def AffineMatrices(self, n:int, h:int, w:int, device) -> torch.Tensor:
+        angle = self.Uniform(n, -self.affine_degrees, self.affine_degrees, device) * math.pi / 180.
+        tx = self.Uniform(n, -self.affine_translate, self.affine_translate, device) * w
+        ty = self.Uniform(n, -self.affine_translate, self.affine_translate, device) * h
+        shear = self.Uniform(n, -self.affine_shear, self.affine_shear, device) * math.pi / 180.
+
+        shearMat = torch.eye(3, device=device).repeat(n, 1, 1)
+        shearMat[:, 0, 1] = torch.tan(shear)
+
+        cx = torch.full((n,), (w - 1) / 2, device=device)
+        cy = torch.full((n,), (h - 1) / 2, device=device)
+
+        mats = translation_matrices(cx + tx, cy + ty) @ rotation_matrices(angle) @ shearMat @ translation_matrices(-cx, -cy)
+        return self.ApplyWithProbability(mats, self.affine_p)
+
+
+    def RotationMatrices(self, n:int, h:int, w:int, device) -> torch.Tensor:
+        angle = self.Uniform(n, -self.rotation_degrees, self.rotation_degrees, device) * math.pi / 180.
+
+        cx = torch.full((n,), (w - 1) / 2, device=device)
+        cy = torch.full((n,), (h - 1) / 2, device=device)
+
+        mats = translation_matrices(cx, cy) @ rotation_matrices(angle) @ translation_matrices(-cx, -cy)
+        return self.ApplyWithProbability(mats, self.rotation_p)
+
+
+    # each corner gets pulled in by up to distortion * half the image size, like kornia
+    def PerspectiveMatrices(self, n:int, h:int, w:int, device) -> torch.Tensor:
+        corners = torch.tensor([[0., 0.], [w - 1., 0.], [w - 1., h - 1.], [0., h - 1.]], device=device).expand(n, 4, 2)
+        inward = torch.tensor([[1., 1.], [-1., 1.], [-1., -1.], [1., -1.]], device=device)
+        maxShift = torch.tensor([self.perspective_distortion * w / 2, self.perspective_distortion * h / 2], device=device)
+
+        moved = corners + torch.rand((n, 4, 2), device=device) * maxShift * inward
+
+        mats = homography_from_points(corners, moved)
+        return self.ApplyWithProbability(mats, self.perspective_p)
+
+
+    # one resample of the whole batch. grid_sample wants, for every output pixel, where to read from the input
+    def Warp(self, input:torch.Tensor, mats:torch.Tensor) -> torch.Tensor:
+        n, c, h, w = input.shape
+
+        ys, xs = torch.meshgrid(torch.arange(h, device=input.device, dtype=mats.dtype),
+                                torch.arange(w, device=input.device, dtype=mats.dtype), indexing='ij')
+        outCoords = torch.stack([xs.flatten(), ys.flatten(), torch.ones(h * w, device=input.device, dtype=mats.dtype)])
+
+        srcCoords = torch.linalg.inv(mats) @ outCoords
+        srcXY = srcCoords[:, :2] / srcCoords[:, 2:3]
+
+        gridX = srcXY[:, 0] / max(w - 1, 1) * 2 - 1
+        gridY = srcXY[:, 1] / max(h - 1, 1) * 2 - 1
+        grid = torch.stack([gridX, gridY], dim=-1).view(n, h, w, 2)
+
+        return F.grid_sample(input, grid.to(input.dtype), mode='bilinear', padding_mode='zeros', align_corners=True)
+
+
+    ######
+    # colour + erase
+    ######
+
+    # brightness, contrast, saturation and hue are all linear in rgb, so they fold into one colour matrix + offset per cut
+    def ColorJitterMatrices(self, n:int, device):
+        brightness = self.Uniform(n, -self.jitter_brightness, self.jitter_brightness, device)
+        contrast = self.Uniform(n, 1 - self.jitter_contrast, 1 + self.jitter_contrast, device)
+        saturation = self.Uniform(n, 1 - self.jitter_saturation, 1 + self.jitter_saturation, device)
+        hue = self.Uniform(n, -self.jitter_hue, self.jitter_hue, device) * 2 * math.pi
+
+        eye = torch.eye(3, device=device)
+        luma = torch.tensor(LUMA_WEIGHTS, device=device)
+        satMat = saturation[:, None, None] * eye + (1 - saturation)[:, None, None] * luma[None, None, :].expand(n, 3, 3)
+
+        rgbToYiq = torch.tensor(RGB_TO_YIQ, device=device)
+        hueRot = torch.eye(3, device=device).repeat(n, 1, 1)
+        hueRot[:, 1, 1] = torch.cos(hue)
+        hueRot[:, 1, 2] = -torch.sin(hue)
+        hueRot[:, 2, 1] = torch.sin(hue)
+        hueRot[:, 2, 2] = torch.cos(hue)
+        hueMat = torch.linalg.inv(rgbToYiq) @ hueRot @ rgbToYiq
+
+        mats = contrast[:, None, None] * (hueMat @ satMat)
+        offsets = mats @ brightness[:, None].expand(n, 3)[:, :, None]
+
+        applied = torch.rand(n, device=device) < self.jitter_p
+        mats = torch.where(applied[:, None, None], mats, eye)
+        offsets = torch.where(applied[:, None, None], offsets, torch.zeros_like(offsets))
+        return mats, offsets[:, :, 0]
+
+
+    # same_on_batch like the kornia setup, one rectangle for the whole batch. returns a 1 x 1 x h x w keep mask or None
+    def EraseMask(self, h:int, w:int, device) -> torch.Tensor:
+        if torch.rand([]) >= self.erase_p:
+            return None
+
+        area = h * w * float(torch.empty([]).uniform_(*self.erase_scale))
+        ratio = math.exp(float(torch.empty([]).uniform_(math.log(self.erase_ratio[0]), math.log(self.erase_ratio[1]))))
+
+        eh = min(h, max(1, int(round(math.sqrt(area * ratio)))))
+        ew = min(w, max(1, int(round(math.sqrt(area / ratio)))))
+        y0 = int(torch.randint(0, h - eh + 1, ()))
+        x0 = int(torch.randint(0, w - ew + 1, ()))
+
+        mask = torch.ones((1, 1, h, w), device=device)
+        mask[:, :, y0:y0 + eh, x0:x0 + ew] = 0
+        return mask
+
+
+    def forward(self, input:torch.Tensor) -> torch.Tensor:
+        n, c, h, w = input.shape
+        device = input.device
+        out = input
+
+        geometric = [ name for name in self.augmentNames if name in FUSED_GEOMETRIC_NAMES ]
+        if geometric:
+            mats = torch.eye(3, device=device).repeat(n, 1, 1)
+            for name in geometric:
+                if name == 'Af':
+                    mats = self.AffineMatrices(n, h, w, device) @ mats
+                elif name == 'Pe':
+                    mats = self.PerspectiveMatrices(n, h, w, device) @ mats
+                elif name == 'Ro':
+                    mats = self.RotationMatrices(n, h, w, device) @ mats
+            out = self.Warp(out, mats)
+
+        if 'Ji' in self.augmentNames and c == 3:
+            colorMats, colorOffsets = self.ColorJitterMatrices(n, device)
+            out = torch.einsum('nij,njhw->nihw', colorMats.to(out.dtype), out) + colorOffsets.to(out.dtype)[:, :, None, None]
+            out = out.clamp(0, 1)
+
+        if 'Er' in self.augmentNames:
+            keepMask = self.EraseMask(h, w, device)
+            if keepMask is not None:
+                out = out * keepMask.to(out.dtype)
+
+        return out
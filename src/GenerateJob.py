@@ -1,6 +1,7 @@
 import sys
 import os
 import random
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 import numpy as np
 from torch.functional import Tensor
@@ -9,6 +10,8 @@ from src import MakeCutouts
 from src import ImageUtils
 from src import GenerationCommands
 from src import GenerationCommand
+from src import LossMetrics
+from src import MaskStore
 
 #import Hallucinator #circular reference in imports...
 
@@ -72,7 +75,7 @@ replace_grad = ReplaceGrad.apply
 
 
 class Prompt(nn.Module):
-    def __init__(self, embed, weight=1., stop=float('-inf'), textPrompt:str = None, promptMask:torch.Tensor = None, maskBlindfold:float = None):
+    def __init__(self, embed, weight=1., stop=float('-inf'), textPrompt:str = None, promptMask:torch.Tensor = None, maskBlindfold:float = None, maskHandle:MaskStore.MaskHandle = None):
         super().__init__()
         self.register_buffer('embed', embed)
         self.register_buffer('weight', torch.as_tensor(weight))
@@ -83,16 +86,62 @@ class Prompt(nn.Module):
             self.TextPrompt = 'not a text prompt'
 
         self.promptMask = promptMask   # mask associated with this prompt
+        self.maskHandle = maskHandle   # the masks handle in the hallucinators mask store, released when the prompt is removed
         self.maskBlindfold = maskBlindfold #blindfold... TODO: dewscribe better when if igure out what it does exactly
     
 
+    # rowWeights weights each input row instead of taking the mean over them, see GenerationJob.GetCutoutResults
     @autocast(enabled=MakeCutouts.use_mixed_precision)
-    def forward(self, input):
+    def forward(self, input, rowWeights:torch.Tensor = None):
         input_normed = F.normalize(input.unsqueeze(1), dim=2)
         embed_normed = F.normalize(self.embed.unsqueeze(0), dim=2)
         dists = input_normed.sub(embed_normed).norm(dim=2).div(2).arcsin().pow(2).mul(2)
         dists = dists * self.weight.sign()
-        return self.weight.abs() * replace_grad(dists, torch.maximum(dists, self.stop)).mean()
+        dists = replace_grad(dists, torch.maximum(dists, self.stop))
+        if rowWeights is None:
+            return self.weight.abs() * dists.mean()
+        return self.weight.abs() * (dists * rowWeights[:, None]).sum() / dists.shape[1]
+
+
+####################################################
+# the spatial prompt bits of the prompt list, worked out once per change of the prompt list instead of every step
+#   - maskStack: every masked prompts mask stacked on the masks device, masked prompts X color X h X w
+#   - maskIndexForPrompt: per prompt, its row in maskStack, or -1 if it has no mask
+#   - blindfoldProbs: per masked prompt, the chance its cutouts get the blurred background instead of the detached one
+# the job throws it away whenever prompts get added or removed, see GenerationJob.OnPromptsChanged
+####################################################
+class PromptRegistry:
+    def __init__(self, prompts:List[Prompt]):
+        self.numPrompts = len(prompts)
+        self.maskIndexForPrompt: List[int] = []
+        self.maskedPromptIndices: List[int] = []
+
+        for promptIdx, prompt in enumerate(prompts):
+            if prompt.promptMask is None:
+                self.maskIndexForPrompt.append(-1)
+            else:
+                self.maskIndexForPrompt.append(len(self.maskedPromptIndices))
+                self.maskedPromptIndices.append(promptIdx)
+
+        self.maskStack: torch.Tensor = None
+        self.blindfoldProbs: torch.Tensor = None
+        if self.maskedPromptIndices:
+            masks = [ prompts[idx].promptMask for idx in self.maskedPromptIndices ]
+            self.maskStack = torch.stack(masks).detach()
+            self.blindfoldProbs = torch.tensor([ self.BlindfoldProb(prompts[idx].maskBlindfold) for idx in self.maskedPromptIndices ], device=self.maskStack.device)
+
+    # a float blindfold is a chance per step, anything else truthy is always on
+    @staticmethod
+    def BlindfoldProb(maskBlindfold) -> float:
+        if not maskBlindfold:
+            return 0.0
+        if not isinstance(maskBlindfold, float):
+            return 1.0
+        return maskBlindfold
+
+    def NumMasked(self) -> int:
+        return len(self.maskedPromptIndices)
+
 
 
 ## make this something we can init in code or whatever, for nwo this so i can clear argparse shit from these classes
@@ -108,6 +157,7 @@ class SpatialPromptConfig:
         self.append_to_prompts = ''
         self.prompt_key_image = './examples/4-color-mask.png'
         self.dilate_masks = 10
+        self.pair_filter = False # sets GenerationJob.spatial_pair_filter
 
 
 
@@ -153,6 +203,7 @@ class GenerationJob:
         self.vqganDevice = hallucinatorInst.vqganDevice
         self.vqganModel = hallucinatorInst.vqganModel
         self.vqganGumbelEnabled = hallucinatorInst.vqganGumbelEnabled
+        self.vqganCodebookStats = hallucinatorInst.vqganCodebookStats # shared between jobs, dont modify
 
 
 
@@ -164,9 +215,11 @@ class GenerationJob:
 
         # cuts
         self.CurrentCutoutMethod = None
+        self.CurrentCutoutMethodKey: str = None # every setting that went into CurrentCutoutMethod, used to key cached image prompt embeddings
 
         # prompts
         self.embededPrompts: List[Prompt] = []
+        self.promptRegistry: PromptRegistry = None # rebuilt on demand after the prompt list changes
 
         #### these need better names, wtf are they exactly?
         self.z_min = None
@@ -175,10 +228,13 @@ class GenerationJob:
         self.ImageSizeY:int = None
         self.original_quantizedImage:torch.Tensor = None
 
-        #MADGRAD related, needs better naming
-        self.loss_idx: List[float] = []
+        # loss driven lr scheduling, the scheduler is stepped with the rolling mean of the loss
+        self.lossStats = LossMetrics.RollingStats(100)
         self.scheduler: torch.optim.lr_scheduler.ReduceLROnPlateau = None
 
+        # per step losses, read back from the gpu in bulk. also tracks the best image for save_best
+        self.lossMetrics = LossMetrics.DeferredLossMetrics(hallucinatorInst.metrics_flush_freq, save_best)
+
         #mixed precision scaler
         self.gradScaler = GradScaler()
         
@@ -192,8 +248,12 @@ class GenerationJob:
 
         # masking/spatial prompt stuff
         self.use_spatial_prompts = False
+        self.spatial_pair_filter = False # only encode the (cutout, masked prompt) pairs that overlap, instead of every cutout of a prompt that overlaps anywhere
         self.blur_conv = None   # this is set from the job 
         self.noise_fac = 0.1     # used by the blur function
+        self.spatialNumCuts = 0 # cutouts in the last GetSpatialPromptCutouts call
+        self.spatialFirstPairRow = 0 # first row of the masked pairs in its batch, the plain cutouts come before them
+        self.spatialPairMaskIdx: torch.Tensor = None # per masked pair row, the maskStack row of its prompt
 
 
         #image modifications
@@ -242,6 +302,9 @@ class GenerationJob:
                 self.SetCutMethod()
                 print("created default cutmethod: " + str(type(self.CurrentCutoutMethod)))
 
+            # image prompts get cut up with the cut method, so they wait till the commands firing at 0 have set it up
+            self.EmbedImagePrompts()
+
             # create the default optimizer if none specified
             if self.optimizer == None:
                 self.SetOptimizer()
@@ -253,6 +316,22 @@ class GenerationJob:
             if modContainer.ShouldApply( GenerationCommand.GenerationModStage.FinishedGeneration, self.currentIteration ):
                 modContainer.OnExecute( self.currentIteration )
 
+        self.ReleaseResources()
+
+    # flushes this jobs queued images and hands back what it holds in the shared stores. called when the job finishes,
+    # and by whoever runs the job when it fails or gets cancelled, since those never reach OnFinishGeneration. safe to call more than once
+    def ReleaseResources(self):
+        # make sure every image this job queued is on disk before anyone goes looking for it
+        if self.hallucinatorInst.imageWriter is not None:
+            self.hallucinatorInst.imageWriter.Flush()
+
+        # hand back the masks held by the prompts and commands, so the mask store can drop them
+        for prompt in self.embededPrompts:
+            self.hallucinatorInst.maskStore.Release(prompt.maskHandle)
+
+        for modContainer in self.GenerationCommandList:
+            modContainer.mod.Release()
+
     ##############
     ##  image Getters and converters
     ##############
@@ -269,20 +348,26 @@ class GenerationJob:
     ######
     # save file functions
     #####
+    # saves in the background if the hallucinator has an image writer, the tensor is snapshotted so its safe to keep training
     def SaveImageTensor( self, imgTensor:torch.Tensor, filenamePrefix:str = None, info:PngImagePlugin.PngInfo = None ):
-        self.SaveImage( self.ConvertToPIL(imgTensor), filenamePrefix, info)
+        if self.hallucinatorInst.imageWriter is None:
+            self.SaveImage( self.ConvertToPIL(imgTensor), filenamePrefix, info)
+            return
+
+        self.hallucinatorInst.imageWriter.SubmitTensor( imgTensor, build_filename_path( self.outputDir, self.GetOutputName(filenamePrefix) ), info)
 
     def SaveCurrentImage( self, filenamePrefix:str = None, info:PngImagePlugin.PngInfo = None ):
         pilImage = self.GetCurrentImageAsPIL()
         self.SaveImage( pilImage, filenamePrefix, info)
 
-    def SaveImage( self, pilImage, filenamePrefix:str = None, info:PngImagePlugin.PngInfo = None ):
+    def GetOutputName( self, filenamePrefix:str = None ) -> str:
         if filenamePrefix != None:
-            outName = filenamePrefix + self.outputFilename
-        else:
-            outName = self.outputFilename
+            return filenamePrefix + self.outputFilename
+        return self.outputFilename
+
+    def SaveImage( self, pilImage, filenamePrefix:str = None, info:PngImagePlugin.PngInfo = None ):
+        outName = self.GetOutputName(filenamePrefix)
 
-        
         if info == None:
             pilImage.save( build_filename_path( self.outputDir, outName ))
         else:
@@ -300,22 +385,62 @@ class GenerationJob:
         vals = vals + ['', '1', '-inf'][len(vals):]
         return vals[0], float(vals[1]), float(vals[2])
 
+    # clip text embedding, from the hallucinators cache if weve seen this text before
+    def EncodeText(self, txt:str) -> torch.Tensor:
+        return self.hallucinatorInst.textEmbeddingCache.GetOrCompute(txt, self.clipDevice,
+                    lambda: self.clipPerceptor.encode_text(clip.tokenize(txt).to(self.clipDevice)).float() )
+
     def EmbedTextPrompt(self, prompt:str):
         txt, weight, stop = self.split_prompt(prompt)
-        embed = self.clipPerceptor.encode_text(clip.tokenize(txt).to(self.clipDevice)).float()
-        self.embededPrompts.append(Prompt(embed, weight, stop, txt).to(self.clipDevice))
+        embed = self.EncodeText(txt)
+        self.AddPrompt(Prompt(embed, weight, stop, txt).to(self.clipDevice))
 
 
-    def EmbedMaskedPrompt(self, prompt:str, promptMask:torch.Tensor = None, blindfold:float = 0.1):
+    # the prompt takes ownership of maskHandle
+    def EmbedMaskedPrompt(self, prompt:str, maskHandle:MaskStore.MaskHandle, blindfold:float = 0.1):
         txt, weight, stop = self.split_prompt(prompt)
-        embed = self.clipPerceptor.encode_text(clip.tokenize(txt).to(self.clipDevice)).float()
-        self.embededPrompts.append(Prompt(embed, weight, stop, txt, promptMask, blindfold).to(self.clipDevice))
+        embed = self.EncodeText(txt)
+        promptMask = self.hallucinatorInst.maskStore.Get(maskHandle)
+        self.AddPrompt(Prompt(embed, weight, stop, txt, promptMask, blindfold, maskHandle).to(self.clipDevice))
+
+    ##########################
+    ## prompt list changes, everything that adds or removes prompts goes through these so the registry stays current
+    ##########################
+
+    # index = None adds to the end
+    def AddPrompt(self, prompt:Prompt, index:int = None):
+        if index is None:
+            self.embededPrompts.append(prompt)
+        else:
+            self.embededPrompts.insert(index, prompt)
+        self.OnPromptsChanged()
+
+    def ClearPrompts(self):
+        for prompt in self.embededPrompts:
+            self.hallucinatorInst.maskStore.Release(prompt.maskHandle)
+        self.embededPrompts = []
+        self.OnPromptsChanged()
+
+    def RemovePromptAt(self, index:int) -> Prompt:
+        prompt = self.embededPrompts.pop(index)
+        self.hallucinatorInst.maskStore.Release(prompt.maskHandle)
+        self.OnPromptsChanged()
+        return prompt
+
+    def OnPromptsChanged(self):
+        self.promptRegistry = None
+
+    def GetPromptRegistry(self) -> PromptRegistry:
+        if self.promptRegistry is None:
+            self.promptRegistry = PromptRegistry(self.embededPrompts)
+        return self.promptRegistry
+
 
     ###################
     ##  some getters and setters...
     ###################
 
-    def SetCutMethod(self, cutMethod:str = 'latest', cutNum:int = 32, cutSize:List[int] = [0, 0], cutPow:float = 1.0, augmentNameList:list = [], use_kornia:bool = True ):
+    def SetCutMethod(self, cutMethod:str = 'latest', cutNum:int = 32, cutSize:List[int] = [0, 0], cutPow:float = 1.0, augmentNameList:list = [], use_kornia:bool = True, cutSizeBuckets:int = 0, use_fused:bool = False ):
         if not augmentNameList:
             print("adding default augments, since none were provided")
             augmentNameList = [['Af', 'Pe', 'Ji', 'Er']]
@@ -338,7 +463,11 @@ class GenerationJob:
             print("GenerationJob: cant use augments in mixed precision mode yet...")
             augmentNameList = [] 
 
-        self.CurrentCutoutMethod = MakeCutouts.GetMakeCutouts( cutMethod, self.clipPerceptorInputResolution, cutNum, cutSize, cutPow, augmentNameList, use_kornia )
+        self.CurrentCutoutMethod = MakeCutouts.GetMakeCutouts( cutMethod, self.clipPerceptorInputResolution, cutNum, cutSize, cutPow, augmentNameList, use_kornia, cutSizeBuckets, use_fused )
+
+        # after the overrides above and GetMakeCutouts filling in the cut size, so its what the cut method was actually built with
+        self.CurrentCutoutMethodKey = str(( cutMethod, self.clipPerceptorInputResolution, cutNum, list(cutSize), cutPow, augmentNameList, use_kornia, 
+                                            cutSizeBuckets, use_fused, MakeCutouts.deterministic, MakeCutouts.use_mixed_precision ))
 
 
     ########################
@@ -378,8 +507,8 @@ class GenerationJob:
     def SetOptimizer(self, opt_name:str = "Adam", opt_lr:float = 0.1) -> None:
         self.optimizer = self.get_optimizer(self.quantizedImage, opt_name, opt_lr)
 
-        if self.optimizer == "MADGRAD":
-            self.scheduler = optim.lr_scheduler.ReduceLROnPlateau(self.optimizer, 'min', factor=0.999, patience=0)  
+        # every optimizer gets the plateau scheduler, it used to only be meant for MADGRAD but the check never matched
+        self.scheduler = optim.lr_scheduler.ReduceLROnPlateau(self.optimizer, 'min', factor=0.999, patience=0)  
 
         self.optimizerName = opt_name
         self.optimizerLearningRate = opt_lr 
@@ -401,20 +530,11 @@ class GenerationJob:
         self.InitPrompts()
         self.InitStartingImage()
         
-        # CLIP tokenize/encode
-        for prompt in self.image_prompts:
-            path, weight, stop = self.split_prompt(prompt)
-            img = Image.open(path)
-            pil_image = img.convert('RGB')
-            img = ImageUtils.resize_image(pil_image, (self.ImageSizeX, self.ImageSizeY))
-            batch = self.CurrentCutoutMethod(TF.to_tensor(img).unsqueeze(0).to(self.clipDevice))
-            embed = self.clipPerceptor.encode_image(self.normalize(batch)).float()
-            self.embededPrompts.append(Prompt(embed, weight, stop).to(self.clipDevice))
-
+        # CLIP tokenize/encode. image prompts wait for the cut method, see OnPreTrain
         for seed, weight in zip(self.noise_prompt_seeds, self.noise_prompt_weights):
             gen = torch.Generator().manual_seed(seed)
             embed = torch.empty([1, self.clipPerceptor.visual.output_dim]).normal_(generator=gen)
-            self.embededPrompts.append(Prompt(embed, weight).to(self.clipDevice))
+            self.AddPrompt(Prompt(embed, weight).to(self.clipDevice))
 
         if self.image_prompts:
             print('Using image prompts:', self.image_prompts)
@@ -428,6 +548,27 @@ class GenerationJob:
     ### Helper type methods
     #####################
 
+    # image prompts go in front of the other prompts, where they were when they got embedded in Initialize
+    def EmbedImagePrompts(self):
+        if not self.image_prompts:
+            return
+
+        imageCache = self.hallucinatorInst.imagePromptCache
+        sizeXY = [self.ImageSizeX, self.ImageSizeY]
+        splitPrompts = [ self.split_prompt(prompt) for prompt in self.image_prompts ]
+
+        # decoding and resizing is mostly PIL, which releases the GIL, so load all the images at once
+        with ThreadPoolExecutor(max_workers=min(len(splitPrompts), 8)) as pool:
+            loadedImages = list(pool.map(lambda split: imageCache.LoadImage(split[0], sizeXY), splitPrompts))
+
+        for promptIndex, ((path, weight, stop), (contentHash, imgTensor)) in enumerate(zip(splitPrompts, loadedImages)):
+            def encodeImagePrompt():
+                batch, _ = self.CurrentCutoutMethod(imgTensor.unsqueeze(0).to(self.clipDevice))
+                return self.clipPerceptor.encode_image(self.normalize(batch)).float()
+
+            embed = imageCache.GetOrComputeEmbed(contentHash, sizeXY, self.CurrentCutoutMethodKey, self.clipDevice, encodeImagePrompt)
+            self.AddPrompt(Prompt(embed, weight, stop).to(self.clipDevice), promptIndex)
+
     def InitPrompts(self):
            
         # Split target images using the pipe character (weights are split later)
@@ -437,25 +578,18 @@ class GenerationJob:
 
 
     def InitStartingImage(self):
-        vqganNumResolutionsF = 2**(self.vqganModel.decoder.num_resolutions - 1)
-        toksX, toksY = self.ImageSizeXY[0] // vqganNumResolutionsF, self.ImageSizeXY[1] // vqganNumResolutionsF
+        stats = self.vqganCodebookStats
+        vqganNumResolutionsF = stats.vqganNumResolutionsF
+        toksX, toksY = stats.GetTokenGrid(self.ImageSizeXY[0], self.ImageSizeXY[1])
         self.ImageSizeX, self.ImageSizeY = toksX * vqganNumResolutionsF, toksY * vqganNumResolutionsF
 
-        print("vqgan input resolutions: " + str(self.vqganModel.decoder.num_resolutions))
+        print("vqgan input resolutions: " + str(stats.numResolutions))
         print("cliperceptor input_res (aka cut size): " + str(self.clipPerceptorInputResolution) + " and whatever f is supposed to be: " + str(vqganNumResolutionsF))
         print("Toks X,Y: " + str(toksX) + ", " + str(toksY) + "      SizeX,Y: " + str(self.ImageSizeX) + ", " + str(self.ImageSizeY))
         
-        # Gumbel or not?
-        if self.vqganGumbelEnabled:
-            e_dim = 256
-            n_toks = self.vqganModel.quantize.n_embed
-            self.z_min = self.vqganModel.quantize.embed.weight.min(dim=0).values[None, :, None, None]
-            self.z_max = self.vqganModel.quantize.embed.weight.max(dim=0).values[None, :, None, None]
-        else:
-            e_dim = self.vqganModel.quantize.e_dim
-            n_toks = self.vqganModel.quantize.n_e
-            self.z_min = self.vqganModel.quantize.embedding.weight.min(dim=0).values[None, :, None, None]
-            self.z_max = self.vqganModel.quantize.embedding.weight.max(dim=0).values[None, :, None, None]
+        # these are shared with every other job on this hallucinator, only ever read from them
+        self.z_min = stats.z_min
+        self.z_max = stats.z_max
 
         print('initializing image of size: ' + str(self.ImageSizeXY))
 
@@ -482,14 +616,10 @@ class GenerationJob:
             pil_tensor = TF.to_tensor(pil_image)
             self.quantizedImage, *_ = self.vqganModel.encode(pil_tensor.to(self.vqganDevice).unsqueeze(0) * 2 - 1)
         else:
-            one_hot = F.one_hot(torch.randint(n_toks, [toksY * toksX], device=self.vqganDevice), n_toks).float()
-            # z = one_hot @ vqganModel.quantize.embedding.weight
-            if self.vqganGumbelEnabled:
-                self.quantizedImage = one_hot @ self.vqganModel.quantize.embed.weight
-            else:
-                self.quantizedImage = one_hot @ self.vqganModel.quantize.embedding.weight
+            # random codebook entries for every token, gathered directly instead of one_hot @ codebook
+            self.quantizedImage = F.embedding(torch.randint(stats.n_toks, [toksY * toksX], device=self.vqganDevice), stats.codebook)
 
-            self.quantizedImage = self.quantizedImage.view([-1, toksY, toksX, e_dim]).permute(0, 3, 1, 2) 
+            self.quantizedImage = self.quantizedImage.view([-1, toksY, toksX, stats.e_dim]).permute(0, 3, 1, 2) 
             #z = torch.rand_like(z)*2						# NR: check
 
 
@@ -503,62 +633,65 @@ class GenerationJob:
     ## cutout stuff during training
     ########################
 
+    # builds one batch for every prompt:
+    #   - prompts without a mask all share the plain cutouts, which go in the batch once
+    #   - a masked prompt gets every cutout composed with its mask, if any cutout overlaps its mask enough
+    #   - with spatial_pair_filter, a masked prompt only gets the cutouts that overlap its mask enough
+    # the pairs are picked with tensor ops on the device, the only wait on it is for the size of the nonzero.
+    # GetCutoutResults uses spatialFirstPairRow / spatialPairMaskIdx to hand each prompt its part of the encoded batch
     def GetSpatialPromptCutouts(self, cutouts, cutout_coords):
-        cutouts_detached = cutouts.detach() #used to prevent gradient for unmask parts
-        if self.blur_conv is not None:
-            #Get the "blindfolded" image by blurring then addimg more noise
-            facs = cutouts.new_empty([cutouts.size(0), 1, 1, 1]).uniform_(0, self.noise_fac)
-            cutouts_blurred = self.blur_conv(cutouts_detached)+ facs * torch.randn_like(cutouts_detached)
+        registry = self.GetPromptRegistry()
+        numCuts = cutouts.shape[0]
 
-        cutout_prompt_masks = []
-        prompts_gradient_masked_cutouts = []
+        self.spatialNumCuts = numCuts
+        self.spatialFirstPairRow = numCuts
+        self.spatialPairMaskIdx = torch.empty(0, dtype=torch.long, device=cutouts.device)
 
-        for (x1,x2,y1,y2) in cutout_coords:
+        if registry.NumMasked() == 0:
+            return cutouts
 
-            promptMasks = []
-            for prompt in self.embededPrompts:
-                if prompt.promptMask == None:
-                    continue
-
-                promptMask = prompt.promptMask # color x h x w
-                promptMasks.append(promptMask)
-
-            promptMasks = torch.stack(promptMasks)
-
-            keep_mask = promptMasks[:,:,y1:y2,x1:x2]
-            keep_mask = ImageUtils.resample(keep_mask, (self.cut_size[0], self.cut_size[1])) 
-                                    
-            cutout_prompt_masks.append(keep_mask) # color x h x w
+        cutouts_detached = cutouts.detach() #used to prevent gradient for unmask parts
 
+        # crop + resize the cached mask stack to every cut in one go
+        cutout_prompt_masks = MakeCutouts.crop_masks_batched(registry.maskStack, cutout_coords, cutouts.shape[-2:]) #-> masked prompts X cutouts X color X H X W
 
-        cutout_prompt_masks = torch.stack(cutout_prompt_masks, dim=1) #-> prompts X cutouts X color X H X W
+        #only apply a prompt if a cutout has a (big enough) part of its mask
+        minOverlap = cutouts.shape[-1]*2 #TODO: change this to a better test of overlap
+        passes = cutout_prompt_masks.sum(dim=(3,4)).amax(dim=2) > minOverlap #-> masked prompts X cutouts
 
-        idx:int = -1
-        for prompt in self.embededPrompts: 
+        # by default a prompt keeps all its cutouts if any of them overlap, like before. the pair filter drops the rest
+        if not self.spatial_pair_filter:
+            passes = passes.any(dim=1, keepdim=True).expand_as(passes)
 
-            if prompt.promptMask == None:
-                prompts_gradient_masked_cutouts.append(cutouts)
-                continue
+        # if nothing overlaps and every prompt has a mask the batch is empty, and the step has no prompt loss
+        pairIdx = passes.nonzero()
+        pairMaskIdx, pairCutIdx = pairIdx[:, 0], pairIdx[:, 1]
+        self.spatialPairMaskIdx = pairMaskIdx
 
-            idx += 1
+        batchParts = []
+        if registry.NumMasked() < registry.numPrompts:
+            batchParts.append(cutouts)
+        else:
+            self.spatialFirstPairRow = 0
 
-            keep_mask = cutout_prompt_masks[idx] #-> cutouts X color X H X W       
-            #only apply this prompt if one image has a (big enough) part of mask
-            if keep_mask.sum(dim=3).sum(dim=2).max()> self.cut_size[0]*2: #TODO: change this to a better test of overlap
-            
-                block_mask = 1-keep_mask
+        keep_mask = cutout_prompt_masks[pairMaskIdx, pairCutIdx] #-> pairs X color X H X W
+        pairCutouts = cutouts.index_select(0, pairCutIdx)
 
-                #compose cutout of gradient and non-gradient parts
-                if prompt.maskBlindfold and ((not isinstance(prompt.maskBlindfold,float)) or prompt.maskBlindfold>random.random()):
-                    gradient_masked_cutouts = keep_mask*cutouts + block_mask*cutouts_blurred
-                else:
-                    gradient_masked_cutouts = keep_mask*cutouts + block_mask*cutouts_detached
+        # the part outside the mask gets no gradient, and is either the cutout or the "blindfolded" one, picked per masked prompt
+        background = cutouts_detached.index_select(0, pairCutIdx)
+        if self.blur_conv is not None:
+            #Get the "blindfolded" image by blurring then addimg more noise
+            facs = cutouts.new_empty([cutouts.size(0), 1, 1, 1]).uniform_(0, self.noise_fac)
+            cutouts_blurred = self.blur_conv(cutouts_detached)+ facs * torch.randn_like(cutouts_detached)
 
-                prompts_gradient_masked_cutouts.append(gradient_masked_cutouts)
+            useBlindfold = torch.rand(registry.NumMasked(), device=registry.blindfoldProbs.device) < registry.blindfoldProbs
+            pairBlindfold = useBlindfold.to(cutouts.device).index_select(0, pairMaskIdx)
+            background = torch.where(pairBlindfold[:, None, None, None], cutouts_blurred.index_select(0, pairCutIdx), background)
 
-        cutouts = torch.cat(prompts_gradient_masked_cutouts,dim=0)  
+        #compose cutout of gradient and non-gradient parts, for every kept pair at once
+        batchParts.append(keep_mask*pairCutouts + (1-keep_mask)*background)
 
-        return cutouts  
+        return torch.cat(batchParts, dim=0)
 
 
     def GetCutouts(self, synthedImage):
@@ -584,8 +717,18 @@ class GenerationJob:
             result.append(F.mse_loss(self.quantizedImage, torch.zeros_like(self.original_quantizedImage)) * ((1/torch.tensor(iteration*2 + 1))*self.init_weight) / 2)
 
         if self.use_spatial_prompts:
-            for prompt_masked_iii,prompt in zip(torch.chunk(clipEncodedImage,len(self.embededPrompts),dim=0),self.embededPrompts):
-                result.append(prompt(prompt_masked_iii))
+            registry = self.GetPromptRegistry()
+            pairEncoded = clipEncodedImage[self.spatialFirstPairRow:]
+
+            for prompt, maskIdx in zip(self.embededPrompts, registry.maskIndexForPrompt):
+                if maskIdx < 0:
+                    result.append(prompt(clipEncodedImage[:self.spatialNumCuts]))
+                    continue
+
+                # every pair counts 1 / cutn, the same as in the mean over all the cutouts. pairs that got dropped count 0,
+                # so a prompt with no pairs this step has a loss of 0
+                rowWeights = (self.spatialPairMaskIdx == maskIdx).to(pairEncoded.dtype) / self.spatialNumCuts
+                result.append(prompt(pairEncoded, rowWeights))
         else:
             for prompt in self.embededPrompts:
                 result.append(prompt(clipEncodedImage))      
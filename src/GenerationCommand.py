@@ -54,6 +54,10 @@ class IGenerationCommand(metaclass=abc.ABCMeta):
     def OnExecute(self, iteration: int ):
         raise NotImplementedError
 
+    # called once the job is done with the command, for freeing anything held for the commands lifetime
+    def Release(self):
+        pass
+
 
 
 class GenerationCommandContainer:
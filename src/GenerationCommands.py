@@ -7,6 +7,7 @@ from typing import List
 from src import GenerationCommand
 from src import ImageUtils
 from src import MakeCutouts
+from src import MaskStore
 import numpy as np
 
 import torch
@@ -213,7 +214,7 @@ class AddTextPrompt(GenerationCommand.IGenerationCommand):
 
     def OnExecute(self, iteration: int ):
         if self.clearOtherPrompts == True:
-            self.GenJob.embededPrompts = []
+            self.GenJob.ClearPrompts()
 
         print('Changing prompt to: "' + self.prompt + '", from ' + str(self))
         self.GenJob.EmbedTextPrompt(self.prompt)    
@@ -234,22 +235,22 @@ class RemovePrompt(GenerationCommand.IGenerationCommand):
 
     def OnExecute(self, iteration: int ):
         if self.removeAll:
-            self.GenJob.embededPrompts = []
+            self.GenJob.ClearPrompts()
             print('Removing all prompts, from ' + str(self))
         elif self.removeFirst:
-            self.GenJob.embededPrompts.pop(0)
+            self.GenJob.RemovePromptAt(0)
             print('Removing first prompt, from ' + str(self))
         elif self.removeLast:
-            self.GenJob.embededPrompts.pop(len(self.GenJob.embededPrompts) - 1)
+            self.GenJob.RemovePromptAt(len(self.GenJob.embededPrompts) - 1)
             print('Removing last prompt, from ' + str(self))
         elif self.removeAtIndex >= 0 and self.removeAtIndex < len(self.GenJob.embededPrompts):
-            self.GenJob.embededPrompts.pop( self.removeAtIndex )
+            self.GenJob.RemovePromptAt( self.removeAtIndex )
             print('Removing prompt at ' + str(self.removeAtIndex) + ', from ' + str(self))
           
 
 
 class AddTextPromptWithMask(GenerationCommand.IGenerationCommand):
-    def __init__(self, GenJob, prompt:str, maskImageFileName:str = None, maskTensor:torch.Tensor = None, dilateMaskAmount:int = 10, blindfold:float = 0.1, cacheImageOnInit:bool = True):
+    def __init__(self, GenJob, prompt:str, maskImageFileName:str = None, maskTensor:torch.Tensor = None, dilateMaskAmount:int = 10, blindfold:float = 0.1, cacheImageOnInit:bool = True, maskHandle:MaskStore.MaskHandle = None):
         super().__init__(GenJob)
 
         self.prompt = prompt        
@@ -259,47 +260,35 @@ class AddTextPromptWithMask(GenerationCommand.IGenerationCommand):
 
         self.maskImageFileName = maskImageFileName # filename of mask, if we load off the HD
         self.sourceMaskTensor = maskTensor # if we have a tensor we would liek to use as a mask, pass that in
+        self.sourceMaskHandle = maskHandle # or a mask thats already in the mask store, ie from another of these commands
 
-        self.imageTensor:torch.Tensor = None # the mask tensor we use for the prompt
+        self.maskHandle:MaskStore.MaskHandle = None # our reference to the prepared mask in the hallucinators mask store
 
     def Initialize(self):
-        with torch.inference_mode():
-            # load image into tensor? or we can do it when its time to add the mod, memory now vs. performance later...
-            if self.cacheImageOnInit:
-                #cache the image as a tensor here
-                if self.sourceMaskTensor == None:
-                    self.sourceMaskTensor = ImageUtils.loadImageToTensor(self.maskImageFileName) #, self.GenJob.ImageSizeX, self.GenJob.ImageSizeY )
-
-                self.imageTensor = self.SetupMask(self.sourceMaskTensor)
-                del self.sourceMaskTensor
-
+        # load + prepare the mask now, or when its time to add the prompt, memory now vs. performance later...
+        if self.cacheImageOnInit:
+            self.AcquireMask()
 
-    def SetupMask(self, tensor:torch.Tensor) -> torch.Tensor:
-        with torch.inference_mode():
-            #dialate
-            tensor = tensor.unsqueeze(0).to(self.GenJob.vqganDevice)
-
-            if self.dilateMaskAmount:                
-                struct_ele = torch.FloatTensor(1, 1,self.dilateMaskAmount,self.dilateMaskAmount).fill_(1).to(self.GenJob.vqganDevice)
-                tensor = F.conv2d(tensor,struct_ele,padding='same')                
+    def AcquireMask(self):
+        maskStore = self.GenJob.hallucinatorInst.maskStore
 
-            #resize masks to output size
-            tensor = F.interpolate(tensor,(self.GenJob.ImageSizeX, self.GenJob.ImageSizeY ) )
+        if self.sourceMaskHandle is not None:
+            self.maskHandle = maskStore.AddRef(self.sourceMaskHandle)
+            return
 
-            tensor = tensor.squeeze(0)
+        if self.sourceMaskTensor == None:
+            self.sourceMaskTensor = ImageUtils.loadImageToTensor(self.maskImageFileName) #, self.GenJob.ImageSizeX, self.GenJob.ImageSizeY )
 
-            #make binary
-            tensor[tensor>0.1]=1
+        # dilated, resized and made binary by the store, only once per distinct mask
+        self.maskHandle = maskStore.Acquire(self.sourceMaskTensor, self.dilateMaskAmount, [self.GenJob.ImageSizeX, self.GenJob.ImageSizeY], self.GenJob.vqganDevice)
+        self.sourceMaskTensor = None
 
-            return tensor.to(self.GenJob.vqganDevice)
+    def Release(self):
+        self.GenJob.hallucinatorInst.maskStore.Release(self.maskHandle)
 
     def OnExecute(self, iteration: int ):
-        if self.imageTensor == None:
-            if self.sourceMaskTensor == None:
-                self.sourceMaskTensor = ImageUtils.loadImageToTensor(self.maskImageFileName) #, self.GenJob.ImageSizeX, self.GenJob.ImageSizeY )
-
-            self.imageTensor = self.SetupMask(self.sourceMaskTensor)
-            del self.sourceMaskTensor
+        if self.maskHandle == None:
+            self.AcquireMask()
         
         print('Adding masked prompt for: "' + self.prompt + '", from ' + str(self))
 
@@ -314,7 +303,8 @@ class AddTextPromptWithMask(GenerationCommand.IGenerationCommand):
             self.GenJob.blur_conv = blur_conv.to(self.GenJob.vqganDevice)
 
         # add to prompts list, embed, add to masks, make its index discoverable, ugh.
-        self.GenJob.EmbedMaskedPrompt(self.prompt, self.imageTensor, self.blindfold)   
+        # the prompt gets its own handle, released when the prompt is removed
+        self.GenJob.EmbedMaskedPrompt(self.prompt, self.GenJob.hallucinatorInst.maskStore.AddRef(self.maskHandle), self.blindfold)   
 
 
 # sets the optimiser used
@@ -336,7 +326,7 @@ class SetOptimiser(GenerationCommand.IGenerationCommand):
 
 # cut method to use, see MakeCutouts.py for various cutout methods
 class SetCutMethod(GenerationCommand.IGenerationCommand):
-    def __init__(self, GenJob, cut_method:str = "latest", cutNum:int = 32, cutSize:List[int] = [0,0], cutPow:float = 1.0, augments:list = [], useKorniaAugments:bool = True):
+    def __init__(self, GenJob, cut_method:str = "latest", cutNum:int = 32, cutSize:List[int] = [0,0], cutPow:float = 1.0, augments:list = [], useKorniaAugments:bool = True, cutSizeBuckets:int = 0, useFusedAugments:bool = False):
         super().__init__(GenJob)
 
         self.cut_method = cut_method
@@ -345,10 +335,12 @@ class SetCutMethod(GenerationCommand.IGenerationCommand):
         self.cutPow = cutPow
         self.augments = augments
         self.useKorniaAugments = useKorniaAugments
+        self.cutSizeBuckets = cutSizeBuckets
+        self.useFusedAugments = useFusedAugments
 
     def Initialize(self):
         pass
 
 
     def OnExecute(self, iteration: int ):
-        self.GenJob.SetCutMethod( self.cut_method, self.cutNum, self.cutSize, self.cutPow, self.augments, self.useKorniaAugments )
+        self.GenJob.SetCutMethod( self.cut_method, self.cutNum, self.cutSize, self.cutPow, self.augments, self.useKorniaAugments, self.cutSizeBuckets, self.useFusedAugments )
@@ -1,7 +1,7 @@
 import sys
 import os
 import random
-from typing import Any, Tuple
+from typing import Any, Dict, List, Tuple
 import numpy as np
 from tqdm import tqdm
 
@@ -9,6 +9,12 @@ from src import GenerationCommands
 from src import GenerationCommand
 from src import MakeCutouts
 from src import GenerateJob
+from src import CodebookIndex
+from src import CodebookStats
+from src import EmbeddingCache
+from src import ImageWriter
+from src import LossMetrics
+from src import MaskStore
 
 #stuff im using from source instead of installs
 # i want to run clip from source, not an install. I have clip in a dir alongside this project
@@ -36,6 +42,7 @@ from torch.cuda.amp import autocast
 from torch.cuda.amp import custom_fwd
 from torch.cuda.amp import custom_bwd
 from torch.cuda.amp import GradScaler
+from torch.utils.checkpoint import checkpoint
 from torch import nn, optim
 from torch.nn import functional as F
 from torchvision import transforms
@@ -50,6 +57,12 @@ from torchvision.datasets import CIFAR100
 
 
 
+def is_out_of_memory(e:Exception) -> bool:
+    if hasattr(torch.cuda, 'OutOfMemoryError') and isinstance(e, torch.cuda.OutOfMemoryError):
+        return True
+    return 'out of memory' in str(e)
+
+
 ####################################################
 # main class used to start up the vqgan clip stuff, and allow for interactable generation
 # - basic usage can be seen from generate.py
@@ -59,7 +72,11 @@ class Hallucinator:
 
     def __init__(self, clipModel:str = 'ViT-B/32', vqgan_config_path:str = 'checkpoints/vqgan_imagenet_f16_16384.yaml', vqgan_checkpoint_path:str = 'checkpoints/vqgan_imagenet_f16_16384.ckpt', 
                  use_mixed_precision:bool = False, clip_cpu:bool = False, randomSeed:int = None, cuda_device:str = "cuda:0", anomaly_checker:bool = False, deterministic:int = 1, 
-                 log_clip:bool = False, log_clip_oneshot:bool = False, log_mem:bool = False, display_freq:int = 50 ):
+                 log_clip:bool = False, log_clip_oneshot:bool = False, log_mem:bool = False, display_freq:int = 50, vq_memory_budget_mb:int = 0,
+                 vq_approx_lists:int = 0, vq_approx_probes:int = 8,
+                 text_cache_mb:int = 64, text_cache_dir:str = None, text_disk_cache_mb:int = 512, image_cache_mb:int = 256,
+                 save_workers:int = 2, save_queue_size:int = 8, metrics_flush_freq:int = 10, clip_encode_budget_mb:int = 0,
+                 cutout_chunk_size:int = 0 ):
 
         ## passed in settings
         self.clip_model = clipModel
@@ -75,16 +92,35 @@ class Hallucinator:
         self.log_clip_oneshot = log_clip_oneshot
         self.log_mem = log_mem
         self.display_freq = display_freq
+        self.vq_memory_budget_mb = vq_memory_budget_mb # max MB the nearest code search can use at once, 0 is unbounded
+        self.vq_approx_lists = vq_approx_lists # number of clusters in the approximate code search index, 0 uses the exact search
+        self.vq_approx_probes = vq_approx_probes # clusters searched per token, higher is better recall but slower
+        self.text_cache_mb = text_cache_mb # in memory size of the clip text embedding cache
+        self.text_cache_dir = text_cache_dir # directory for the on disk text embedding cache, None to disable
+        self.text_disk_cache_mb = text_disk_cache_mb # max size of the on disk text embedding cache
+        self.image_cache_mb = image_cache_mb # in memory size of the decoded image prompt cache
+        self.save_workers = save_workers # threads writing progress images in the background, 0 saves inline
+        self.save_queue_size = save_queue_size # images each writer thread can have queued before training waits on it
+        self.metrics_flush_freq = metrics_flush_freq # steps between reading losses back from the gpu, see LossMetrics.py
+        self.clip_encode_budget_mb = clip_encode_budget_mb # max MB a clip image encode call should use, the batch is split to fit. 0 is unbounded
+        self.cutout_chunk_size = cutout_chunk_size # cutouts backpropagated through clip at a time, see BackwardChunked. 0 does them all at once
 
         #### class wide variables set with default values
         self.clipPerceptorInputResolution = None # set after loading clip
         self.clipPerceptor: model.CLIP = None # clip model
         self.clipDevice = None # torch device clip model is loaded onto
         self.clipCifar100 = None #one shot clip model classes, used when logging clip info
+        self.textEmbeddingCache: EmbeddingCache.TextEmbeddingCache = None # shared by all jobs, created with clip
+        self.imagePromptCache: EmbeddingCache.ImagePromptCache = None # shared by all jobs, created with clip
+        self.imageWriter: ImageWriter.AsyncImageWriter = None # background image saving, shared by all jobs
+        self.maskStore = MaskStore.MaskStore() # prepared prompt masks, shared by every prompt / job using the same mask
+        self.clipEncodeBatchSizes = {} # (clip model, resolution) -> images per clip encode call, learned from running out of memory
 
         self.vqganDevice = None #torch device vqgan model is loaded onto
         self.vqganModel: vqgan.VQModel = None #vqgan model
         self.vqganGumbelEnabled = False #vqgan gumbel model in use
+        self.vqganCodebookStats: CodebookStats.VQGANCodebookStats = None # codebook, norms, bounds etc, computed once per loaded model
+        self.vqganCodebookIndex: CodebookIndex.IVFCodebookIndex = None # approximate code search, if enabled
         
         # From imagenet - Which is better?
         #normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
@@ -106,6 +142,10 @@ class Hallucinator:
         self.InitTorch()        
         self.InitVQGAN()
         self.InitClip()
+
+        if self.save_workers > 0:
+            self.imageWriter = ImageWriter.AsyncImageWriter(self.save_workers, self.save_queue_size)
+
         print('Using vqgandevice:', self.vqganDevice)
         print('Using clipdevice:', self.clipDevice)
 
@@ -141,17 +181,48 @@ class Hallucinator:
     ###################
     # Vector quantize
     ###################
-    def vector_quantize(self, x, codebook) -> torch.Tensor:
-        d = x.pow(2).sum(dim=-1, keepdim=True) + codebook.pow(2).sum(dim=1) - 2 * x @ codebook.T
-        indices = d.argmin(-1)
-        x_q = F.one_hot(indices, codebook.shape[0]).to(d.dtype) @ codebook
+    # codebookNormsSq can be passed in to avoid recomputing the codebook norms every call
+    def vector_quantize(self, x, codebook, codebookNormsSq = None) -> torch.Tensor:
+        if codebookNormsSq is None:
+            codebookNormsSq = codebook.pow(2).sum(dim=1)
+
+        indices = self.nearest_code_indices(x.reshape(-1, x.shape[-1]), codebook, codebookNormsSq).view(x.shape[:-1])
+
+        # gather the codebook rows directly, instead of building a tokens x n_e one hot matrix and multiplying
+        x_q = F.embedding(indices, codebook)
         return GenerateJob.replace_grad(x_q, x)
 
+    # finds the closest codebook entry for each row of x ( tokens x e_dim ). the distance matrix is tokens x n_e,
+    # so when a memory budget is set we do this in chunks of tokens instead of all at once
+    @torch.no_grad()
+    def nearest_code_indices(self, x, codebook, codebookNormsSq) -> torch.Tensor:
+        if self.vqganCodebookIndex is not None and codebook is self.vqganCodebookStats.codebook:
+            return self.vqganCodebookIndex.Search(x)
+
+        chunkSize = self.GetVQChunkSize(codebook.shape[0], x.dtype)
+        if chunkSize == 0 or chunkSize >= x.shape[0]:
+            d = x.pow(2).sum(dim=-1, keepdim=True) + codebookNormsSq - 2 * x @ codebook.T
+            return d.argmin(-1)
+
+        indices = []
+        for xChunk in x.split(chunkSize):
+            d = xChunk.pow(2).sum(dim=-1, keepdim=True) + codebookNormsSq - 2 * xChunk @ codebook.T
+            indices.append(d.argmin(-1))
+            del d
+        return torch.cat(indices)
+
+    # how many tokens fit in the vq memory budget, 0 if there is no budget
+    def GetVQChunkSize(self, numCodes:int, dtype) -> int:
+        if not self.vq_memory_budget_mb:
+            return 0
+
+        # the distance matrix for a chunk, plus the matmul result its built from
+        bytesPerToken = 2 * numCodes * torch.finfo(dtype).bits // 8
+        return max(1, (self.vq_memory_budget_mb * 1024 * 1024) // bytesPerToken)
+
     def synth(self, z, gumbelMode) -> torch.Tensor:
-        if gumbelMode:
-            z_q = self.vector_quantize(z.movedim(1, 3), self.vqganModel.quantize.embed.weight).movedim(3, 1)
-        else:
-            z_q = self.vector_quantize(z.movedim(1, 3), self.vqganModel.quantize.embedding.weight).movedim(3, 1)
+        stats = self.vqganCodebookStats
+        z_q = self.vector_quantize(z.movedim(1, 3), stats.codebook, stats.codebookNormsSq).movedim(3, 1)
         return MakeCutouts.clamp_with_grad(self.vqganModel.decode(z_q).add(1).div(2), 0, 1)
 
 
@@ -256,6 +327,10 @@ class Hallucinator:
 
         self.clipPerceptorInputResolution = self.clipPerceptor.visual.input_resolution
 
+        self.textEmbeddingCache = EmbeddingCache.TextEmbeddingCache(self.clip_model, self.text_cache_mb * 1024 * 1024, 
+                                                                     self.text_cache_dir, self.text_disk_cache_mb * 1024 * 1024)
+        self.imagePromptCache = EmbeddingCache.ImagePromptCache(self.clip_model, self.image_cache_mb * 1024 * 1024)
+
 
 
     def InitVQGAN(self):
@@ -288,6 +363,17 @@ class Hallucinator:
 
         self.vqganModel.to(self.vqganDevice)
 
+        # the codebook doesnt change for a loaded model, so work out everything jobs need from it once here
+        self.vqganCodebookStats = CodebookStats.VQGANCodebookStats(self.vqganModel, self.vqganGumbelEnabled)
+
+        self.vqganCodebookIndex = None
+        if self.vq_approx_lists > 0:
+            print("---  building approximate codebook index, lists: " + str(self.vq_approx_lists) + ", probes: " + str(self.vq_approx_probes))
+            self.vqganCodebookIndex = CodebookIndex.IVFCodebookIndex(self.vqganCodebookStats.codebook, self.vq_approx_lists, self.vq_approx_probes, searchBudgetMB=self.vq_memory_budget_mb)
+            chunkSize = self.GetVQChunkSize(self.vqganCodebookIndex.numCodes, self.vqganCodebookStats.codebook.dtype)
+            print("approximate codebook index recall vs exact search: " + str(self.vqganCodebookIndex.MeasureRecallOnCodebook(chunkSize=chunkSize)))
+            print("---  / approximate codebook index built")
+
         print("---  VQGAN model loaded ---")
         self.log_torch_mem()
         print("--- / VQGAN model loaded ---")
@@ -335,6 +421,48 @@ class Hallucinator:
         # Training time
         img, lossAll, lossSum = self.train(genJob, genJob.currentIteration)
 
+        return self.OnJobStepFinished(genJob, img, lossAll, lossSum, trainCallbackFunc)
+
+
+    # step several jobs at once. jobs with the same latent size get stacked and trained as one batch,
+    # each job keeps its own optimizer. returns a list of bools, true if that job has more processing left
+    # library api for scripts driving several jobs, the servers JobScheduler still steps one job per slice
+    def ProcessJobsStep(self, genJobs:List[GenerateJob.GenerationJob], trainCallbackFunc = None) -> List[bool]:
+        for genJob in genJobs:
+            genJob.OnPreTrain()
+
+        # group jobs by the shape of their latents, only those can be decoded together
+        jobGroups:Dict[Tuple, List[GenerateJob.GenerationJob]] = {}
+        for genJob in genJobs:
+            jobGroups.setdefault(tuple(genJob.quantizedImage.shape), []).append(genJob)
+
+        trainResults = {}
+        for jobGroup in jobGroups.values():
+            # chunked training is for when one jobs cutouts barely fit, so dont stack jobs on top of that
+            if len(jobGroup) == 1 or self.cutout_chunk_size:
+                for genJob in jobGroup:
+                    trainResults[id(genJob)] = self.train(genJob, genJob.currentIteration)
+            else:
+                for genJob, result in zip(jobGroup, self.trainBatch(jobGroup)):
+                    trainResults[id(genJob)] = result
+
+        moreWork = []
+        for genJob in genJobs:
+            img, lossAll, lossSum = trainResults[id(genJob)]
+            moreWork.append( self.OnJobStepFinished(genJob, img, lossAll, lossSum, trainCallbackFunc) )
+
+        return moreWork
+
+
+    # callbacks and iteration bookkeeping after a job was trained for a step, returns true if theres more processing left for it
+    def OnJobStepFinished(self, genJob:GenerateJob.GenerationJob, img, lossAll, lossSum, trainCallbackFunc = None) -> bool:
+        genJob.lossMetrics.Record(genJob.currentIteration, img, lossAll, lossSum)
+
+        # losses only get read back every so often, display steps and the last step need them now
+        isLastIteration = genJob.currentIteration + 1 == genJob.totalIterations
+        if genJob.lossMetrics.NeedsFlush() or genJob.currentIteration % self.display_freq == 0 or isLastIteration:
+            self.FlushJobMetrics(genJob)
+
         if trainCallbackFunc != None:
             trainCallbackFunc(genJob, genJob.currentIteration, img, lossAll, lossSum)
         
@@ -350,19 +478,40 @@ class Hallucinator:
         return True
 
     
+    # reads the jobs recorded losses back from the device, feeds them to the lr scheduler and saves the best image if it changed
+    def FlushJobMetrics(self, genJob:GenerateJob.GenerationJob) -> LossMetrics.FlushedLosses:
+        flushed = genJob.lossMetrics.Flush()
+        if flushed is None:
+            return None
+
+        for lossSum in flushed.lossSums:
+            self.UpdateScheduler(genJob, lossSum)
+
+        if flushed.newBest:
+            print("saving image for best error: " + str(flushed.bestLoss) + ", iteration " + str(flushed.bestIteration))
+            genJob.bestErrorScore = flushed.bestLoss
+            genJob.SaveImageTensor( genJob.lossMetrics.bestImage, "lowest_error_")
+
+        return flushed
+
+
     @torch.inference_mode()
     def DefaultTrainCallback(self, genJob:GenerateJob.GenerationJob, iteration:int, curImg, lossAll, lossSum):
         # stat updates and progress images
         if iteration % self.display_freq == 0:
+            # one read back for all the losses, instead of an .item() per prompt
+            lossValues = torch.stack([ lossSum.detach().float().reshape(()) ] + [ loss.detach().float().reshape(()).to(lossSum.device) for loss in lossAll ]).tolist()
+
             print("\n*************************************************")
-            print(f'i: {iteration}, loss sum: {lossSum.item():g}')
+            print(f'i: {iteration}, loss sum: {lossValues[0]:g}')
+            print(f'last {genJob.lossStats.Size()} losses, mean: {genJob.lossStats.Mean():g}, min: {genJob.lossStats.Min():g}, slope: {genJob.lossStats.Slope():g}')
             print("*************************************************")
 
             promptNum = 0
             lossLen = len(lossAll)
             if genJob.embededPrompts and lossLen <= len(genJob.embededPrompts):
-                for loss in lossAll:            
-                    print( "----> " + genJob.embededPrompts[promptNum].TextPrompt + " - loss: " + str( loss.item() ) )
+                for loss in lossValues[1:]:            
+                    print( "----> " + genJob.embededPrompts[promptNum].TextPrompt + " - loss: " + str( loss ) )
                     promptNum += 1
             else:
                 print("mismatch in prompt numbers and losses!")
@@ -373,8 +522,19 @@ class Hallucinator:
                 self.WriteLogClipResults(genJob, curImg)
                 print(" ")
 
+                # an exact search over up to 4096 tokens, only worth paying for when were logging anyway
+                if self.vqganCodebookIndex is not None:
+                    chunkSize = self.GetVQChunkSize(self.vqganCodebookIndex.numCodes, self.vqganCodebookStats.codebook.dtype)
+                    print("approximate codebook search recall on current image: " + str(self.vqganCodebookIndex.MeasureRecall(genJob.quantizedImage.movedim(1, 3), chunkSize)))
+                    print(" ")
+
             if self.log_mem:
                 self.log_torch_mem()
+                print("text embedding cache: " + str(self.textEmbeddingCache.GetStats()))
+                print("image prompt cache: " + str(self.imagePromptCache.GetStats()))
+                print("mask store: " + str(self.maskStore.GetStats()))
+                if self.clipEncodeBatchSizes:
+                    print("clip encode micro batch sizes: " + str(self.clipEncodeBatchSizes))
                 print(" ")
 
             print(" ")
@@ -387,15 +547,6 @@ class Hallucinator:
                 genJob.savedImageCount = iteration
                 
             genJob.SaveImageTensor( curImg, str(genJob.savedImageCount).zfill(5))
-                            
-        if genJob.save_best == True:
-
-            lossAvg = lossSum / len(lossAll)
-
-            if genJob.bestErrorScore > lossAvg.item():
-                print("saving image for best error: " + str(lossAvg.item()))
-                genJob.bestErrorScore = lossAvg
-                genJob.SaveImageTensor( curImg, "lowest_error_")
 
 
     def train(self, genJob:GenerateJob.GenerationJob, iteration:int):
@@ -406,51 +557,215 @@ class Hallucinator:
             
             cutouts = genJob.GetCutouts(synthedImage)
 
-            if self.clipDevice != self.vqganDevice:
-                clipEncodedImage = self.clipPerceptor.encode_image(self.normalize(cutouts.to(self.clipDevice))).float()
+            if self.cutout_chunk_size and cutouts.shape[0] > self.cutout_chunk_size:
+                lossAll, lossSum = self.BackwardChunked(genJob, cutouts, iteration)
             else:
-                clipEncodedImage = self.clipPerceptor.encode_image(self.normalize(cutouts)).float()
+                clipEncodedImage = self.EncodeImage(cutouts)
+                
+                lossAll = genJob.GetCutoutResults(clipEncodedImage, iteration)
+                lossSum = self.CombineLosses(lossAll)
+                
+                if self.use_mixed_precision == False:
+                    lossSum.backward()
+                else:
+                    genJob.gradScaler.scale(lossSum).backward()
 
-            
-            lossAll = genJob.GetCutoutResults(clipEncodedImage, iteration)
+            self.StepOptimizer(genJob)
 
-            # see if this squaring helps with multiple prompts
-            lossSum:torch.Tensor = None
+            return synthedImage, lossAll, lossSum
 
-            if len( lossAll ) > 1:
-                total:torch.Tensor = None
-                for t in lossAll:
-                    if total == None:
-                        total = torch.square( t )
-                    else:
-                        total += torch.square( t )
 
-                lossSum = total
-            else:
-                ret:Any = sum(lossAll)
-                assert( isinstance(ret, torch.Tensor) )
-                lossSum = ret
+    # backward for a big cutout batch, with only cutout_chunk_size cutouts in clips autograd graph at any one time.
+    # gives the same gradients as the plain backward in train, at the cost of one more clip forward:
+    #   - pass 1: encode every cutout without autograd, and backward the losses to the embeddings. the losses get
+    #     squared and summed across prompts in CombineLosses, so every embedding is needed before any gradient is known
+    #   - pass 2: per chunk, encode again with autograd and push that chunks embedding gradients back into the cutouts
+    # the cutout gradients then go back through the cut method + augments and the vqgan decoder once, the decoded
+    # image is only ever in one graph so nothing needs retain_graph
+    def BackwardChunked(self, genJob:GenerateJob.GenerationJob, cutouts:torch.Tensor, iteration:int):
+        cutoutsDetached = cutouts.detach().requires_grad_(True)
+
+        with torch.no_grad():
+            clipEncodedImage = self.EncodeImage(cutoutsDetached)
+        clipEncodedImage.requires_grad_(True)
+
+        # also gives the init_weight loss its gradient, that one goes straight to the latent
+        lossAll = genJob.GetCutoutResults(clipEncodedImage, iteration)
+        lossSum = self.CombineLosses(lossAll)
+
+        if self.use_mixed_precision == False:
+            lossSum.backward()
+        else:
+            genJob.gradScaler.scale(lossSum).backward()
+
+        encodedGrads = clipEncodedImage.grad
+        for start in range(0, cutouts.shape[0], self.cutout_chunk_size):
+            chunkEncoded = self.EncodeImage(cutoutsDetached[start:start + self.cutout_chunk_size])
+            chunkEncoded.backward(encodedGrads[start:start + self.cutout_chunk_size])
+            del chunkEncoded
+
+        cutouts.backward(cutoutsDetached.grad)
+
+        return lossAll, lossSum
+
+
+    # trains a group of jobs that have the same latent size as one batch:
+    # one decode, one clip encode for all the cutouts, and then the losses are split back out per job.
+    # the decoder works on each image independently, and jobs share no parameters, so each job gets the same
+    # gradients it would get if it was trained alone
+    def trainBatch(self, genJobs:List[GenerateJob.GenerationJob]):
+        with torch.cuda.amp.autocast(self.use_mixed_precision):
+            for genJob in genJobs:
+                genJob.optimizer.zero_grad(set_to_none=True)
 
+            synthedImages = self.synth(torch.cat([genJob.quantizedImage for genJob in genJobs]), genJobs[0].vqganGumbelEnabled)
 
-            if genJob.optimizer == "MADGRAD":
-                genJob.loss_idx.append(lossSum.item())
-                if iteration > 100: #use only 100 last looses to avg
-                    avg_loss = sum(genJob.loss_idx[iteration-100:])/len(genJob.loss_idx[iteration-100:]) 
+            cutoutsList = []
+            for idx, genJob in enumerate(genJobs):
+                cutoutsList.append( genJob.GetCutouts(synthedImages[idx:idx+1]) )
+
+            clipEncodedImages = self.EncodeImage(torch.cat(cutoutsList))
+            clipEncodedPerJob = clipEncodedImages.split([cutouts.shape[0] for cutouts in cutoutsList])
+
+            results = []
+            backwardLoss:torch.Tensor = None
+            for idx, genJob in enumerate(genJobs):
+                lossAll = genJob.GetCutoutResults(clipEncodedPerJob[idx], genJob.currentIteration)
+                lossSum = self.CombineLosses(lossAll)
+
+                if self.use_mixed_precision == True:
+                    scaledLoss = genJob.gradScaler.scale(lossSum)
+                else:
+                    scaledLoss = lossSum
+                backwardLoss = scaledLoss if backwardLoss is None else backwardLoss + scaledLoss
+
+                results.append( (synthedImages[idx:idx+1], lossAll, lossSum) )
+
+            backwardLoss.backward()
+
+            for genJob in genJobs:
+                self.StepOptimizer(genJob)
+
+            return results
+
+
+    # clip image encoding, in micro batches when the whole batch doesnt fit.
+    # the micro batch size comes from the clip encode memory budget, and gets halved every time a micro batch runs out
+    # of cuda memory. sizes that had to shrink are remembered per clip model + resolution, so later jobs start there.
+    # under autograd each micro batch is checkpointed, only its input is kept and its activations are recomputed in
+    # backward one micro batch at a time, otherwise splitting the forward wouldnt save anything
+    def EncodeImage(self, cutouts:torch.Tensor) -> torch.Tensor:
+        if self.clipDevice != self.vqganDevice:
+            cutouts = cutouts.to(self.clipDevice)
+        cutouts = self.normalize(cutouts)
+
+        numImages = cutouts.shape[0]
+        if numImages == 0:
+            # spatial prompts with nothing overlapping, the empty result still hangs off the cutouts so backward works
+            return cutouts.flatten(1)[:, :1].expand(0, self.clipPerceptor.visual.output_dim).float()
+
+        key = (self.clip_model, cutouts.shape[-1])
+        batchSize = min( size for size in [numImages, self.clipEncodeBatchSizes.get(key, 0), self.GetClipEncodeBatchSize(cutouts)] if size > 0 )
+
+        encoded = []
+        start = 0
+        while start < numImages:
+            chunk = cutouts[start:start + batchSize]
+            try:
+                encoded.append( self.EncodeImageChunk(chunk, chunk.shape[0] < numImages) )
+            except RuntimeError as e:
+                if not is_out_of_memory(e) or batchSize == 1:
+                    raise
+
+                del e
+                batchSize = max(1, chunk.shape[0] // 2)
+                self.clipEncodeBatchSizes[key] = batchSize
+                torch.cuda.empty_cache()
+                print("clip encode ran out of memory, using micro batches of " + str(batchSize) + " for " + str(key))
+                continue
+
+            start += chunk.shape[0]
+
+        if len(encoded) == 1:
+            return encoded[0]
+        return torch.cat(encoded)
+
+    # plain reentrant checkpoint, torch 1.10 takes no other checkpoint options. it needs an input that requires grad,
+    # which the cutouts do whenever were training.
+    # the out of memory retry in EncodeImage only covers the forward: the recompute during backward runs at the micro
+    # batch size the forward settled on, and is not retried if that runs out of memory. the forward under checkpoint
+    # keeps no activations, so it can succeed at a size the backward cant, set clip_encode_budget with some headroom
+    def EncodeImageChunk(self, chunk:torch.Tensor, checkpointed:bool) -> torch.Tensor:
+        if checkpointed and torch.is_grad_enabled() and chunk.requires_grad:
+            return checkpoint(self.encode_image_float, chunk)
+        return self.encode_image_float(chunk)
+
+    def encode_image_float(self, images:torch.Tensor) -> torch.Tensor:
+        return self.clipPerceptor.encode_image(images).float()
+
+    # how many images fit in the clip encode budget, 0 if there is no budget
+    def GetClipEncodeBatchSize(self, images:torch.Tensor) -> int:
+        if not self.clip_encode_budget_mb:
+            return 0
+
+        bytesPerImage = self.EstimateClipEncodeBytesPerImage(images.shape[-1])
+        return max(1, (self.clip_encode_budget_mb * 1024 * 1024) // bytesPerImage)
+
+    # rough activation memory of one image through the clip visual model, its a starting point, running out of memory
+    # still shrinks the micro batches from there
+    def EstimateClipEncodeBytesPerImage(self, resolution:int) -> int:
+        visual = self.clipPerceptor.visual
+        bytesPerValue = 2 if torch.is_autocast_enabled() else 4
+
+        if hasattr(visual, 'transformer'):
+            # vit: per layer, about 16 token x width tensors ( layer norms, qkv, attention out, the 4x mlp ) + the attention maps
+            tokens = (resolution // visual.conv1.kernel_size[0]) ** 2 + 1
+            width = visual.transformer.width
+            heads = max(1, width // 64)
+            perLayer = 16 * tokens * width + 2 * heads * tokens * tokens
+            return visual.transformer.layers * perLayer * bytesPerValue
+
+        # modified resnet: the stem and first stages dominate, about 100 values per input pixel all in
+        return 100 * resolution * resolution * bytesPerValue
+
+
+    def CombineLosses(self, lossAll) -> torch.Tensor:
+        # see if this squaring helps with multiple prompts
+        lossSum:torch.Tensor = None
+
+        if len( lossAll ) > 1:
+            total:torch.Tensor = None
+            for t in lossAll:
+                if total == None:
+                    total = torch.square( t )
                 else:
-                    avg_loss = sum(genJob.loss_idx)/len(genJob.loss_idx)
+                    total += torch.square( t )
 
-                genJob.scheduler.step(avg_loss)
-            
-            if self.use_mixed_precision == False:
-                lossSum.backward()
-                genJob.optimizer.step()
-            else:
-                genJob.gradScaler.scale(lossSum).backward()
-                genJob.gradScaler.step(genJob.optimizer)
-                genJob.gradScaler.update()
-            
-            with torch.inference_mode():
-                genJob.quantizedImage.copy_(genJob.quantizedImage.maximum(genJob.z_min).minimum(genJob.z_max))
+            lossSum = total
+        else:
+            ret:Any = sum(lossAll)
+            assert( isinstance(ret, torch.Tensor) )
+            lossSum = ret
 
-            return synthedImage, lossAll, lossSum
+        return lossSum
+
+
+    # called with the loss sums read back by FlushJobMetrics, so this lags behind training by up to metrics_flush_freq steps
+    def UpdateScheduler(self, genJob:GenerateJob.GenerationJob, lossSum:float):
+        genJob.lossStats.Add(lossSum)
+
+        #use only the last 100 losses to avg
+        if genJob.scheduler is not None:
+            genJob.scheduler.step(genJob.lossStats.Mean())
 
+
+    # gradients need to already be computed, steps the jobs optimizer and clamps the latent to the codebook bounds
+    def StepOptimizer(self, genJob:GenerateJob.GenerationJob):
+        if self.use_mixed_precision == False:
+            genJob.optimizer.step()
+        else:
+            genJob.gradScaler.step(genJob.optimizer)
+            genJob.gradScaler.update()
+        
+        with torch.inference_mode():
+            genJob.quantizedImage.copy_(genJob.quantizedImage.maximum(genJob.z_min).minimum(genJob.z_max))
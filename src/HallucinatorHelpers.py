@@ -1,3 +1,5 @@
+import hashlib
+import io
 from typing import List
 
 from PIL import Image
@@ -5,6 +7,7 @@ import numpy as np
 import torch
 from src import GenerationCommand, GenerationCommands, Hallucinator
 from src import GenerateJob
+from src import EmbeddingCache
 from torchvision.transforms import functional as TF
 
 ###########################################
@@ -24,7 +27,12 @@ def CreateHallucinatorFromArgParse( args ) -> Hallucinator.Hallucinator:
                                               vqgan_checkpoint_path=args.vqgan_checkpoint, use_mixed_precision=args.use_mixed_precision,
                                               clip_cpu=args.clip_cpu, cuda_device=args.cuda_device, anomaly_checker = args.anomaly_checker,
                                               deterministic = args.deterministic, log_clip = args.log_clip, log_clip_oneshot = args.log_clip_oneshot, 
-                                              log_mem = args.log_mem, display_freq = args.display_freq )
+                                              log_mem = args.log_mem, display_freq = args.display_freq, vq_memory_budget_mb = args.vq_memory_budget,
+                                              vq_approx_lists = args.vq_approx_lists, vq_approx_probes = args.vq_approx_probes,
+                                              text_cache_mb = args.text_cache_mb, text_cache_dir = args.text_cache_dir, text_disk_cache_mb = args.text_disk_cache_mb,
+                                              image_cache_mb = args.image_cache_mb, save_workers = args.save_workers, save_queue_size = args.save_queue,
+                                              metrics_flush_freq = args.metrics_flush_freq,
+                                              clip_encode_budget_mb = args.clip_encode_budget, cutout_chunk_size = args.cutout_chunk_size )
 
     hallucinatorInst.Initialize()
 
@@ -42,21 +50,26 @@ def CreateGenerationJobFromArgParse( hallucinatorInst:Hallucinator.Hallucinator,
                                         save_seq = args.save_seq, save_best = args.save_best)
 
 
-    genJob.Initialize()
+    # a long lived process ( the server ) keeps going after a bad job spec, so dont leave what the job already took hold of behind
+    try:
+        genJob.Initialize()
 
-    # create the commands we need to set this up
+        # create the commands we need to set this up
 
-    # cut method, fire at 0 so we define it on startup
-    cut = GenerationCommands.SetCutMethod(genJob, cut_method = args.cut_method, cutNum=args.cutn, cutSize=args.cut_size, cutPow=args.cut_pow, augments=args.augments)
-    genJob.AddGenerationCommandFireOnce(cut, 0)
+        # cut method, fire at 0 so we define it on startup
+        cut = GenerationCommands.SetCutMethod(genJob, cut_method = args.cut_method, cutNum=args.cutn, cutSize=args.cut_size, cutPow=args.cut_pow, augments=args.augments, cutSizeBuckets=args.cut_size_buckets, 
+                                            useFusedAugments=args.fused_augments)
+        genJob.AddGenerationCommandFireOnce(cut, 0)
 
-    # optimizer
-    opt = GenerationCommands.SetOptimiser(genJob, optimizerName=args.optimizer, learningRate=args.step_size)
-    genJob.AddGenerationCommandFireOnce(opt, 0)
-
-    # prompts...
-    CreateGenerationCommandListForTextPromptsAndAddToJob(genJob, textPrompts = args.prompts, storyModePromptChangeFreq=args.prompt_frequency)
+        # optimizer
+        opt = GenerationCommands.SetOptimiser(genJob, optimizerName=args.optimizer, learningRate=args.step_size)
+        genJob.AddGenerationCommandFireOnce(opt, 0)
 
+        # prompts...
+        CreateGenerationCommandListForTextPromptsAndAddToJob(genJob, textPrompts = args.prompts, storyModePromptChangeFreq=args.prompt_frequency)
+    except Exception:
+        genJob.ReleaseResources()
+        raise
 
     return genJob
 
@@ -99,18 +112,66 @@ def CreateGenerationCommandListForTextPromptsAndAddToJob(genJob:GenerateJob.Gene
     return cmdList
 
 
-# TODO: this is probably nto the best place for this, but w/e, good enough for now.
-#   doesnt support multiple weighted promtps yet, not automatically. need to come up with a way to rpeserve memory, the masks will eat
-#   up memory if we have 10 prompts using the same mask, so neeed to come up with a better way to share masks between prompts
-def CreateGenerationCommandListForMaskablePrompts(genJob:GenerateJob.GenerationJob, spatialPromptConfig:GenerateJob.SpatialPromptConfig) -> List[GenerationCommands.AddTextPromptWithMask]:
-    #Make prompt masks
-    img = Image.open(spatialPromptConfig.prompt_key_image)
-    pil_image = img.convert('RGB')
+####################################################
+# colour key masks for spatial prompts
+#
+# every pixel of the key image goes to the prompt with the closest colour ( L1 distance ), exact matches included.
+# instead of a loop over pixels, the distances are worked out once per distinct colour in the image against the palette,
+# and the winning prompt index gets scattered into one hot masks. the masks are cached by key image content hash + palette,
+# so scripted runs / repeat jobs with the same key image skip all of it
+####################################################
+
+colorKeyMaskCache = EmbeddingCache.LRUTensorCache(256 * 1024 * 1024)
+
+
+# palette is one rgb colour per prompt. duplicate colours behave like the old dict did: a colour goes to the last prompt
+# that uses it, and ties between colours go to the one listed first. returns a prompts x 1 x h x w bool tensor
+def build_color_key_masks(keyImage:np.ndarray, palette:List[tuple]) -> torch.Tensor:
+    uniqueColors = []
+    colorToPromptIdx = {}
+    for promptIdx, color in enumerate(palette):
+        color = tuple(int(c) for c in color)
+        if color not in colorToPromptIdx:
+            uniqueColors.append(color)
+        colorToPromptIdx[color] = promptIdx
+    uniquePromptIdx = np.array([ colorToPromptIdx[color] for color in uniqueColors ], dtype=np.int64)
+
+    h, w = keyImage.shape[:2]
+    pixels = keyImage.reshape(-1, 3).astype(np.int32)
+
+    # only the distinct colours of the image need distances, most key images have a handful
+    packed = (pixels[:, 0] << 16) | (pixels[:, 1] << 8) | pixels[:, 2]
+    imageColors, pixelColorIdx = np.unique(packed, return_inverse=True)
+    imageRGB = np.stack([ (imageColors >> 16) & 255, (imageColors >> 8) & 255, imageColors & 255 ], axis=1)
+
+    dists = np.abs(imageRGB[:, None, :] - np.array(uniqueColors, dtype=np.int32)[None, :, :]).sum(axis=2)
+    pixelPromptIdx = uniquePromptIdx[dists.argmin(axis=1)][pixelColorIdx.reshape(-1)]
 
-    prompt_key_image = np.asarray(pil_image)
+    masks = torch.zeros((len(palette), h * w), dtype=torch.bool)
+    masks.scatter_(0, torch.from_numpy(pixelPromptIdx)[None, :], True)
+    return masks.view(len(palette), 1, h, w)
 
-    #Set up color->prompt map
-    color_to_prompt_idx={}
+
+# returns prompts x 1 x h x w float masks for the key image at path, from the cache if its been seen with this palette
+def get_color_key_masks(path:str, palette:List[tuple]) -> torch.Tensor:
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    key = (hashlib.sha256(data).hexdigest(), tuple( tuple(int(c) for c in color) for color in palette ))
+    masks = colorKeyMaskCache.Get(key)
+    if masks is None:
+        keyImage = np.asarray(Image.open(io.BytesIO(data)).convert('RGB'))
+        masks = build_color_key_masks(keyImage, palette)
+        colorKeyMaskCache.Put(key, masks)
+
+    # new float tensor every time, callers are free to modify it
+    return masks.float()
+
+
+# TODO: this is probably nto the best place for this, but w/e, good enough for now.
+#   doesnt support multiple weighted promtps yet, not automatically. prompts using the same mask share one copy of it
+#   through the hallucinators mask store, see MaskStore.py
+def CreateGenerationCommandListForMaskablePrompts(genJob:GenerateJob.GenerationJob, spatialPromptConfig:GenerateJob.SpatialPromptConfig) -> List[GenerationCommands.AddTextPromptWithMask]:
     all_prompts=[]
     blindfolds=[]
     for i,(color_key,blind,prompt) in enumerate(spatialPromptConfig.spatial_prompts):
@@ -124,40 +185,15 @@ def CreateGenerationCommandListForMaskablePrompts(genJob:GenerateJob.GenerationJ
 
         all_prompts.append(prompt)
         blindfolds.append(blind)
-        color_to_prompt_idx[color_key] = i
-    
-    color_to_prompt_idx_orig = dict(color_to_prompt_idx)
-
-    #init the masks
-    prompt_masks = torch.FloatTensor(
-        len(spatialPromptConfig.spatial_prompts),
-        1, #color channel
-        prompt_key_image.shape[0],
-        prompt_key_image.shape[1]).fill_(0)
-
-    #go pixel by pixel and assign it to one mask, based on closest color
-    for y in range(prompt_key_image.shape[0]):
-        for x in range(prompt_key_image.shape[1]):
-            key_color = tuple(prompt_key_image[y,x])
-
-            if key_color not in color_to_prompt_idx:
-                min_dist=999999
-                best_idx=-1
-                for color,idx in color_to_prompt_idx_orig.items():
-                    dist = abs(color[0]-key_color[0])+abs(color[1]-key_color[1])+abs(color[2]-key_color[2])
-                    #print('{} - {} = {}'.format(color,key_color,dist))
-                    if dist<min_dist:
-                        min_dist = dist
-                        best_idx=idx
-                color_to_prompt_idx[key_color]=best_idx #store so we don't need to compare again
-                idx = best_idx
-            else:
-                idx = color_to_prompt_idx[key_color]
-
-            prompt_masks[idx,0,y,x]=1
+
+    #one mask per prompt, each pixel assigned to one mask based on closest color
+    palette = [ color_key for color_key,_,_ in spatialPromptConfig.spatial_prompts ]
+    prompt_masks = get_color_key_masks(spatialPromptConfig.prompt_key_image, palette)
 
     #prompt_masks = prompt_masks.to(self.vqganDevice)
 
+    genJob.spatial_pair_filter = spatialPromptConfig.pair_filter
+
     #todo, create prompt mod things here
     modList:List[GenerationCommands.AddTextPromptWithMask] = []
     maskIdx: int = 0
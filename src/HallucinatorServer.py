@@ -0,0 +1,414 @@
+import argparse
+import collections
+import json
+import queue
+import threading
+import time
+import traceback
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+from src import CmdLineArgs
+from src import GenerateJob
+from src import Hallucinator
+from src import HallucinatorHelpers
+from src import JobScheduler
+
+
+###########################################
+#
+# long lived local server that owns one initialized Hallucinator, so models only get loaded once
+# instead of every time a generate script is launched ( ie, from the discord bot )
+#
+# API, json in and out:
+#   POST /jobs         body is a job spec, same keys as the json configs / CmdLineArgs dest names
+#                      ( prompts, size, max_iterations, cut_method, ... ), can also contain load_json
+#                      to start from a config in cmdConfigs/. 'user' and 'priority' set how the job gets
+#                      scheduled against other jobs, see JobScheduler.py. returns the job id
+#   GET  /jobs         status of every job
+#   GET  /jobs/<id>    status of one job, includes the output path once its done
+#   GET  /jobs/<id>/result      the finished image as a png, 409 while the job isnt finished
+#   POST /jobs/<id>/cancel      cancels a queued or running job, a running job stops before its next step
+#
+###########################################
+
+
+# these are owned by the server's Hallucinator, a job spec cant change them
+SERVER_ONLY_ARGS = [ 'clip_model', 'vqgan_config', 'vqgan_checkpoint', 'use_mixed_precision', 'clip_cpu', 'cuda_device',
+                     'anomaly_checker', 'log_clip', 'log_clip_oneshot', 'log_mem', 'display_freq',
+                     'vq_memory_budget', 'vq_approx_lists', 'vq_approx_probes', 'server_host', 'server_port', 'server_quantum', 'server_job_history',
+                     'text_cache_mb', 'text_cache_dir', 'text_disk_cache_mb', 'image_cache_mb', 'save_workers', 'save_queue', 'metrics_flush_freq', 'clip_encode_budget', 'cutout_chunk_size',
+                     'save_json', 'save_json_strip_defaults', 'save_json_strip_misc', 'convert_to_json_cmd' ]
+
+
+class JobSpecError(Exception):
+    pass
+
+
+class ServerJobRecord:
+    def __init__(self, jobId:str, spec:dict, args:argparse.Namespace, user:str = 'default', priority:int = 0):
+        self.jobId = jobId
+        self.spec = spec
+        self.args = args
+        self.user = user
+        self.priority = priority
+
+        self.status = 'queued' # queued, running, finished, failed, cancelled
+        self.cancelRequested = False
+        self.error:str = None
+        self.outputPath:str = None
+        self.genJob:GenerateJob.GenerationJob = None
+        self.scheduledJob:JobScheduler.ScheduledJob = None
+
+        self.submitTime = time.time()
+        self.startTime:float = None
+        self.finishTime:float = None
+
+    def ToDict(self) -> dict:
+        ret = { 'id': self.jobId, 'status': self.status, 'outputPath': self.outputPath, 'error': self.error, 'user': self.user,
+                'priority': self.priority, 'submitTime': self.submitTime, 'startTime': self.startTime, 'finishTime': self.finishTime }
+
+        if self.genJob is not None:
+            ret['iteration'] = self.genJob.currentIteration
+            ret['totalIterations'] = self.genJob.totalIterations
+
+        if self.scheduledJob is not None:
+            ret['schedulerStats'] = self.scheduledJob.GetStats()
+
+        return ret
+
+
+
+class HallucinatorServer:
+    def __init__(self, hallucinatorInst:Hallucinator.Hallucinator, serverArgs:argparse.Namespace):
+        self.hallucinatorInst = hallucinatorInst
+        self.serverArgs = serverArgs
+        self.parser = CmdLineArgs.build_parser()
+
+        self.jobs: Dict[str, ServerJobRecord] = {}
+        self.doneJobIds: collections.deque = collections.deque() # finished, failed and cancelled jobs, oldest first. evicted from jobs past server_job_history
+        self.jobsLock = threading.Lock()
+        self.jobQueue: queue.Queue = queue.Queue() # submitted jobs waiting to be created and handed to the scheduler
+        self.scheduler = JobScheduler.JobScheduler(hallucinatorInst, quantum=serverArgs.server_quantum, finishedHistory=serverArgs.server_job_history)
+
+        self.httpServer: ThreadingHTTPServer = None
+        self.workerThread: threading.Thread = None
+        self.running = False
+
+
+    ##################
+    ## Job specs
+    ##################
+
+    # turns a job spec dict into the same args namespace the command line would produce
+    def CreateArgsFromSpec(self, spec:dict, jobId:str) -> argparse.Namespace:
+        if not isinstance(spec, dict):
+            raise JobSpecError("job spec must be a json object")
+
+        spec = dict(spec)
+        jobArgs = vars(self.parser.parse_args([]))
+
+        # start from a config file, like --load_json does
+        configPath = spec.pop('load_json', None)
+        if configPath:
+            with open(configPath, 'rt') as f:
+                spec = { **json.load(f), **spec }
+
+        for key, val in spec.items():
+            if key not in jobArgs:
+                raise JobSpecError("unknown job spec option: " + str(key))
+
+            if key in SERVER_ONLY_ARGS and val != getattr(self.serverArgs, key):
+                raise JobSpecError("option is fixed by the server and cant be changed per job: " + str(key))
+
+            jobArgs[key] = val
+
+        # keep jobs from overwriting each others output unless they ask for a directory
+        if 'output_dir' not in spec:
+            jobArgs['output_dir'] = GenerateJob.build_filename_path(self.serverArgs.output_dir, jobId + '/')
+
+        # server only settings always come from the server
+        for key in SERVER_ONLY_ARGS:
+            jobArgs[key] = getattr(self.serverArgs, key)
+
+        args = argparse.Namespace(**jobArgs)
+        CmdLineArgs.apply_runtime_defaults(args)
+        return args
+
+
+    def SubmitJob(self, spec:dict) -> ServerJobRecord:
+        jobId = uuid.uuid4().hex[:12]
+
+        if not isinstance(spec, dict):
+            raise JobSpecError("job spec must be a json object")
+
+        spec = dict(spec)
+        user = str(spec.pop('user', 'default'))
+        try:
+            priority = int(spec.pop('priority', 0))
+        except (TypeError, ValueError):
+            raise JobSpecError("priority must be an integer")
+
+        args = self.CreateArgsFromSpec(spec, jobId)
+
+        record = ServerJobRecord(jobId, spec, args, user, priority)
+        with self.jobsLock:
+            self.jobs[jobId] = record
+
+        self.jobQueue.put(record)
+        print("server: queued job " + jobId)
+        return record
+
+
+    def GetJobStatus(self, jobId:str) -> dict:
+        with self.jobsLock:
+            record = self.jobs.get(jobId)
+        if record is None:
+            return None
+        return record.ToDict()
+
+
+    def GetAllJobStatus(self) -> List[dict]:
+        with self.jobsLock:
+            records = list(self.jobs.values())
+        return [ record.ToDict() for record in records ]
+
+
+    # path of the finished image, None if the job isnt finished
+    def GetJobResultPath(self, jobId:str) -> str:
+        with self.jobsLock:
+            record = self.jobs.get(jobId)
+        if record is None or record.status != 'finished':
+            return None
+        return record.outputPath
+
+
+    # returns false if theres no such job, or its already done
+    def CancelJob(self, jobId:str) -> bool:
+        scheduledJob = None
+        with self.jobsLock:
+            record = self.jobs.get(jobId)
+            if record is None or record.status not in ['queued', 'running']:
+                return False
+
+            record.cancelRequested = True
+            if record.status == 'queued':
+                # StartJob skips it when the worker gets to it
+                self.SetJobDone(record, 'cancelled')
+            else:
+                # if the job is still being created this is None, and StartJob cancels it once its submitted
+                scheduledJob = record.scheduledJob
+
+        if scheduledJob is not None:
+            self.scheduler.Cancel(scheduledJob)
+
+        print("server: cancelling job " + jobId)
+        return True
+
+
+    ##################
+    ## Processing
+    ##################
+
+    # creates the generation job and hands it to the scheduler. runs on the worker thread, since creating a job
+    # still uses the vqgan ( the starting image gets encoded ). its prompts, image prompts too, get embedded on its first step
+    def StartJob(self, record:ServerJobRecord):
+        with self.jobsLock:
+            if record.status == 'cancelled':
+                return
+            record.status = 'running'
+            record.startTime = time.time()
+        print("server: starting job " + record.jobId)
+
+        try:
+            record.genJob = HallucinatorHelpers.CreateGenerationJobFromArgParse( self.hallucinatorInst, record.args )
+        except Exception as e:
+            traceback.print_exc()
+            self.OnJobFailed(record, str(e))
+            return
+
+        record.scheduledJob = self.scheduler.Submit( record.genJob, record.user, record.priority, 
+                                                     lambda scheduledJob: self.OnJobFinished(record), record.submitTime )
+
+        # cancelled while the job was being created
+        with self.jobsLock:
+            cancelRequested = record.cancelRequested
+        if cancelRequested:
+            self.scheduler.Cancel(record.scheduledJob)
+
+
+    def OnJobFinished(self, record:ServerJobRecord):
+        if record.scheduledJob.error is not None:
+            self.OnJobFailed(record, record.scheduledJob.error)
+            return
+
+        if record.scheduledJob.cancelled:
+            with self.jobsLock:
+                self.SetJobDone(record, 'cancelled')
+            print("server: job " + record.jobId + " cancelled after " + str(record.scheduledJob.stepsDone) + " steps")
+            return
+
+        # saving is slow, dont hold the lock for it
+        try:
+            record.genJob.SaveCurrentImage()
+        except Exception as e:
+            traceback.print_exc()
+            self.OnJobFailed(record, str(e))
+            return
+
+        with self.jobsLock:
+            record.outputPath = GenerateJob.build_filename_path( record.genJob.outputDir, record.genJob.outputFilename )
+            self.SetJobDone(record, 'finished')
+
+        print("server: job " + record.jobId + " finished, waited " + f"{record.scheduledJob.QueueWaitTime():.2f}" + "s, " 
+              + f"{record.scheduledJob.StepsPerSecActive():.2f}" + " steps/sec")
+
+
+    def OnJobFailed(self, record:ServerJobRecord, error:str):
+        with self.jobsLock:
+            record.error = error
+            self.SetJobDone(record, 'failed')
+        print("server: job " + record.jobId + " failed: " + error)
+
+
+    # moves a job to one of the done states, and evicts the oldest done jobs past server_job_history. call with jobsLock held
+    def SetJobDone(self, record:ServerJobRecord, status:str):
+        record.status = status
+        record.finishTime = time.time()
+
+        self.doneJobIds.append(record.jobId)
+        if self.serverArgs.server_job_history > 0:
+            while len(self.doneJobIds) > self.serverArgs.server_job_history:
+                self.jobs.pop(self.doneJobIds.popleft(), None)
+
+
+    def WorkerLoop(self):
+        while self.running:
+            # pick up any newly submitted jobs, then give the next job its time slice
+            while True:
+                try:
+                    record = self.jobQueue.get_nowait()
+                except queue.Empty:
+                    break
+                self.StartJob(record)
+
+            if not self.scheduler.RunSlice():
+                try:
+                    record = self.jobQueue.get(timeout=0.5)
+                    self.StartJob(record)
+                except queue.Empty:
+                    pass
+
+
+    ##################
+    ## Life cycle
+    ##################
+
+    def Start(self, host:str = None, port:int = None):
+        host = host if host is not None else self.serverArgs.server_host
+        port = port if port is not None else self.serverArgs.server_port
+
+        self.running = True
+        self.workerThread = threading.Thread(target=self.WorkerLoop, name='hallucinator-worker', daemon=True)
+        self.workerThread.start()
+
+        self.httpServer = ThreadingHTTPServer((host, port), CreateRequestHandler(self))
+        print("server: listening on http://" + str(host) + ":" + str(self.httpServer.server_address[1]))
+
+
+    def ServeForever(self):
+        try:
+            self.httpServer.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.Stop()
+
+
+    def Stop(self):
+        self.running = False
+        if self.httpServer is not None:
+            self.httpServer.server_close()
+
+
+
+def CreateRequestHandler(server:HallucinatorServer):
+
+    class HallucinatorRequestHandler(BaseHTTPRequestHandler):
+
+        def SendJson(self, code:int, obj):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            parts = [ part for part in self.path.split('/') if part ]
+
+            if parts == ['jobs']:
+                self.SendJson(200, server.GetAllJobStatus())
+            elif len(parts) == 2 and parts[0] == 'jobs':
+                status = server.GetJobStatus(parts[1])
+                if status is None:
+                    self.SendJson(404, { 'error': 'unknown job id' })
+                else:
+                    self.SendJson(200, status)
+            elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'result':
+                self.SendResult(parts[1])
+            else:
+                self.SendJson(404, { 'error': 'not found' })
+
+        def SendResult(self, jobId:str):
+            status = server.GetJobStatus(jobId)
+            if status is None:
+                self.SendJson(404, { 'error': 'unknown job id' })
+                return
+
+            resultPath = server.GetJobResultPath(jobId)
+            if resultPath is None:
+                self.SendJson(409, { 'error': 'job is ' + status['status'] + ', not finished', 'status': status['status'] })
+                return
+
+            try:
+                with open(resultPath, 'rb') as f:
+                    body = f.read()
+            except OSError as e:
+                self.SendJson(500, { 'error': str(e) })
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            parts = [ part for part in self.path.split('/') if part ]
+
+            if len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'cancel':
+                if server.GetJobStatus(parts[1]) is None:
+                    self.SendJson(404, { 'error': 'unknown job id' })
+                elif not server.CancelJob(parts[1]):
+                    self.SendJson(409, { 'error': 'job is already done', 'status': server.GetJobStatus(parts[1])['status'] })
+                else:
+                    self.SendJson(200, server.GetJobStatus(parts[1]))
+                return
+
+            if parts != ['jobs']:
+                self.SendJson(404, { 'error': 'not found' })
+                return
+
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                spec = json.loads(self.rfile.read(length) or b'{}')
+                record = server.SubmitJob(spec)
+            except (JobSpecError, ValueError, OSError) as e:
+                self.SendJson(400, { 'error': str(e) })
+                return
+
+            self.SendJson(200, record.ToDict())
+
+    return HallucinatorRequestHandler
@@ -1,6 +1,7 @@
 import numpy as np
 from PIL import Image
 import math
+import functools
 
 import torch
 from torch import nn
@@ -77,13 +78,25 @@ def lanczos(x, a):
 
 def ramp(ratio, width):
     n = math.ceil(width / ratio + 1)
-    out = torch.empty([n])
-    cur = 0
-    for i in range(out.shape[0]):
-        out[i] = cur
-        cur += ratio
+    out = (torch.arange(n, dtype=torch.float64) * ratio).float()
     return torch.cat([-out[1:].flip([0]), out])[1:-1]
 
+
+# resample gets called for every cutout / mask crop with a new size ratio, so the kernels are cached.
+# ratios are snapped to steps of 1/LANCZOS_RATIO_STEPS so nearby ratios share a kernel, least recently used get dropped
+LANCZOS_RATIO_STEPS = 1024
+LANCZOS_CACHE_SIZE = 1024 # kernels are a few dozen floats each
+
+@functools.lru_cache(maxsize=LANCZOS_CACHE_SIZE)
+def build_lanczos_kernel(quantizedRatio:float, a:int, device:torch.device, dtype:torch.dtype) -> torch.Tensor:
+    # cached tensors get reused outside of whatever mode we are called in, so they cant be inference tensors
+    with torch.inference_mode(False):
+        return lanczos(ramp(quantizedRatio, a), a).to(device, dtype)
+
+def get_lanczos_kernel(ratio:float, a:int, device, dtype) -> torch.Tensor:
+    quantizedRatio = max(1, round(ratio * LANCZOS_RATIO_STEPS)) / LANCZOS_RATIO_STEPS
+    return build_lanczos_kernel(quantizedRatio, a, torch.device(device), dtype)
+
 # Used in older MakeCutouts
 # resample is non-deterministic due to interpolate bicubic
 # F.pad is non determinsitic...
@@ -95,13 +108,13 @@ def resample(input: torch.Tensor, sizeYX, align_corners=True, deterministic = Fa
 
     if not deterministic:
         if dh < h:
-            kernel_h = lanczos(ramp(dh / h, 2), 2).to(input.device, input.dtype)
+            kernel_h = get_lanczos_kernel(dh / h, 2, input.device, input.dtype)
             pad_h = (kernel_h.shape[0] - 1) // 2
             input = F.pad(input, (0, 0, pad_h, pad_h), 'reflect')
             input = F.conv2d(input, kernel_h[None, None, :, None])
 
         if dw < w:
-            kernel_w = lanczos(ramp(dw / w, 2), 2).to(input.device, input.dtype)
+            kernel_w = get_lanczos_kernel(dw / w, 2, input.device, input.dtype)
             pad_w = (kernel_w.shape[0] - 1) // 2
             input = F.pad(input, (pad_w, pad_w, 0, 0), 'reflect')
             input = F.conv2d(input, kernel_w[None, None, None, :])
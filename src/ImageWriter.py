@@ -0,0 +1,104 @@
+import queue
+import threading
+from typing import Dict, List, Tuple
+
+import torch
+from torchvision.transforms import functional as TF
+
+
+####################################################
+# background image writer, so saving progress images doesnt stall the training loop
+#
+# the training thread only takes a snapshot of the image ( an async copy into pinned memory when on the gpu ),
+# worker threads wait for the copy, convert to PIL and do the png encode + write.
+# each worker has a bounded queue, if the workers fall behind the training thread blocks until there is room.
+# images going to the same path always go to the same worker, so writes to a path land in order
+####################################################
+
+class AsyncImageWriter:
+    def __init__(self, numWorkers:int = 2, maxQueueSize:int = 8):
+        self.numWorkers = max(1, numWorkers)
+        self.queues: List[queue.Queue] = [ queue.Queue(maxsize=max(1, maxQueueSize)) for _ in range(self.numWorkers) ]
+
+        # reusable pinned host buffers, allocating pinned memory every save is slow
+        self.pinnedBuffers: Dict[Tuple, List[torch.Tensor]] = {}
+        self.buffersLock = threading.Lock()
+
+        self.workers: List[threading.Thread] = []
+        for idx in range(self.numWorkers):
+            worker = threading.Thread(target=self.WorkerLoop, args=(self.queues[idx],), name='image-writer-' + str(idx), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+
+    def GetPinnedBuffer(self, shape, dtype) -> torch.Tensor:
+        with self.buffersLock:
+            free = self.pinnedBuffers.get((tuple(shape), dtype))
+            if free:
+                return free.pop()
+        return torch.empty(shape, dtype=dtype, pin_memory=True)
+
+
+    def ReturnPinnedBuffer(self, buffer:torch.Tensor):
+        with self.buffersLock:
+            self.pinnedBuffers.setdefault((tuple(buffer.shape), buffer.dtype), []).append(buffer)
+
+
+    # copies the first image of a batch off to the host without waiting for the gpu
+    def Snapshot(self, imgTensor:torch.Tensor):
+        with torch.inference_mode():
+            img = imgTensor[0].detach()
+
+            if img.is_cuda:
+                hostImg = self.GetPinnedBuffer(img.shape, img.dtype)
+                hostImg.copy_(img, non_blocking=True)
+                copyDone = torch.cuda.Event()
+                copyDone.record()
+                return hostImg, copyDone, True
+
+            return img.clone(), None, False
+
+
+    # queues an image tensor ( 1 x c x h x w ) to be written to path, blocks if that workers queue is full
+    def SubmitTensor(self, imgTensor:torch.Tensor, path:str, info = None):
+        hostImg, copyDone, pinned = self.Snapshot(imgTensor)
+        self.queues[hash(path) % self.numWorkers].put( (hostImg, copyDone, pinned, path, info) )
+
+
+    def WorkerLoop(self, workQueue:queue.Queue):
+        while True:
+            item = workQueue.get()
+            if item is None:
+                workQueue.task_done()
+                return
+
+            hostImg, copyDone, pinned, path, info = item
+            try:
+                if copyDone is not None:
+                    copyDone.synchronize()
+
+                pilImage = TF.to_pil_image(hostImg)
+                if info == None:
+                    pilImage.save(path)
+                else:
+                    pilImage.save(path, pnginfo=info)
+            except Exception as e:
+                print("image writer: failed to write " + str(path) + ", " + str(e))
+            finally:
+                if pinned:
+                    self.ReturnPinnedBuffer(hostImg)
+                workQueue.task_done()
+
+
+    # blocks until everything queued so far is written
+    def Flush(self):
+        for workQueue in self.queues:
+            workQueue.join()
+
+
+    def Shutdown(self):
+        self.Flush()
+        for workQueue in self.queues:
+            workQueue.put(None)
+        for worker in self.workers:
+            worker.join()
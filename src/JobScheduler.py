@@ -0,0 +1,207 @@
+import collections
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List
+
+from src import GenerateJob
+
+
+####################################################
+# time sliced scheduler over Hallucinator.ProcessJobStep
+#
+# instead of running one job to completion, every active job gets a slice of 'quantum' steps in turn,
+# so a short request doesnt wait behind a 1600 iteration animation.
+#   - higher priority jobs always run before lower priority ones
+#   - within a priority, the user that has had the fewest steps goes next, so one user queueing
+#     lots of jobs doesnt crowd everyone else out
+#   - a users jobs take turns round robin
+#   - jobs can be cancelled from any thread, they stop before their next step
+# bigger quantum = better throughput for long jobs, smaller = lower latency for short ones
+####################################################
+
+class ScheduledJob:
+    def __init__(self, genJob:GenerateJob.GenerationJob, user:str, priority:int, onFinished:Callable = None, submitTime:float = None):
+        self.genJob = genJob
+        self.user = user
+        self.priority = priority
+        self.onFinished = onFinished # called with this ScheduledJob once the job is done or failed
+
+        self.submitTime = submitTime if submitTime is not None else time.time()
+        self.firstStepTime:float = None
+        self.lastRunTime:float = 0
+        self.finishTime:float = None
+
+        self.stepsDone = 0
+        self.activeTime = 0.0 # time spent actually stepping this job
+        self.finished = False
+        self.error:str = None
+        self.cancelRequested = False # set by JobScheduler.Cancel, the job stops at its next step
+        self.cancelled = False
+
+    # time from being submitted to getting its first step
+    def QueueWaitTime(self) -> float:
+        start = self.firstStepTime if self.firstStepTime is not None else time.time()
+        return start - self.submitTime
+
+    # steps/sec while this job was being stepped
+    def StepsPerSecActive(self) -> float:
+        return self.stepsDone / self.activeTime if self.activeTime > 0 else 0.0
+
+    # steps/sec from its first step till now / till it finished, includes time other jobs had the gpu
+    def StepsPerSecWall(self) -> float:
+        if self.firstStepTime is None:
+            return 0.0
+        end = self.finishTime if self.finishTime is not None else time.time()
+        return self.stepsDone / (end - self.firstStepTime) if end > self.firstStepTime else 0.0
+
+    def GetStats(self) -> dict:
+        return { 'user': self.user, 'priority': self.priority, 'stepsDone': self.stepsDone, 'totalSteps': self.genJob.totalIterations,
+                 'queueWaitTime': self.QueueWaitTime(), 'stepsPerSecActive': self.StepsPerSecActive(),
+                 'stepsPerSecWall': self.StepsPerSecWall(), 'finished': self.finished, 'error': self.error, 'cancelled': self.cancelled }
+
+
+
+class JobScheduler:
+    # finishedHistory is how many finished jobs are kept around for GetStats, 0 keeps them all
+    def __init__(self, hallucinatorInst, quantum:int = 10, trainCallbackFunc = None, finishedHistory:int = 100):
+        self.hallucinatorInst = hallucinatorInst
+        self.quantum = max(1, quantum)
+        self.trainCallbackFunc = trainCallbackFunc
+
+        self.activeJobs: List[ScheduledJob] = []
+        self.finishedJobs: collections.deque = collections.deque(maxlen=finishedHistory if finishedHistory > 0 else None) # oldest first, the oldest drop off when its full
+        self.userStepsServed: Dict[str, int] = {} # per user step counts, used for fairness
+
+        self.lock = threading.Lock()
+        self.workAvailable = threading.Condition(self.lock)
+
+
+    # submitTime can be passed in if the job was already waiting somewhere else, so queue wait times include that
+    def Submit(self, genJob:GenerateJob.GenerationJob, user:str = 'default', priority:int = 0, onFinished:Callable = None, submitTime:float = None) -> ScheduledJob:
+        scheduledJob = ScheduledJob(genJob, user, priority, onFinished, submitTime)
+
+        with self.lock:
+            # a user coming back after being idle starts level with the least served active user,
+            # instead of getting to run alone until their old step count catches up
+            if not any(job.user == user for job in self.activeJobs):
+                activeServed = [ self.userStepsServed.get(job.user, 0) for job in self.activeJobs ]
+                floor = min(activeServed) if activeServed else 0
+                self.userStepsServed[user] = max(self.userStepsServed.get(user, 0), floor)
+
+            self.activeJobs.append(scheduledJob)
+            self.workAvailable.notify_all()
+
+        return scheduledJob
+
+
+    # stops a job before its next step, it finishes as cancelled and onFinished still gets called. safe from any thread
+    def Cancel(self, scheduledJob:ScheduledJob):
+        with self.lock:
+            scheduledJob.cancelRequested = True
+            self.workAvailable.notify_all()
+
+
+    def HasWork(self) -> bool:
+        with self.lock:
+            return len(self.activeJobs) > 0
+
+
+    def WaitForWork(self, timeout:float = None) -> bool:
+        with self.lock:
+            if not self.activeJobs:
+                self.workAvailable.wait(timeout)
+            return len(self.activeJobs) > 0
+
+
+    def PickNextJob(self) -> ScheduledJob:
+        with self.lock:
+            if not self.activeJobs:
+                return None
+
+            # cancelled jobs dont take any steps, get them out of the way first
+            for job in self.activeJobs:
+                if job.cancelRequested:
+                    return job
+
+            topPriority = max(job.priority for job in self.activeJobs)
+            candidates = [ job for job in self.activeJobs if job.priority == topPriority ]
+
+            # least served user first, then the job of theirs that ran longest ago. min() keeps submit order on ties
+            return min(candidates, key=lambda job: (self.userStepsServed.get(job.user, 0), job.lastRunTime))
+
+
+    # runs one time slice of up to quantum steps on the next job, returns false if there was nothing to run
+    def RunSlice(self) -> bool:
+        scheduledJob = self.PickNextJob()
+        if scheduledJob is None:
+            return False
+
+        if scheduledJob.firstStepTime is None:
+            scheduledJob.firstStepTime = time.time()
+
+        sliceStart = time.time()
+        stepsThisSlice = 0
+        moreWork = True
+
+        try:
+            while moreWork and stepsThisSlice < self.quantum and not scheduledJob.cancelRequested:
+                moreWork = self.hallucinatorInst.ProcessJobStep(scheduledJob.genJob, self.trainCallbackFunc)
+                stepsThisSlice += 1
+        except Exception as e:
+            traceback.print_exc()
+            scheduledJob.error = str(e)
+            moreWork = False
+        finally:
+            if moreWork and scheduledJob.cancelRequested:
+                scheduledJob.cancelled = True
+                moreWork = False
+
+            # a failed or cancelled job never gets to OnFinishGeneration, so its masks and queued images would be left behind
+            if scheduledJob.error is not None or scheduledJob.cancelled:
+                self.ReleaseJob(scheduledJob)
+
+        now = time.time()
+        scheduledJob.activeTime += now - sliceStart
+        scheduledJob.lastRunTime = now
+        scheduledJob.stepsDone += stepsThisSlice
+
+        with self.lock:
+            self.userStepsServed[scheduledJob.user] = self.userStepsServed.get(scheduledJob.user, 0) + stepsThisSlice
+
+            if not moreWork:
+                scheduledJob.finished = True
+                scheduledJob.finishTime = now
+                self.activeJobs.remove(scheduledJob)
+                self.finishedJobs.append(scheduledJob)
+
+        if not moreWork and scheduledJob.onFinished is not None:
+            scheduledJob.onFinished(scheduledJob)
+
+        return True
+
+
+    # releases a job that didnt finish normally. its already failed, so a second error here only gets printed
+    def ReleaseJob(self, scheduledJob:ScheduledJob):
+        try:
+            scheduledJob.genJob.ReleaseResources()
+        except Exception:
+            traceback.print_exc()
+
+
+    def RunUntilEmpty(self):
+        while self.RunSlice():
+            pass
+
+
+    def GetStats(self) -> List[dict]:
+        with self.lock:
+            jobs = self.activeJobs + list(self.finishedJobs)
+        return [ job.GetStats() for job in jobs ]
+
+
+    def PrintStats(self):
+        print("user, priority, steps, queue wait (s), steps/sec active, steps/sec wall")
+        for stats in self.GetStats():
+            print(stats['user'] + ", " + str(stats['priority']) + ", " + str(stats['stepsDone']) + "/" + str(stats['totalSteps']) + ", "
+                  + f"{stats['queueWaitTime']:.2f}, {stats['stepsPerSecActive']:.2f}, {stats['stepsPerSecWall']:.2f}")
@@ -0,0 +1,190 @@
+from collections import deque
+from typing import List
+
+import torch
+
+
+####################################################
+# loss bookkeeping that doesnt sync with the gpu every step
+#
+# every .item() on a loss waits for the gpu to catch up, which stops the cpu from queueing up the next step.
+# instead the per step losses get written into a small buffer on the device, and read back all at once
+# every flushFreq steps. save_best keeps the best image on the device too ( a torch.where per step ), so
+# it only needs to be looked at when the buffer gets read back
+####################################################
+
+
+# the host side values from one read back of the buffer
+class FlushedLosses:
+    def __init__(self, iterations:List[int], lossSums:List[float], lossAvgs:List[float], bestLoss:float = None, bestIteration:int = None, newBest:bool = False):
+        self.iterations = iterations
+        self.lossSums = lossSums
+        self.lossAvgs = lossAvgs
+        self.bestLoss = bestLoss # best average loss seen so far, if tracking the best image
+        self.bestIteration = bestIteration
+        self.newBest = newBest # true if the best image changed since the last read back
+
+
+
+class DeferredLossMetrics:
+    def __init__(self, flushFreq:int = 10, trackBest:bool = False):
+        self.flushFreq = max(1, flushFreq)
+        self.trackBest = trackBest
+
+        self.lossBuffer: torch.Tensor = None # flushFreq x 2, loss sum and average loss per step. created on the losses device
+        self.iterations: List[int] = [] # iterations in the buffer, in slot order
+
+        self.bestLoss: torch.Tensor = None
+        self.bestIteration: torch.Tensor = None
+        self.bestImage: torch.Tensor = None
+        self.lastBestIteration = -1 # best iteration as of the last read back
+
+        self.lastFlushed: FlushedLosses = None
+
+
+    # store one steps losses, doesnt sync
+    @torch.inference_mode()
+    def Record(self, iteration:int, curImg:torch.Tensor, lossAll, lossSum:torch.Tensor):
+        lossSum = lossSum.detach().float().reshape(())
+        lossAvg = lossSum / len(lossAll)
+
+        if self.lossBuffer is None or self.lossBuffer.device != lossSum.device:
+            self.lossBuffer = torch.zeros((self.flushFreq, 2), device=lossSum.device)
+
+        slot = len(self.iterations)
+        self.lossBuffer[slot, 0] = lossSum
+        self.lossBuffer[slot, 1] = lossAvg
+        self.iterations.append(iteration)
+
+        if self.trackBest:
+            self.UpdateBest(iteration, curImg, lossAvg)
+
+
+    def UpdateBest(self, iteration:int, curImg:torch.Tensor, lossAvg:torch.Tensor):
+        curImg = curImg.detach()
+
+        if self.bestLoss is None:
+            self.bestLoss = torch.full((), float('inf'), device=lossAvg.device)
+            self.bestIteration = torch.full((), -1, dtype=torch.long, device=lossAvg.device)
+
+        # the image can change size between steps ( ie, a command resets the job ), restart tracking if so
+        if self.bestImage is None or self.bestImage.shape != curImg.shape:
+            self.bestImage = curImg.clone()
+            self.bestLoss.fill_(float('inf'))
+
+        isBetter = lossAvg < self.bestLoss
+        self.bestLoss = torch.minimum(self.bestLoss, lossAvg)
+        self.bestIteration.masked_fill_(isBetter, iteration)
+        self.bestImage.copy_( torch.where(isBetter.to(curImg.device), curImg, self.bestImage) )
+
+
+    def NeedsFlush(self) -> bool:
+        return len(self.iterations) >= self.flushFreq
+
+
+    # reads everything recorded since the last flush back to the host in one go, returns None if theres nothing new
+    @torch.inference_mode()
+    def Flush(self) -> FlushedLosses:
+        count = len(self.iterations)
+        if count == 0:
+            return None
+
+        readback = self.lossBuffer[:count].flatten()
+        if self.trackBest:
+            readback = torch.cat([ readback, self.bestLoss.view(1), self.bestIteration.view(1).to(readback.dtype) ])
+
+        values = readback.tolist()
+
+        flushed = FlushedLosses(self.iterations, values[0:count*2:2], values[1:count*2:2])
+        if self.trackBest:
+            flushed.bestLoss = values[-2]
+            flushed.bestIteration = int(values[-1])
+            flushed.newBest = flushed.bestIteration != self.lastBestIteration
+            self.lastBestIteration = flushed.bestIteration
+
+        self.iterations = []
+        self.lastFlushed = flushed
+        return flushed
+
+
+
+####################################################
+# mean, min and slope of the last windowSize values, O(1) per value and fixed memory
+#   - mean from a running sum
+#   - min from a monotonic deque, the front is always the min of the window
+#   - slope is the least squares fit over the window, from running sums of y and x*y.
+#     x is the absolute index of the value, the x only sums have closed forms
+# the running sums get recomputed every time the window wraps around so float error cant build up
+####################################################
+
+class RollingStats:
+    def __init__(self, windowSize:int = 100):
+        self.windowSize = max(1, windowSize)
+        self.values: List[float] = [0.0] * self.windowSize
+        self.count = 0 # total values ever added, the next values index
+        self.sumY = 0.0
+        self.sumXY = 0.0
+        self.minDeque: deque = deque() # (index, value), values increasing front to back
+
+    def Add(self, value:float):
+        value = float(value)
+        idx = self.count
+        slot = idx % self.windowSize
+
+        if idx >= self.windowSize:
+            oldValue = self.values[slot]
+            self.sumY -= oldValue
+            self.sumXY -= (idx - self.windowSize) * oldValue
+
+        self.values[slot] = value
+        self.sumY += value
+        self.sumXY += idx * value
+        self.count += 1
+
+        while self.minDeque and self.minDeque[-1][1] >= value:
+            self.minDeque.pop()
+        self.minDeque.append((idx, value))
+        while self.minDeque[0][0] <= idx - self.windowSize:
+            self.minDeque.popleft()
+
+        if slot == self.windowSize - 1:
+            self.Recompute()
+
+    def Recompute(self):
+        start = self.WindowStart()
+        self.sumY = 0.0
+        self.sumXY = 0.0
+        for idx in range(start, self.count):
+            value = self.values[idx % self.windowSize]
+            self.sumY += value
+            self.sumXY += idx * value
+
+    def WindowStart(self) -> int:
+        return max(0, self.count - self.windowSize)
+
+    def Size(self) -> int:
+        return min(self.count, self.windowSize)
+
+    def IsFull(self) -> bool:
+        return self.count >= self.windowSize
+
+    def Mean(self) -> float:
+        n = self.Size()
+        return self.sumY / n if n > 0 else float('nan')
+
+    def Min(self) -> float:
+        return self.minDeque[0][1] if self.minDeque else float('nan')
+
+    # change per value of the least squares line through the window, negative means the loss is still going down
+    def Slope(self) -> float:
+        n = self.Size()
+        if n < 2:
+            return 0.0
+
+        # shift x so the window starts at 0, keeps the numbers small
+        start = self.WindowStart()
+        sumX = n * (n - 1) / 2
+        sumXX = (n - 1) * n * (2 * n - 1) / 6
+        sumXY = self.sumXY - start * self.sumY
+
+        return (n * sumXY - sumX * self.sumY) / (n * sumXX - sumX * sumX)
@@ -1,5 +1,6 @@
-from typing import List
+from typing import Dict, List, Tuple
 from src import ImageUtils
+from src import FusedAugments
 
 import torch
 from torch.cuda.amp import autocast
@@ -10,6 +11,7 @@ from torch.cuda.amp import custom_bwd
 
 import kornia.augmentation as K
 import torchvision.transforms as TT
+from torchvision.ops import roi_align
 
 # hack to manage mixed_precision
 # set from generate based on cmd args
@@ -36,8 +38,89 @@ class ClampWithGrad(torch.autograd.Function):
 clamp_with_grad = ClampWithGrad.apply
 
 
+####################################################
+# size bucketing for the resample based cut methods
+#
+# random cut sizes mean one resample call per cut. snapping sizes to a few buckets means lots of cuts share a size,
+# and all the crops of one size get resampled in one call. fewer buckets = faster, more = closer to the original sizes
+####################################################
+
+# splits [minSize, maxSize] into numBuckets equal ranges and moves each size to the middle of its range. 0 buckets leaves sizes alone
+def snap_to_size_buckets(sizes:torch.Tensor, minSize:int, maxSize:int, numBuckets:int) -> torch.Tensor:
+    if numBuckets <= 0 or maxSize <= minSize:
+        return sizes
+
+    width = (maxSize - minSize) / numBuckets
+    bucket = ((sizes - minSize) / width).long().clamp(0, numBuckets - 1)
+    return (minSize + (bucket + 0.5) * width).round().long()
+
+
+# resamples every crop to sizeYX, one resample call per distinct crop size, and puts the results back in cut order.
+# cutCoords is a list of [x1, x2, y1, y2] like cutout_coords
+def resample_cutouts_grouped(input:torch.Tensor, cutCoords:list, sizeYX, deterministic = False) -> torch.Tensor:
+    groups: Dict[Tuple[int, int], List[int]] = {}
+    for idx, (x1, x2, y1, y2) in enumerate(cutCoords):
+        groups.setdefault((y2 - y1, x2 - x1), []).append(idx)
+
+    results = []
+    order = []
+    for indices in groups.values():
+        crops = torch.cat([ input[:, :, y1:y2, x1:x2] for x1, x2, y1, y2 in [ cutCoords[idx] for idx in indices ] ])
+        results.append(ImageUtils.resample(crops, sizeYX, deterministic=deterministic))
+        order.extend(indices)
+
+    batch = torch.cat(results)
+    if len(groups) == 1:
+        return batch
+
+    # each cut is input.shape[0] rows of the batch
+    n = input.shape[0]
+    position = torch.empty(len(order), dtype=torch.long)
+    position[torch.tensor(order)] = torch.arange(len(order))
+    rows = (position[:, None] * n + torch.arange(n)[None, :]).flatten()
+    return batch.index_select(0, rows.to(batch.device))
+
+
+
+# pinned + non blocking so the copy doesnt stall the host
+def coords_to_device(cutCoords:torch.Tensor, device) -> torch.Tensor:
+    if device.type == 'cuda':
+        return cutCoords.pin_memory().to(device, non_blocking=True)
+    return cutCoords.to(device)
+
+
+# crops every mask to every cut and resizes to sizeYX in one roi_align call, for the spatial prompt masks.
+# masks is P x C x H x W, cutCoords a list or K x 4 tensor of [x1, x2, y1, y2] like cutout_coords.
+# roi_align averages several bilinear samples per output pixel when shrinking, so binary masks stay in [0, 1]
+# output is P x K x C x sizeY x sizeX
+def crop_masks_batched(masks:torch.Tensor, cutCoords, sizeYX) -> torch.Tensor:
+    p = masks.shape[0]
+    cutCoords = torch.as_tensor(cutCoords, dtype=torch.float32)
+    k = cutCoords.shape[0]
+
+    # aligned=True puts pixel i at [i, i+1), so the exclusive ends are the box edges
+    boxes = torch.stack([cutCoords[:, 0], cutCoords[:, 2], cutCoords[:, 1], cutCoords[:, 3]], dim=1)
+    batchIdx = torch.arange(p, dtype=torch.float32).repeat_interleave(k)
+    rois = torch.cat([batchIdx[:, None], boxes.repeat(p, 1)], dim=1).to(masks.dtype)
+    rois = coords_to_device(rois, masks.device)
+
+    crops = roi_align(masks, rois, output_size=(int(sizeYX[0]), int(sizeYX[1])), spatial_scale=1.0, sampling_ratio=-1, aligned=True)
+    return crops.view(p, k, *crops.shape[1:])
+
+
+
 # current defaults = 'Af', 'Pe', 'Ji', 'Er'
-def setupAugmentList(augmentNameList, cut_size_x, cut_size_y, use_kornia = True):
+def setupAugmentList(augmentNameList, cut_size_x, cut_size_y, use_kornia = True, use_fused = False):
+    # the fused engine does the augments it knows in one warp + one colour pass, see FusedAugments.py.
+    # anything it doesnt know still gets set up below, and runs after it
+    if use_fused and augmentNameList:
+        fused = FusedAugments.FusedAugments(augmentNameList[0])
+        otherNames = [ item for item in augmentNameList[0] if item not in FusedAugments.FUSED_AUGMENT_NAMES ]
+        print("Setting up cutMethod using fused augments: " + str(fused.augmentNames))
+        if not otherNames:
+            return nn.Sequential(fused)
+        return nn.Sequential(fused, *setupAugmentList([otherNames], cut_size_x, cut_size_y, use_kornia))
+
     # Pick your own augments & their order
     print("Setting up cutMethod using kornia augments: " + str( use_kornia ) )
     augment_list = []
@@ -126,7 +209,7 @@ def setupAugmentList(augmentNameList, cut_size_x, cut_size_y, use_kornia = True)
 ###################
 ##  string based switch statement 'factory'
 ###################
-def GetMakeCutouts( cutMethod:str, clipPerceptorInputResolution:int, cutNum:int, cutSize:List[int], cutPow:float, augmentNameList:list, use_kornia:bool = True ):
+def GetMakeCutouts( cutMethod:str, clipPerceptorInputResolution:int, cutNum:int, cutSize:List[int], cutPow:float, augmentNameList:list, use_kornia:bool = True, sizeBuckets:int = 0, use_fused:bool = False ):
     # Cutout class options:
     # 'squish', 'latest','original','updated' or 'updatedpooling'
     if cutMethod == 'latest':
@@ -142,9 +225,9 @@ def GetMakeCutouts( cutMethod:str, clipPerceptorInputResolution:int, cutNum:int,
     if clipPerceptorInputResolution != cutSize or clipPerceptorInputResolution != cutSize[0] or clipPerceptorInputResolution != cutSize[1]:
         cutsMatchClip = False
 
-    augs = setupAugmentList(augmentNameList, clipPerceptorInputResolution, clipPerceptorInputResolution, use_kornia)
+    augs = setupAugmentList(augmentNameList, clipPerceptorInputResolution, clipPerceptorInputResolution, use_kornia, use_fused)
 
-    print("Cutouts method: " + cutMethod + " using cutSize: " + str(cutSize) + '  Matches clipres: ' + str(cutsMatchClip))
+    print("Cutouts method: " + cutMethod + " using cutSize: " + str(cutSize) + '  Matches clipres: ' + str(cutsMatchClip) + '  size buckets: ' + str(sizeBuckets))
 
     # used for whatever test cut thing im doing
     make_cutouts:nn.Module = None
@@ -156,13 +239,13 @@ def GetMakeCutouts( cutMethod:str, clipPerceptorInputResolution:int, cutNum:int,
         make_cutouts = MakeCutoutsGrowFromCenter(clipPerceptorInputResolution, cutSize[0], cutSize[1], cutNum, cut_pow=cutPow, use_pool=True, augments=augs)    
 
     elif cutMethod == 'squish':        
-        make_cutouts = MakeCutoutsSquish(clipPerceptorInputResolution, cutSize[0], cutSize[1], cutNum, cut_pow=cutPow, use_pool=True, augments=augs)
+        make_cutouts = MakeCutoutsSquish(clipPerceptorInputResolution, cutSize[0], cutSize[1], cutNum, cut_pow=cutPow, use_pool=True, augments=augs, size_buckets=sizeBuckets)
     elif cutMethod == 'original':
-        make_cutouts = MakeCutoutsOrig(clipPerceptorInputResolution, cutNum, cut_pow=cutPow, augments=augs)
+        make_cutouts = MakeCutoutsOrig(clipPerceptorInputResolution, cutNum, cut_pow=cutPow, augments=augs, size_buckets=sizeBuckets)
     elif cutMethod == 'nerdy':
         make_cutouts = MakeCutoutsNerdy(clipPerceptorInputResolution, cutNum, cut_pow=cutPow, augments=augs)
     elif cutMethod == 'nerdyNoPool':
-        make_cutouts = MakeCutoutsNerdyNoPool(clipPerceptorInputResolution, cutNum, cut_pow=cutPow, augments=augs)
+        make_cutouts = MakeCutoutsNerdyNoPool(clipPerceptorInputResolution, cutNum, cut_pow=cutPow, augments=augs, size_buckets=sizeBuckets)
     else:
         print("Bad cut method selected")
 
@@ -176,7 +259,7 @@ def GetMakeCutouts( cutMethod:str, clipPerceptorInputResolution:int, cutNum:int,
 # no idea what im doing, still learning, but this looked cool enough to me on images > 1200x1200
 # squish
 class MakeCutoutsSquish(nn.Module):
-    def __init__(self, clipRes, cut_size_x, cut_size_y, cutn, cut_pow=1., use_pool=True, augments=[]):
+    def __init__(self, clipRes, cut_size_x, cut_size_y, cutn, cut_pow=1., use_pool=True, augments=[], size_buckets=0):
         super().__init__()
         self.cut_size_x = cut_size_x
         self.cut_size_y = cut_size_y
@@ -184,6 +267,7 @@ class MakeCutoutsSquish(nn.Module):
         self.cut_pow = cut_pow # not used with pooling
         self.use_pool = use_pool
         self.clipRes = clipRes
+        self.size_buckets = size_buckets # snap cut sizes to this many sizes so resampling can batch them, 0 = off
         
         #self.augs = setupAugmentList(cut_size_x, cut_size_y)
         self.augs = augments
@@ -195,45 +279,62 @@ class MakeCutoutsSquish(nn.Module):
         self.av_pool = nn.AdaptiveAvgPool2d((self.clipRes, self.clipRes))
         self.max_pool = nn.AdaptiveMaxPool2d((self.clipRes, self.clipRes))
 
-    @autocast(enabled=use_mixed_precision)
-    def forward(self, input):
-        sideY, sideX = input.shape[2:4]
 
+    # random cut sizes and offsets for all the cuts at once. returns a cutn x 4 cpu tensor of [x1, x2, y1, y2], same as cutout_coords
+    def SampleCutCoords(self, sideX:int, sideY:int) -> torch.Tensor:
         max_size_x = sideX
         max_size_y = sideY
 
         min_size_x = min(sideX, self.cut_size_x)
         min_size_y = min(sideX, self.cut_size_y)
 
-        cutouts = []
-        cutout_coords = []
-        
-        for _ in range(self.cutn):            
-            # Use Pooling and original method together
+        # doubles so the floor below cant round up to the max
+        size_x = (torch.rand(self.cutn, dtype=torch.float64)**self.cut_pow * (max_size_x - min_size_x) + min_size_x).long()
+        size_y = (torch.rand(self.cutn, dtype=torch.float64)**self.cut_pow * (max_size_y - min_size_y) + min_size_y).long()
+
+        # pooling handles every size in one go already, only resampling gains anything from fewer sizes
+        if not self.use_pool:
+            size_x = snap_to_size_buckets(size_x, min_size_x, max_size_x, self.size_buckets)
+            size_y = snap_to_size_buckets(size_y, min_size_y, max_size_y, self.size_buckets)
+
+        offsetx = (torch.rand(self.cutn, dtype=torch.float64) * (sideX - size_x + 1)).long()
+        offsety = (torch.rand(self.cutn, dtype=torch.float64) * (sideY - size_y + 1)).long()
+
+        return torch.stack([offsetx, offsetx + size_x, offsety, offsety + size_y], dim=1)
 
-            size_x = int(torch.rand([])**self.cut_pow * (max_size_x - min_size_x) + min_size_x)
-            size_y = int(torch.rand([])**self.cut_pow * (max_size_y - min_size_y) + min_size_y)
 
-            offsetx = torch.randint(0, sideX - size_x + 1, ())
-            offsety = torch.randint(0, sideY - size_y + 1, ())
+    # each cut pooled on its own, resampling is done per cut size
+    def GetCutouts(self, input, cutCoords:torch.Tensor):
+        if not self.use_pool:
+            return resample_cutouts_grouped(input, cutCoords.tolist(), (self.clipRes, self.clipRes), deterministic)
 
-            cutout = input[:, :, offsety:offsety + size_y, offsetx:offsetx + size_x]
-            cutout_coords.append([offsetx,offsetx + size_x,offsety,offsety + size_y])
+        cutouts = []
+
+        for x1, x2, y1, y2 in cutCoords.tolist():
+            cutout = input[:, :, y1:y2, x1:x2]
 
             # now pool for some reason? dont know what i'm doing but the results are good...
-            if self.use_pool:
-                cutout = (self.av_pool(cutout) + self.max_pool(cutout))/2
-                cutouts.append(cutout)
-            else:
-                cutouts.append(ImageUtils.resample(cutout, (self.clipRes, self.clipRes), deterministic=deterministic))            
+            cutout = (self.av_pool(cutout) + self.max_pool(cutout))/2
+            cutouts.append(cutout)
+
+        return torch.cat(cutouts, dim=0)
+
+
+    @autocast(enabled=use_mixed_precision)
+    def forward(self, input):
+        sideY, sideX = input.shape[2:4]
+
+        cutCoords = self.SampleCutCoords(sideX, sideY)
+
+        cutouts = self.GetCutouts(input, cutCoords)
             
-        batch = self.augs(torch.cat(cutouts, dim=0))
+        batch = self.augs(cutouts)
         
         if self.noise_fac:
             facs = batch.new_empty([self.cutn, 1, 1, 1]).uniform_(0, self.noise_fac)
             batch = batch + facs * torch.randn_like(batch)
 
-        return batch, cutout_coords
+        return batch, cutCoords.tolist()
 
 
 #latest make cutouts this came with - works well on images <= 600x600 ish
@@ -257,16 +358,18 @@ class MakeCutoutsNerdy(nn.Module):
     
     @autocast(enabled=use_mixed_precision)
     def forward(self, input):
-        cutouts = []
         #cutout_coords = [] # TODO: figure out how to make cutout cordinates for this... im not sure we can
         
-        #TODO: i'm pretty sure the self.cutn doesnt do anything but generate 32 copies of the same tensor here
-        for _ in range(self.cutn):
-            # Use Pooling
-            cutout = (self.av_pool(input) + self.max_pool(input))/2
-            cutouts.append(cutout)
+        # every cut is the same pooled image, only the augments and noise differ per cut.
+        # so pool once and expand it into the batch, a view instead of cutn copies. the augments all write new tensors
+        cutout = (self.av_pool(input) + self.max_pool(input))/2
+
+        if cutout.shape[0] == 1:
+            cutouts = cutout.expand(self.cutn, -1, -1, -1)
+        else:
+            cutouts = cutout.repeat(self.cutn, 1, 1, 1)
             
-        batch = self.augs(torch.cat(cutouts, dim=0))
+        batch = self.augs(cutouts)
         
         if self.noise_fac:
             facs = batch.new_empty([self.cutn, 1, 1, 1]).uniform_(0, self.noise_fac)
@@ -277,11 +380,12 @@ class MakeCutoutsNerdy(nn.Module):
 # An Nerdy updated version with selectable Kornia augments, but no pooling:
 # nerdyNoPool
 class MakeCutoutsNerdyNoPool(nn.Module):
-    def __init__(self, cut_size, cutn, cut_pow=1., augments=[]):
+    def __init__(self, cut_size, cutn, cut_pow=1., augments=[], size_buckets=0):
         super().__init__()
         self.cut_size = cut_size
         self.cutn = cutn
         self.cut_pow = cut_pow
+        self.size_buckets = size_buckets # snap cut sizes to this many sizes so resampling can batch them, 0 = off
         self.noise_fac = 0.1
         
         # Pick your own augments & their order
@@ -317,16 +421,14 @@ class MakeCutoutsNerdyNoPool(nn.Module):
         sideY, sideX = input.shape[2:4]
         max_size = min(sideX, sideY)
         min_size = min(sideX, sideY, self.cut_size)
-        cutouts = []
         cutout_coords = []
         for _ in range(self.cutn):
             size = int(torch.rand([])**self.cut_pow * (max_size - min_size) + min_size)
-            offsetx = torch.randint(0, sideX - size + 1, ())
-            offsety = torch.randint(0, sideY - size + 1, ())
-            cutout = input[:, :, offsety:offsety + size, offsetx:offsetx + size]
+            size = int(snap_to_size_buckets(torch.tensor(size), min_size, max_size, self.size_buckets))
+            offsetx = int(torch.randint(0, sideX - size + 1, ()))
+            offsety = int(torch.randint(0, sideY - size + 1, ()))
             cutout_coords.append([offsetx,offsetx + size,offsety,offsety + size])
-            cutouts.append(ImageUtils.resample(cutout, (self.cut_size, self.cut_size), deterministic=deterministic))
-        batch = self.augs(torch.cat(cutouts, dim=0))
+        batch = self.augs(resample_cutouts_grouped(input, cutout_coords, (self.cut_size, self.cut_size), deterministic))
         if self.noise_fac:
             facs = batch.new_empty([self.cutn, 1, 1, 1]).uniform_(0, self.noise_fac)
             batch = batch + facs * torch.randn_like(batch)
@@ -337,28 +439,28 @@ class MakeCutoutsNerdyNoPool(nn.Module):
 # This is the original version (No pooling)
 # original
 class MakeCutoutsOrig(nn.Module):
-    def __init__(self, cut_size, cutn, cut_pow=1., augments=[]):
+    def __init__(self, cut_size, cutn, cut_pow=1., augments=[], size_buckets=0):
         super().__init__()
         self.cut_size = cut_size
         self.cutn = cutn
         self.cut_pow = cut_pow
+        self.size_buckets = size_buckets # snap cut sizes to this many sizes so resampling can batch them, 0 = off
 
     @autocast(enabled=use_mixed_precision)
     def forward(self, input):
         sideY, sideX = input.shape[2:4]
         max_size = min(sideX, sideY)
         min_size = min(sideX, sideY, self.cut_size)
-        cutouts = []
         cutout_coords = []
         for _ in range(self.cutn):
             size = int(torch.rand([])**self.cut_pow * (max_size - min_size) + min_size)
-            offsetx = torch.randint(0, sideX - size + 1, ())
-            offsety = torch.randint(0, sideY - size + 1, ())
-            cutout = input[:, :, offsety:offsety + size, offsetx:offsetx + size]
+            size = int(snap_to_size_buckets(torch.tensor(size), min_size, max_size, self.size_buckets))
+            offsetx = int(torch.randint(0, sideX - size + 1, ()))
+            offsety = int(torch.randint(0, sideY - size + 1, ()))
             cutout_coords.append([offsetx,offsetx + size,offsety,offsety + size])
-            cutouts.append(ImageUtils.resample(cutout, (self.cut_size, self.cut_size), deterministic=deterministic))
 
-        return clamp_with_grad(torch.cat(cutouts, dim=0), 0, 1), cutout_coords
+        cutouts = resample_cutouts_grouped(input, cutout_coords, (self.cut_size, self.cut_size), deterministic)
+        return clamp_with_grad(cutouts, 0, 1), cutout_coords
 
 
 
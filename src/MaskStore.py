@@ -0,0 +1,135 @@
+import hashlib
+import threading
+from typing import Dict, List
+
+import torch
+from torch.nn import functional as F
+
+
+####################################################
+# one copy of each prompt mask on the device, shared by every prompt that uses it
+#
+# masks are keyed by the content hash of the source mask + dilation + output size + device, so 10 prompts on the
+# same mask ( or the same mask re-added every phase of a scripted job ) cost one dilate / resize and one device tensor.
+# whoever needs a mask holds a MaskHandle, entries are reference counted and dropped when the last handle is released
+####################################################
+
+
+def mask_content_hash(mask:torch.Tensor) -> str:
+    mask = mask.detach().float().contiguous().cpu()
+    return hashlib.sha256(str(tuple(mask.shape)).encode('utf-8') + mask.numpy().tobytes()).hexdigest()
+
+
+# dilate, resize to the output size and make binary. c x h x w in, c x sizeX x sizeY out, on device
+@torch.inference_mode()
+def prepare_mask(mask:torch.Tensor, dilateAmount:int, sizeXY:List[int], device) -> torch.Tensor:
+    mask = mask.unsqueeze(0).to(device)
+
+    if dilateAmount:
+        struct_ele = torch.ones((1, 1, dilateAmount, dilateAmount), device=device)
+        mask = F.conv2d(mask, struct_ele, padding='same')
+
+    mask = F.interpolate(mask, (sizeXY[0], sizeXY[1]))
+    mask = mask.squeeze(0)
+
+    mask[mask > 0.1] = 1
+    return mask
+
+
+
+class MaskHandle:
+    def __init__(self, key:tuple):
+        self.key = key
+        self.released = False
+
+
+
+class MaskEntry:
+    def __init__(self, mask:torch.Tensor):
+        self.mask = mask
+        self.refCount = 0
+
+
+
+class MaskStore:
+    def __init__(self):
+        self.entries: Dict[tuple, MaskEntry] = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+
+    # returns a handle to the prepared version of sourceMask, preparing it only if no one holds it already.
+    # contentHash can be passed in if the caller already has it
+    def Acquire(self, sourceMask:torch.Tensor, dilateAmount:int, sizeXY:List[int], device, contentHash:str = None) -> MaskHandle:
+        if contentHash is None:
+            contentHash = mask_content_hash(sourceMask)
+        key = (contentHash, int(dilateAmount or 0), tuple(sizeXY), str(torch.device(device)))
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                entry.refCount += 1
+                return MaskHandle(key)
+            self.misses += 1
+
+        mask = prepare_mask(sourceMask, dilateAmount, sizeXY, device)
+
+        with self.lock:
+            # someone else could have made it while we were
+            entry = self.entries.setdefault(key, MaskEntry(mask))
+            entry.refCount += 1
+            return MaskHandle(key)
+
+
+    # another handle to the same mask, released separately
+    def AddRef(self, handle:MaskHandle) -> MaskHandle:
+        with self.lock:
+            if handle.released or handle.key not in self.entries:
+                raise ValueError("mask handle was already released")
+            self.entries[handle.key].refCount += 1
+            return MaskHandle(handle.key)
+
+
+    def Get(self, handle:MaskHandle) -> torch.Tensor:
+        with self.lock:
+            if handle.released or handle.key not in self.entries:
+                raise ValueError("mask handle was already released")
+            return self.entries[handle.key].mask
+
+
+    # safe to call more than once per handle
+    def Release(self, handle:MaskHandle):
+        if handle is None:
+            return
+
+        with self.lock:
+            if handle.released:
+                return
+            handle.released = True
+
+            entry = self.entries.get(handle.key)
+            if entry is None:
+                return
+
+            entry.refCount -= 1
+            if entry.refCount <= 0:
+                del self.entries[handle.key]
+
+
+    # bytes held, and bytes saved vs every handle having its own copy
+    def GetStats(self) -> dict:
+        with self.lock:
+            totalBytes = 0
+            sharedBytes = 0
+            refs = 0
+            for entry in self.entries.values():
+                size = entry.mask.numel() * entry.mask.element_size()
+                totalBytes += size
+                sharedBytes += size * (entry.refCount - 1)
+                refs += entry.refCount
+
+            return { 'masks': len(self.entries), 'handles': refs, 'bytes': totalBytes, 'savedBytes': sharedBytes,
+                     'hits': self.hits, 'misses': self.misses }
@@ -0,0 +1,92 @@
+import torch
+import torch.nn as nn
+
+from src import GenerateJob
+from src import Hallucinator
+from src import MakeCutouts
+
+
+CLIP_RES = 16
+EMBED_DIM = 8
+LATENT_DIM = 4
+
+
+class StubCodebookStats:
+    def __init__(self):
+        self.codebook = torch.randn(32, LATENT_DIM, generator=torch.Generator().manual_seed(10))
+        self.codebookNormsSq = self.codebook.pow(2).sum(dim=1)
+
+
+# stands in for the vqgan decoder, each image is decoded on its own like the real one
+class StubVQGAN(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv2d(LATENT_DIM, 3, 3, padding=1)
+        with torch.no_grad():
+            self.conv.weight.copy_(torch.randn(self.conv.weight.shape, generator=torch.Generator().manual_seed(11)) * 0.3)
+            self.conv.bias.zero_()
+
+    def decode(self, z):
+        return torch.tanh(self.conv(nn.functional.interpolate(z, scale_factor=4, mode='bilinear', align_corners=False)))
+
+
+# stands in for clip, a fixed projection of the cutouts
+class StubCLIP:
+    class Visual:
+        output_dim = EMBED_DIM
+
+    def __init__(self):
+        self.visual = StubCLIP.Visual()
+        self.proj = torch.randn(3 * CLIP_RES * CLIP_RES, EMBED_DIM, generator=torch.Generator().manual_seed(12))
+
+    def encode_image(self, images):
+        return images.flatten(1) @ self.proj
+
+
+def make_hallucinator() -> Hallucinator.Hallucinator:
+    hallucinatorInst = Hallucinator.Hallucinator(display_freq=1000, metrics_flush_freq=4, save_workers=0)
+    hallucinatorInst.clipPerceptor = StubCLIP()
+    hallucinatorInst.clipPerceptorInputResolution = CLIP_RES
+    hallucinatorInst.clipDevice = torch.device('cpu')
+    hallucinatorInst.vqganDevice = torch.device('cpu')
+    hallucinatorInst.vqganModel = StubVQGAN()
+    hallucinatorInst.vqganCodebookStats = StubCodebookStats()
+    return hallucinatorInst
+
+
+def make_job(hallucinatorInst, seed:int) -> GenerateJob.GenerationJob:
+    genJob = GenerateJob.GenerationJob(hallucinatorInst, totalIterations=20, save_freq=1000)
+    generator = torch.Generator().manual_seed(seed)
+    genJob.quantizedImage = torch.randn(1, LATENT_DIM, 8, 8, generator=generator).requires_grad_(True)
+    genJob.original_quantizedImage = genJob.quantizedImage.detach().clone()
+    genJob.z_min = hallucinatorInst.vqganCodebookStats.codebook.min(0).values[None, :, None, None]
+    genJob.z_max = hallucinatorInst.vqganCodebookStats.codebook.max(0).values[None, :, None, None]
+    genJob.CurrentCutoutMethod = MakeCutouts.GetMakeCutouts('squish', CLIP_RES, 4, [0, 0], 1.0, [])
+    genJob.AddPrompt(GenerateJob.Prompt(torch.randn(1, EMBED_DIM, generator=generator), 1.0))
+    genJob.AddPrompt(GenerateJob.Prompt(torch.randn(1, EMBED_DIM, generator=generator), 0.5))
+    genJob.SetOptimizer('Adam', 0.1)
+    return genJob
+
+
+def test_batched_jobs_match_jobs_stepped_alone():
+    steps = 6
+
+    torch.manual_seed(0)
+    hallucinatorInst = make_hallucinator()
+    aloneJobs = [ make_job(hallucinatorInst, 1), make_job(hallucinatorInst, 2) ]
+    torch.manual_seed(0)
+    for _ in range(steps):
+        for genJob in aloneJobs:
+            assert hallucinatorInst.ProcessJobStep(genJob)
+
+    torch.manual_seed(0)
+    hallucinatorInst = make_hallucinator()
+    batchedJobs = [ make_job(hallucinatorInst, 1), make_job(hallucinatorInst, 2) ]
+    torch.manual_seed(0)
+    for _ in range(steps):
+        assert hallucinatorInst.ProcessJobsStep(batchedJobs) == [True, True]
+
+    for aloneJob, batchedJob in zip(aloneJobs, batchedJobs):
+        assert batchedJob.currentIteration == aloneJob.currentIteration == steps
+        assert not torch.equal(batchedJob.quantizedImage, batchedJob.original_quantizedImage)
+        assert torch.allclose(batchedJob.quantizedImage, aloneJob.quantizedImage, atol=1e-5)
@@ -0,0 +1,34 @@
+import math
+
+import torch
+
+from src import CodebookIndex
+
+
+def make_codebook(seed:int) -> torch.Tensor:
+    gen = torch.Generator().manual_seed(seed)
+    codebook = torch.randn(1024, 16, generator=gen)
+    # a pile of near duplicate codes, like the unused codes in a trained codebook, makes one oversized cluster
+    codebook[:300] = codebook[0] + 0.01 * torch.randn(300, 16, generator=gen)
+    return codebook
+
+
+def test_lists_hold_every_code_once_and_stay_narrow():
+    codebook = make_codebook(0)
+    index = CodebookIndex.IVFCodebookIndex(codebook, 32, 4)
+
+    inList = index.listNormsSq.isfinite()
+    assert sorted(index.listCodes[inList].tolist()) == list(range(codebook.shape[0]))
+    assert inList.any(dim=1).all()
+    assert index.listCodes.shape[1] <= 2 * math.ceil(codebook.shape[0] / 32)
+
+
+def test_search_probing_every_list_matches_exact_search():
+    codebook = make_codebook(1)
+    index = CodebookIndex.IVFCodebookIndex(codebook, 32, 4, searchBudgetMB=1)
+    index.numProbes = index.numLists
+
+    x = torch.randn(500, 16, generator=torch.Generator().manual_seed(2))
+    assert index.GetSearchChunkSize() < x.shape[0]
+    assert torch.equal(index.Search(x), index.ExactSearch(x))
+    assert index.Search(x[:0]).shape == (0,)
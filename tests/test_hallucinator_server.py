@@ -0,0 +1,227 @@
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+from PIL import Image
+
+from src import CmdLineArgs
+from src import GenerateJob
+from src import HallucinatorHelpers
+from src import HallucinatorServer
+from src import JobScheduler
+
+
+# stands in for a GenerationJob, only what the server and scheduler touch
+class StubJob:
+    def __init__(self, args):
+        self.totalIterations = args.max_iterations
+        self.currentIteration = 0
+        self.outputDir = args.output_dir
+        self.outputFilename = args.output
+        self.releaseCount = 0
+
+    def OnFinishGeneration(self):
+        self.ReleaseResources()
+
+    def ReleaseResources(self):
+        self.releaseCount += 1
+
+    def SaveCurrentImage(self):
+        os.makedirs(self.outputDir, exist_ok=True)
+        Image.new('RGB', (8, 8), (255, 0, 0)).save(GenerateJob.build_filename_path(self.outputDir, self.outputFilename))
+
+
+# the models are never loaded, a step just counts
+class StubHallucinator:
+    def __init__(self, stepTime:float):
+        self.stepTime = stepTime
+
+    def ProcessJobStep(self, genJob:StubJob, trainCallbackFunc = None) -> bool:
+        time.sleep(self.stepTime)
+        genJob.currentIteration += 1
+        if genJob.currentIteration == genJob.totalIterations:
+            genJob.OnFinishGeneration()
+            return False
+        return True
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    createdJobs = {}
+    creationGates = {}
+
+    # jobs are created from their spec as usual, just as a StubJob. a job whose prompt has a gate waits on it while being created
+    def create_job(hallucinatorInst, args):
+        gate = creationGates.get(args.prompts)
+        if gate is not None:
+            assert gate.wait(10)
+        job = StubJob(args)
+        createdJobs[args.prompts] = job
+        return job
+
+    monkeypatch.setattr(HallucinatorHelpers, 'CreateGenerationJobFromArgParse', create_job)
+
+    serverArgs = CmdLineArgs.build_parser().parse_args(['--output_dir', str(tmp_path) + '/', '--server_quantum', '2'])
+    inst = HallucinatorServer.HallucinatorServer(StubHallucinator(stepTime=0.01), serverArgs)
+    inst.Start('127.0.0.1', 0)
+    httpThread = threading.Thread(target=inst.httpServer.serve_forever, daemon=True)
+    httpThread.start()
+
+    inst.createdJobs = createdJobs
+    inst.creationGates = creationGates
+    inst.url = 'http://127.0.0.1:' + str(inst.httpServer.server_address[1])
+    yield inst
+
+    inst.httpServer.shutdown()
+    inst.Stop()
+    inst.workerThread.join(5)
+
+
+def request(server, method:str, path:str, spec:dict = None):
+    data = json.dumps(spec).encode('utf-8') if spec is not None else None
+    req = urllib.request.Request(server.url + path, data=data, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=10) as response:
+            return response.status, response.headers.get('Content-Type'), response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers.get('Content-Type'), e.read()
+
+
+def request_json(server, method:str, path:str, spec:dict = None):
+    code, _, body = request(server, method, path, spec)
+    return code, json.loads(body)
+
+
+def wait_for(server, jobId:str, condition, timeout:float = 10) -> dict:
+    end = time.time() + timeout
+    while time.time() < end:
+        _, status = request_json(server, 'GET', '/jobs/' + jobId)
+        if condition(status):
+            return status
+        time.sleep(0.02)
+    raise AssertionError("timed out waiting on job " + jobId + ", last status " + str(status))
+
+
+def test_submit_status_and_result(server):
+    code, status = request_json(server, 'POST', '/jobs', { 'prompts': 'a waffle', 'max_iterations': 5, 'user': 'someone' })
+    assert code == 200
+    assert status['status'] in ['queued', 'running']
+    assert status['user'] == 'someone'
+    jobId = status['id']
+
+    status = wait_for(server, jobId, lambda status: status['status'] == 'finished')
+    assert status['iteration'] == 5
+    assert status['totalIterations'] == 5
+    assert status['schedulerStats']['stepsDone'] == 5
+    assert os.path.isfile(status['outputPath'])
+
+    code, contentType, body = request(server, 'GET', '/jobs/' + jobId + '/result')
+    assert code == 200
+    assert contentType == 'image/png'
+    with open(status['outputPath'], 'rb') as f:
+        assert body == f.read()
+
+    code, allStatus = request_json(server, 'GET', '/jobs')
+    assert code == 200
+    assert [ status['id'] for status in allStatus ] == [jobId]
+
+    assert server.createdJobs['a waffle'].releaseCount == 1
+
+
+def test_bad_requests(server):
+    code, _ = request_json(server, 'POST', '/jobs', { 'not_an_option': 1 })
+    assert code == 400
+
+    code, _ = request_json(server, 'POST', '/jobs', { 'clip_model': 'RN50' })
+    assert code == 400
+
+    code, _ = request_json(server, 'GET', '/jobs/nope')
+    assert code == 404
+
+    code, _ = request_json(server, 'GET', '/jobs/nope/result')
+    assert code == 404
+
+    code, _ = request_json(server, 'POST', '/jobs/nope/cancel')
+    assert code == 404
+
+
+def test_cancel_running_job(server):
+    _, status = request_json(server, 'POST', '/jobs', { 'prompts': 'a long waffle', 'max_iterations': 100000 })
+    jobId = status['id']
+    wait_for(server, jobId, lambda status: status['status'] == 'running' and status.get('iteration', 0) > 0)
+
+    code, contentType, _ = request(server, 'GET', '/jobs/' + jobId + '/result')
+    assert code == 409
+
+    code, _ = request_json(server, 'POST', '/jobs/' + jobId + '/cancel')
+    assert code == 200
+
+    status = wait_for(server, jobId, lambda status: status['status'] == 'cancelled')
+    assert status['schedulerStats']['cancelled']
+    assert status['iteration'] < 100000
+    assert status['outputPath'] is None
+
+    # the job didnt finish, but what it held still got released
+    assert server.createdJobs['a long waffle'].releaseCount == 1
+
+    code, body = request_json(server, 'GET', '/jobs/' + jobId + '/result')
+    assert code == 409
+    assert body['status'] == 'cancelled'
+
+    code, _ = request_json(server, 'POST', '/jobs/' + jobId + '/cancel')
+    assert code == 409
+
+
+def test_cancel_queued_job(server):
+    # hold the worker while it creates the first job, so the second one stays queued
+    gate = threading.Event()
+    server.creationGates['first'] = gate
+
+    _, first = request_json(server, 'POST', '/jobs', { 'prompts': 'first', 'max_iterations': 3 })
+    _, second = request_json(server, 'POST', '/jobs', { 'prompts': 'second', 'max_iterations': 3 })
+    wait_for(server, first['id'], lambda status: status['status'] == 'running')
+
+    code, status = request_json(server, 'POST', '/jobs/' + second['id'] + '/cancel')
+    assert code == 200
+    assert status['status'] == 'cancelled'
+
+    gate.set()
+    wait_for(server, first['id'], lambda status: status['status'] == 'finished')
+
+    # the worker has moved past the queue, and never created the cancelled job
+    time.sleep(0.2)
+    _, status = request_json(server, 'GET', '/jobs/' + second['id'])
+    assert status['status'] == 'cancelled'
+    assert status['startTime'] is None
+    assert 'second' not in server.createdJobs
+
+
+def test_old_done_jobs_are_forgotten(server):
+    server.serverArgs.server_job_history = 2
+
+    jobIds = []
+    for jobNum in range(4):
+        _, status = request_json(server, 'POST', '/jobs', { 'prompts': 'waffle ' + str(jobNum), 'max_iterations': 2 })
+        jobIds.append(status['id'])
+        wait_for(server, status['id'], lambda status: status['status'] == 'finished')
+
+    _, allStatus = request_json(server, 'GET', '/jobs')
+    assert [ status['id'] for status in allStatus ] == jobIds[2:]
+
+    code, _ = request_json(server, 'GET', '/jobs/' + jobIds[0])
+    assert code == 404
+
+
+def test_scheduler_keeps_a_capped_finished_history():
+    scheduler = JobScheduler.JobScheduler(StubHallucinator(stepTime=0), quantum=10, finishedHistory=2)
+    args = CmdLineArgs.build_parser().parse_args(['-i', '3'])
+    for _ in range(4):
+        scheduler.Submit(StubJob(args))
+    scheduler.RunUntilEmpty()
+
+    assert len(scheduler.finishedJobs) == 2
+    assert [ stats['stepsDone'] for stats in scheduler.GetStats() ] == [3, 3]
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import torch
+
+from src import GenerateJob
+from src import Hallucinator
+from src import LossMetrics
+
+
+def test_rolling_stats_match_the_window():
+    values = np.random.default_rng(0).normal(size=40).cumsum()
+    stats = LossMetrics.RollingStats(7)
+
+    for count, value in enumerate(values, 1):
+        stats.Add(value)
+        window = values[max(0, count - 7):count]
+
+        assert stats.Size() == len(window)
+        assert stats.Mean() == pytest.approx(window.mean())
+        assert stats.Min() == window.min()
+        if len(window) > 1:
+            assert stats.Slope() == pytest.approx(np.polyfit(np.arange(len(window)), window, 1)[0])
+
+
+# a job with just what SetOptimizer and the scheduler updates use
+def make_job() -> GenerateJob.GenerationJob:
+    genJob = GenerateJob.GenerationJob.__new__(GenerateJob.GenerationJob)
+    genJob.quantizedImage = torch.zeros(1, 4, 2, 2, requires_grad=True)
+    genJob.lossStats = LossMetrics.RollingStats(100)
+    genJob.SetOptimizer('Adam', 0.1)
+    return genJob
+
+
+def get_lr(genJob) -> float:
+    return genJob.optimizer.param_groups[0]['lr']
+
+
+def test_flat_loss_drops_the_lr_after_patience():
+    hallucinatorInst = Hallucinator.Hallucinator()
+    genJob = make_job()
+    patience = genJob.scheduler.patience
+
+    # the first value sets the best loss, then every flat step after patience is a plateau
+    for _ in range(patience + 1):
+        hallucinatorInst.UpdateScheduler(genJob, 2.0)
+        assert get_lr(genJob) == 0.1
+
+    for step in range(1, 6):
+        hallucinatorInst.UpdateScheduler(genJob, 2.0)
+        assert get_lr(genJob) == pytest.approx(0.1 * 0.999 ** step)
+
+
+def test_falling_loss_keeps_the_lr():
+    hallucinatorInst = Hallucinator.Hallucinator()
+    genJob = make_job()
+
+    for step in range(20):
+        hallucinatorInst.UpdateScheduler(genJob, 2.0 - 0.05 * step)
+    assert get_lr(genJob) == 0.1
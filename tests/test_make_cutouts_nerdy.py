@@ -0,0 +1,71 @@
+import pytest
+import torch
+
+from src import MakeCutouts
+
+
+# the forward MakeCutoutsNerdy had before it pooled once, every cut pooled and concatenated separately
+class MakeCutoutsNerdyPerCut(MakeCutouts.MakeCutoutsNerdy):
+    def forward(self, input):
+        cutouts = []
+        for _ in range(self.cutn):
+            cutout = (self.av_pool(input) + self.max_pool(input))/2
+            cutouts.append(cutout)
+
+        batch = self.augs(torch.cat(cutouts, dim=0))
+
+        if self.noise_fac:
+            facs = batch.new_empty([self.cutn, 1, 1, 1]).uniform_(0, self.noise_fac)
+            batch = batch + facs * torch.randn_like(batch)
+
+        return batch, None
+
+
+CUT_SIZE = 32
+CUTN = 16
+AUGMENTS = [['Re', 'Af', 'Pe', 'Cr', 'Ji', 'Er']]
+
+
+# the crop box each cut got from RandomResizedCrop, cutn x 4 corners x xy
+def crop_boxes(cutter):
+    crop = next(aug for aug in cutter.augs if type(aug).__name__ == 'RandomResizedCrop')
+    return crop._params['src'].clone()
+
+
+def run_cutter(cutterClass, input, seed):
+    augs = MakeCutouts.setupAugmentList(AUGMENTS, CUT_SIZE, CUT_SIZE)
+    cutter = cutterClass(CUT_SIZE, CUTN, augments=augs)
+    if input.shape[0] > 1:
+        # the noise is sized for one image per cut, so only the single image case can use it
+        cutter.noise_fac = False
+
+    input = input.clone().requires_grad_(True)
+    torch.manual_seed(seed)
+    batch, _ = cutter(input)
+    batch.square().sum().backward()
+    return batch.detach(), input.grad, crop_boxes(cutter)
+
+
+@pytest.mark.parametrize('batchSize', [1, 2])
+def test_nerdy_matches_per_cut_pooling(batchSize):
+    input = torch.rand(batchSize, 3, 80, 96, generator=torch.Generator().manual_seed(0))
+
+    sizes = []
+    sizesRef = []
+    for seed in range(5):
+        batch, grad, boxes = run_cutter(MakeCutouts.MakeCutoutsNerdy, input, seed)
+        batchRef, gradRef, boxesRef = run_cutter(MakeCutoutsNerdyPerCut, input, seed)
+
+        assert batch.shape == (batchSize * CUTN, 3, CUT_SIZE, CUT_SIZE)
+        # same seed, same crop offsets and sizes, same cuts and gradients
+        assert torch.equal(boxes, boxesRef)
+        assert torch.allclose(batch, batchRef, atol=1e-6)
+        assert torch.allclose(grad, gradRef, atol=1e-5)
+
+        sizes.append(boxes[:, 2] - boxes[:, 0])
+        sizesRef.append(boxesRef[:, 2] - boxesRef[:, 0])
+
+    # the cuts still get different crops from each other, expanding the pooled image didnt tie them together
+    sizes = torch.cat(sizes)
+    assert torch.equal(sizes, torch.cat(sizesRef))
+    assert sizes.unique(dim=0).shape[0] > 1
@@ -0,0 +1,96 @@
+import pytest
+import torch
+
+from src import GenerateJob
+
+
+CUT_SIZE = 16
+NUM_CUTS = 6
+
+
+# a job with just what the spatial prompt cutouts and losses use
+def make_job(prompts, pairFilter:bool) -> GenerateJob.GenerationJob:
+    genJob = GenerateJob.GenerationJob.__new__(GenerateJob.GenerationJob)
+    genJob.embededPrompts = prompts
+    genJob.promptRegistry = None
+    genJob.use_spatial_prompts = True
+    genJob.spatial_pair_filter = pairFilter
+    genJob.blur_conv = None
+    genJob.noise_fac = 0.1
+    genJob.init_weight = 0
+    genJob.clipDevice = torch.device('cpu')
+    return genJob
+
+
+def make_prompt(seed:int, weight:float, mask:torch.Tensor = None) -> GenerateJob.Prompt:
+    embed = torch.randn(1, 8, generator=torch.Generator().manual_seed(seed))
+    return GenerateJob.Prompt(embed, weight, promptMask=mask)
+
+
+# stands in for clip, any fixed differentiable map from cutouts to embeddings will do
+def encode(cutouts:torch.Tensor) -> torch.Tensor:
+    proj = torch.randn(3 * CUT_SIZE * CUT_SIZE, 8, generator=torch.Generator().manual_seed(100))
+    return cutouts.flatten(1) @ proj
+
+
+def run_step(genJob, image:torch.Tensor, cutoutCoords):
+    image = image.clone().requires_grad_(True)
+    cutouts = torch.stack([ image[:, y1:y2, x1:x2] for x1, x2, y1, y2 in cutoutCoords ])
+
+    batch = genJob.GetSpatialPromptCutouts(cutouts, cutoutCoords)
+    losses = genJob.GetCutoutResults(encode(batch), 0)
+    torch.stack(losses).square().sum().backward()
+    return batch.shape[0], torch.stack(losses).detach(), image.grad
+
+
+def make_cut_coords():
+    # cuts along a 64 wide strip, left to right
+    return [ [x, x + CUT_SIZE, 0, CUT_SIZE] for x in range(0, 48 + 1, 48 // (NUM_CUTS - 1)) ]
+
+
+def test_pair_filter_matches_unfiltered_when_every_pair_overlaps():
+    image = torch.rand(3, CUT_SIZE, 64, generator=torch.Generator().manual_seed(0))
+    fullMask = torch.ones(3, CUT_SIZE, 64)
+    prompts = [ make_prompt(1, 1.0), make_prompt(2, 0.5, fullMask), make_prompt(3, 2.0, fullMask) ]
+
+    rows, losses, grad = run_step(make_job(prompts, False), image, make_cut_coords())
+    rowsFiltered, lossesFiltered, gradFiltered = run_step(make_job(prompts, True), image, make_cut_coords())
+
+    assert rows == rowsFiltered == 3 * NUM_CUTS
+    assert torch.allclose(losses, lossesFiltered, atol=1e-6)
+    assert torch.allclose(grad, gradFiltered, atol=1e-6)
+
+
+def test_pair_filter_keeps_the_unfiltered_loss_of_each_kept_pair():
+    image = torch.rand(3, CUT_SIZE, 64, generator=torch.Generator().manual_seed(0))
+    leftMask = torch.zeros(3, CUT_SIZE, 64)
+    leftMask[:, :, :24] = 1
+    prompts = [ make_prompt(2, 0.5, leftMask), make_prompt(3, -1.0, torch.ones(3, CUT_SIZE, 64)) ]
+    cutoutCoords = make_cut_coords()
+
+    genJob = make_job(prompts, True)
+    rows, losses, _ = run_step(genJob, image, cutoutCoords)
+    keptCuts = genJob.spatialPairMaskIdx.eq(0).sum().item()
+    assert 0 < keptCuts < NUM_CUTS
+    assert rows == keptCuts + NUM_CUTS
+
+    # the unfiltered batch has every cut for the left prompt, its kept pairs are its first cuts
+    genJobUnfiltered = make_job(prompts, False)
+    cutouts = torch.stack([ image[:, y1:y2, x1:x2] for x1, x2, y1, y2 in cutoutCoords ])
+    encoded = encode(genJobUnfiltered.GetSpatialPromptCutouts(cutouts, cutoutCoords))
+    perCutLosses = torch.stack([ prompts[0](encoded[cutIdx:cutIdx + 1]) for cutIdx in range(NUM_CUTS) ])
+
+    assert torch.allclose(losses[0], perCutLosses[:keptCuts].sum() / NUM_CUTS, atol=1e-6)
+    assert torch.allclose(losses[1], prompts[1](encoded[NUM_CUTS:]).detach(), atol=1e-6)
+
+
+@pytest.mark.parametrize('pairFilter', [False, True])
+def test_prompts_without_overlap_have_no_loss(pairFilter):
+    image = torch.rand(3, CUT_SIZE, 64, generator=torch.Generator().manual_seed(0))
+    prompts = [ make_prompt(1, 1.0), make_prompt(2, 0.5, torch.zeros(3, CUT_SIZE, 64)) ]
+
+    rows, losses, grad = run_step(make_job(prompts, pairFilter), image, make_cut_coords())
+
+    assert rows == NUM_CUTS
+    assert losses[1] == 0
+    assert grad is not None
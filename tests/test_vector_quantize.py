@@ -0,0 +1,59 @@
+import pytest
+import torch
+from torch.nn import functional as F
+
+from src import GenerateJob
+from src import Hallucinator
+
+
+# the one hot version vector_quantize used before it gathered codebook rows directly
+def vector_quantize_one_hot(x, codebook):
+    d = x.pow(2).sum(dim=-1, keepdim=True) + codebook.pow(2).sum(dim=1) - 2 * x @ codebook.T
+    indices = d.argmin(-1)
+    x_q = F.one_hot(indices, codebook.shape[0]).to(d.dtype) @ codebook
+    return GenerateJob.replace_grad(x_q, x)
+
+
+def make_inputs(seed):
+    gen = torch.Generator().manual_seed(seed)
+    codebook = torch.randn(512, 8, generator=gen)
+    x = torch.randn(1, 20, 30, 8, generator=gen)
+    upstreamGrad = torch.randn(1, 20, 30, 8, generator=gen)
+    return x, codebook, upstreamGrad
+
+
+def quantize_with_grad(quantizeFn, x, codebook, upstreamGrad):
+    x = x.clone().requires_grad_(True)
+    x_q = quantizeFn(x, codebook)
+    x_q.backward(upstreamGrad)
+    return x_q.detach(), x.grad
+
+
+# 0 is the single distance matrix, 1 MB splits the 600 tokens into chunks of 256 for a 512 entry codebook
+@pytest.mark.parametrize('budgetMB', [0, 1])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_vector_quantize_matches_one_hot(budgetMB, seed):
+    hallucinator = Hallucinator.Hallucinator(vq_memory_budget_mb=budgetMB)
+    x, codebook, upstreamGrad = make_inputs(seed)
+
+    if budgetMB:
+        assert 0 < hallucinator.GetVQChunkSize(codebook.shape[0], x.dtype) < x[0].numel() // x.shape[-1]
+
+    x_q, grad = quantize_with_grad(hallucinator.vector_quantize, x, codebook, upstreamGrad)
+    x_q_ref, grad_ref = quantize_with_grad(vector_quantize_one_hot, x, codebook, upstreamGrad)
+
+    assert torch.equal(x_q, x_q_ref)
+    assert torch.equal(grad, grad_ref)
+
+
+def test_chunked_nearest_code_indices_match_unchunked():
+    x, codebook, _ = make_inputs(3)
+    x = x.reshape(-1, x.shape[-1])
+    codebookNormsSq = codebook.pow(2).sum(dim=1)
+
+    unchunked = Hallucinator.Hallucinator(vq_memory_budget_mb=0).nearest_code_indices(x, codebook, codebookNormsSq)
+    chunked = Hallucinator.Hallucinator(vq_memory_budget_mb=1).nearest_code_indices(x, codebook, codebookNormsSq)
+
+    d = x.pow(2).sum(dim=-1, keepdim=True) + codebookNormsSq - 2 * x @ codebook.T
+    assert torch.equal(unchunked, d.argmin(-1))
+    assert torch.equal(chunked, unchunked)